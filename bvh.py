@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+# 
+#  BVH - bounding volume hierarchies over triangle meshes for ray queries.
+#  Authors:
+#   - Richard Petri <dasricht at gmail.com>
+#
+#  This is free and unencumbered software released into the public domain.
+#  
+#  Anyone is free to copy, modify, publish, use, compile, sell, or
+#  distribute this software, either in source code form or as a compiled
+#  binary, for any purpose, commercial or non-commercial, and by any
+#  means.
+#  
+#  In jurisdictions that recognize copyright laws, the author or authors
+#  of this software dedicate any and all copyright interest in the
+#  software to the public domain. We make this dedication for the benefit
+#  of the public at large and to the detriment of our heirs and
+#  successors. We intend this dedication to be an overt act of
+#  relinquishment in perpetuity of all present and future rights to this
+#  software under copyright law.
+#  
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#   
+#  For more information, please refer to <http://unlicense.org/>
+#
+##############################################################################
+import numpy as np
+import hommat
+
+BVH_ARRAYS = ['nodemin', 'nodemax', 'nodeleft', 'noderight', 'nodestart',
+              'nodecount', 'order', 'v0', 'e1', 'e2']
+
+def _area(bmin, bmax):
+    d = np.maximum(bmax - bmin, 0)
+    return d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0]
+
+class TriangleBVH(object):
+    '''
+    A bounding volume hierarchy over the triangles of a mesh, built with the
+    binned surface area heuristic.
+    
+    All data is stored in flat arrays (see BVH_ARRAYS), so a hierarchy can be
+    saved, cached and loaded again: nodemin/nodemax hold the node boxes,
+    nodeleft/noderight the children (-1 for leaves) and nodestart/nodecount
+    the range of the node in order, which maps to the triangle numbers.
+    v0, e1 and e2 hold the first vertex and the two edges of the triangles
+    (in order) for the intersection tests.
+    '''
+    def __init__(self, v, f, leafsize = 4, bins = 16):
+        '''
+        Builds the hierarchy over the vertex positions v (N, 3) or (N, 4)
+        and the triangles f (M, 3), e.g. of an ObjFileParser.
+        '''
+        if v is None:
+            return
+        v = np.asarray(v, dtype=np.float32)[:, :3]
+        f = np.asarray(f, dtype=np.int64).reshape(-1, 3)
+        tris = v[f]
+        pmin = tris.min(axis=1)
+        pmax = tris.max(axis=1)
+        centers = 0.5 * (pmin + pmax)
+        order = np.arange(len(f))
+        
+        # The hierarchy is built breadth first. All nodes of a level are
+        # processed at once, their triangles are contiguous in order.
+        nodemin, nodemax, nodestart, nodecount, nodeleft = [], [], [], [], []
+        starts = np.zeros(min(1, len(f)), dtype=np.int64)
+        counts = np.array([len(f)] * len(starts), dtype=np.int64)
+        nnodes = len(starts)
+        while len(starts) > 0:
+            nodes = len(starts)
+            segstarts = np.cumsum(counts) - counts
+            seg = np.repeat(np.arange(nodes), counts)
+            pos = np.repeat(starts - segstarts, counts) + np.arange(counts.sum())
+            sel = order[pos]
+            bmin = np.minimum.reduceat(pmin[sel], segstarts)
+            bmax = np.maximum.reduceat(pmax[sel], segstarts)
+            split, left = self._split(sel, seg, segstarts, counts, pmin, pmax,
+                                      centers, bins, bmin, bmax)
+            split &= counts > leafsize
+            
+            # Move the left triangles of every split node to its front.
+            key = 2 * seg + (~left | ~split[seg])
+            order[pos] = sel[np.argsort(key, kind='mergesort')]
+            nleft = np.bincount(seg[left & split[seg]], minlength=nodes)
+            
+            children = np.empty(nodes, dtype=np.int64)
+            children[:] = -1
+            children[split] = nnodes + 2 * np.arange(np.count_nonzero(split))
+            nnodes += 2 * np.count_nonzero(split)
+            nodemin.append(bmin)
+            nodemax.append(bmax)
+            nodestart.append(starts)
+            nodecount.append(counts)
+            nodeleft.append(children)
+            
+            starts, counts, nleft = starts[split], counts[split], nleft[split]
+            starts = np.stack([starts, starts + nleft], axis=1).ravel()
+            counts = np.stack([nleft, counts - nleft], axis=1).ravel()
+        
+        concat = lambda arrays, shape, dtype: (np.concatenate(arrays)
+            if arrays else np.zeros(shape, dtype=dtype))
+        self.nodemin = concat(nodemin, (0, 3), np.float32)
+        self.nodemax = concat(nodemax, (0, 3), np.float32)
+        self.nodestart = concat(nodestart, 0, np.int64)
+        self.nodecount = concat(nodecount, 0, np.int64)
+        self.nodeleft = concat(nodeleft, 0, np.int64)
+        self.noderight = np.where(self.nodeleft < 0, -1, self.nodeleft + 1)
+        self.order = order
+        tris = tris[order]
+        self.v0 = tris[:, 0]
+        self.e1 = tris[:, 1] - tris[:, 0]
+        self.e2 = tris[:, 2] - tris[:, 0]
+    
+    @staticmethod
+    def _split(sel, seg, segstarts, counts, pmin, pmax, centers, bins,
+               nodemin, nodemax):
+        '''
+        Finds the best binned SAH splits of the nodes, whose triangles sel
+        are given in segments. Returns whether a node should be split and
+        whether each triangle goes to the left child.
+        '''
+        nodes = len(counts)
+        c = centers[sel]
+        cmin = np.minimum.reduceat(c, segstarts)
+        extent = np.maximum.reduceat(c, segstarts) - cmin
+        scale = bins / np.where(extent > 0, extent, np.inf)
+        binof = np.minimum(((c - cmin[seg]) * scale[seg]).astype(np.int64),
+                           bins - 1)
+        bestcost = counts * _area(nodemin, nodemax)
+        bestaxis = np.zeros(nodes, dtype=np.int64)
+        bestbin = np.zeros(nodes, dtype=np.int64)
+        for axis in range(3):
+            key = seg * bins + binof[:, axis]
+            count = np.bincount(key, minlength=nodes * bins)
+            nonempty = count > 0
+            keystarts = (np.cumsum(count) - count)[nonempty]
+            ordered = sel[np.argsort(key, kind='mergesort')]
+            bmin = np.empty((nodes * bins, 3), dtype=np.float32)
+            bmax = np.empty((nodes * bins, 3), dtype=np.float32)
+            bmin[:] = np.inf
+            bmax[:] = -np.inf
+            bmin[nonempty] = np.minimum.reduceat(pmin[ordered], keystarts)
+            bmax[nonempty] = np.maximum.reduceat(pmax[ordered], keystarts)
+            bmin = bmin.reshape(nodes, bins, 3)
+            bmax = bmax.reshape(nodes, bins, 3)
+            count = count.reshape(nodes, bins)
+            # Costs of the splits after every bin from prefix/suffix bounds.
+            lcount = np.cumsum(count, axis=1)[:, :-1]
+            rcount = counts[:, np.newaxis] - lcount
+            larea = _area(np.minimum.accumulate(bmin, axis=1)[:, :-1],
+                          np.maximum.accumulate(bmax, axis=1)[:, :-1])
+            rarea = _area(np.minimum.accumulate(bmin[:, ::-1], axis=1)[:, -2::-1],
+                          np.maximum.accumulate(bmax[:, ::-1], axis=1)[:, -2::-1])
+            cost = np.where((lcount > 0) & (rcount > 0),
+                            lcount * larea + rcount * rarea, np.inf)
+            i = np.argmin(cost, axis=1)
+            cost = cost[np.arange(nodes), i]
+            better = cost < bestcost
+            bestcost[better] = cost[better]
+            bestaxis[better] = axis
+            bestbin[better] = i[better]
+        split = np.isfinite(bestcost) & (bestcost < counts * _area(nodemin, nodemax))
+        left = binof[np.arange(len(sel)), bestaxis[seg]] <= bestbin[seg]
+        return split, left
+    
+    @classmethod
+    def fromobj(cls, obj, leafsize = 4, bins = 16):
+        '''Builds the hierarchy over the triangles of an ObjFileParser.'''
+        return cls(obj.v, obj.f, leafsize, bins)
+    
+    def toarrays(self):
+        '''Returns the flat arrays of the hierarchy as dict.'''
+        return dict((name, getattr(self, name)) for name in BVH_ARRAYS)
+    
+    @classmethod
+    def fromarrays(cls, arrays):
+        '''Creates a hierarchy from the arrays returned by toarrays.'''
+        self = cls(None, None)
+        for name in BVH_ARRAYS:
+            setattr(self, name, arrays[name])
+        return self
+    
+    def save(self, file):
+        '''Saves the hierarchy to a .npz file.'''
+        np.savez(file, **self.toarrays())
+    
+    @classmethod
+    def load(cls, file):
+        '''Loads a hierarchy saved with save.'''
+        with np.load(file) as arrays:
+            return cls.fromarrays(dict((name, arrays[name])
+                                       for name in BVH_ARRAYS))
+    
+    def intersect(self, origins, directions, tmin = 0.0, tmax = np.inf):
+        '''
+        Finds the closest hits of the rays (R, 3) with the triangles. The
+        hierarchy is traversed for all rays at once, level by level. Returns
+        the distances t (R,) (inf for misses), the triangle numbers (-1 for
+        misses) and the barycentric coordinates u and v of the hits.
+        A single ray of shape (3,) returns scalars.
+        '''
+        single = np.ndim(origins) == 1
+        origins = np.atleast_2d(np.asarray(origins, dtype=np.float64))[:, :3]
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))[:, :3]
+        nrays = len(origins)
+        best = np.empty(nrays)
+        best[:] = tmax
+        triangle = np.empty(nrays, dtype=np.int64)
+        triangle[:] = -1
+        bu = np.zeros(nrays)
+        bv = np.zeros(nrays)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            invdirs = 1.0 / directions
+        
+        rays = np.arange(nrays if len(self.nodestart) > 0 else 0)
+        nodes = np.zeros(len(rays), dtype=np.int64)
+        while len(rays) > 0:
+            # Slab test of all (ray, node) pairs.
+            o, inv = origins[rays], invdirs[rays]
+            with np.errstate(invalid='ignore'):
+                t1 = (self.nodemin[nodes] - o) * inv
+                t2 = (self.nodemax[nodes] - o) * inv
+            tnear = np.nanmax(np.fmin(t1, t2), axis=1)
+            tfar = np.nanmin(np.fmax(t1, t2), axis=1)
+            hit = ((tnear <= tfar) & (tfar >= tmin) & (tnear <= best[rays]))
+            rays, nodes = rays[hit], nodes[hit]
+            
+            # Test the triangles of the leaves.
+            isleaf = self.nodeleft[nodes] < 0
+            if np.any(isleaf):
+                lrays, lnodes = rays[isleaf], nodes[isleaf]
+                counts = self.nodecount[lnodes]
+                trays = np.repeat(lrays, counts)
+                tris = (np.repeat(self.nodestart[lnodes] - np.cumsum(counts)
+                                  + counts, counts) + np.arange(counts.sum()))
+                t, u, v, ok = self._triangles(origins[trays],
+                                              directions[trays], tris)
+                ok &= (t >= tmin) & (t < best[trays])
+                trays, tris, t, u, v = trays[ok], tris[ok], t[ok], u[ok], v[ok]
+                np.minimum.at(best, trays, t)
+                closest = t == best[trays]
+                trays, tris = trays[closest], tris[closest]
+                triangle[trays] = self.order[tris]
+                bu[trays] = u[closest]
+                bv[trays] = v[closest]
+            
+            rays, nodes = rays[~isleaf], nodes[~isleaf]
+            rays = np.concatenate([rays, rays])
+            nodes = np.concatenate([self.nodeleft[nodes], self.noderight[nodes]])
+        
+        best[triangle < 0] = np.inf
+        if single:
+            return best[0], triangle[0], bu[0], bv[0]
+        return best, triangle, bu, bv
+    
+    def _triangles(self, origins, directions, tris):
+        '''Moeller-Trumbore intersection of the rays with the triangles.'''
+        v0 = self.v0[tris].astype(np.float64)
+        e1 = self.e1[tris].astype(np.float64)
+        e2 = self.e2[tris].astype(np.float64)
+        p = np.cross(directions, e2)
+        det = np.sum(e1 * p, axis=1)
+        ok = np.abs(det) > 1e-12
+        inv = 1.0 / np.where(ok, det, 1.0)
+        s = origins - v0
+        u = np.sum(s * p, axis=1) * inv
+        q = np.cross(s, e1)
+        v = np.sum(directions * q, axis=1) * inv
+        t = np.sum(e2 * q, axis=1) * inv
+        ok &= (u >= 0) & (v >= 0) & (u + v <= 1)
+        return t, u, v, ok
+    
+    def pick(self, origin, direction):
+        '''
+        Returns the number of the closest triangle hit by a single ray (or -1)
+        and the distance along the ray.
+        '''
+        t, triangle, _, _ = self.intersect(origin, direction)
+        return triangle, t
+
+def screenray(M, x, y, width, height):
+    '''
+    Returns the origin and the (normalized) direction of the ray through the
+    window coordinates x, y (e.g. the demoplate mouse position, origin at
+    the top left) for the (projection * view * model) matrix M.
+    '''
+    ndcx = 2.0 * x / width - 1
+    ndcy = 1 - 2.0 * y / height
+    near, far = hommat.transformpoints(hommat.inverse(M),
+        [[ndcx, ndcy, -1, 1], [ndcx, ndcy, 1, 1]], divide=True)
+    direction = far - near
+    return near, direction / np.linalg.norm(direction)
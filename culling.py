@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+# 
+#  Culling - view-frustum culling of axis aligned bounding boxes.
+#  Authors:
+#   - Richard Petri <dasricht at gmail.com>
+#
+#  This is free and unencumbered software released into the public domain.
+#  
+#  Anyone is free to copy, modify, publish, use, compile, sell, or
+#  distribute this software, either in source code form or as a compiled
+#  binary, for any purpose, commercial or non-commercial, and by any
+#  means.
+#  
+#  In jurisdictions that recognize copyright laws, the author or authors
+#  of this software dedicate any and all copyright interest in the
+#  software to the public domain. We make this dedication for the benefit
+#  of the public at large and to the detriment of our heirs and
+#  successors. We intend this dedication to be an overt act of
+#  relinquishment in perpetuity of all present and future rights to this
+#  software under copyright law.
+#  
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#   
+#  For more information, please refer to <http://unlicense.org/>
+#
+##############################################################################
+import numpy as np
+
+# Results of the box/frustum classification.
+CULL_OUTSIDE = 0
+CULL_INTERSECT = 1
+CULL_INSIDE = 2
+
+def frustumplanes(M):
+    '''
+    Extracts the six frustum planes (left, right, bottom, top, near, far)
+    from a (projection * view) matrix as built with hommat. Returns a (6, 4)
+    array of normalized planes (a, b, c, d), their normals point inwards.
+    '''
+    M = np.asarray(M, dtype=np.float64)
+    planes = np.array([M[3] + M[0], M[3] - M[0],
+                       M[3] + M[1], M[3] - M[1],
+                       M[3] + M[2], M[3] - M[2]])
+    planes /= np.linalg.norm(planes[:, :3], axis=1)[:, np.newaxis]
+    return planes
+
+def objectbox(obj):
+    '''Returns the (2, 3) bounding box of an ObjFileParser.'''
+    return np.array([obj.minpos, obj.maxpos], dtype=np.float32)
+
+def transformboxes(M, boxes):
+    '''
+    Transforms the bounding boxes (N, 2, 3) with the affine matrix M or one
+    of the matrices (N, 4, 4) each. Returns the (N, 2, 3) boxes enclosing the
+    transformed boxes.
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64)
+    M = np.asarray(M, dtype=np.float64)
+    R = M[..., :3, :3]
+    center = 0.5 * (boxes[:, 0] + boxes[:, 1])
+    extent = 0.5 * (boxes[:, 1] - boxes[:, 0])
+    if M.ndim == 2:
+        center = np.dot(center, R.T) + M[:3, 3]
+        extent = np.dot(extent, np.abs(R).T)
+    else:
+        center = np.einsum('nij,nj->ni', R, center) + M[:, :3, 3]
+        extent = np.einsum('nij,nj->ni', np.abs(R), extent)
+    return np.stack([center - extent, center + extent], axis=1)
+
+def classifyboxes(planes, boxes):
+    '''
+    Classifies the bounding boxes (N, 2, 3) against the frustum planes.
+    Returns CULL_OUTSIDE, CULL_INTERSECT or CULL_INSIDE for every box.
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64)
+    center = 0.5 * (boxes[:, 0] + boxes[:, 1])
+    extent = 0.5 * (boxes[:, 1] - boxes[:, 0])
+    # Distance of the box centers and the projected box radius per plane.
+    distance = np.dot(center, planes[:, :3].T) + planes[:, 3]
+    radius = np.dot(extent, np.abs(planes[:, :3]).T)
+    result = np.empty(len(boxes), dtype=np.int8)
+    result[:] = CULL_INTERSECT
+    result[np.all(distance >= radius, axis=1)] = CULL_INSIDE
+    result[np.any(distance < -radius, axis=1)] = CULL_OUTSIDE
+    return result
+
+def cullboxes(planes, boxes):
+    '''
+    Tests the bounding boxes (N, 2, 3) against the frustum planes, returns a
+    boolean mask of the (possibly) visible boxes.
+    '''
+    return classifyboxes(planes, boxes) != CULL_OUTSIDE
+
+class BoxHierarchy(object):
+    '''
+    A bounding volume hierarchy over bounding boxes (N, 2, 3) for culling
+    large scenes. The nodes are stored in flat arrays: nodeboxes holds the
+    boxes, nodestart/nodecount the range of the node in order, and
+    nodeleft/noderight the children (-1 for leaves).
+    '''
+    def __init__(self, boxes, leafsize = 16):
+        boxes = np.asarray(boxes, dtype=np.float32)
+        self.boxes = boxes
+        self.order = np.arange(len(boxes))
+        centers = 0.5 * (boxes[:, 0] + boxes[:, 1])
+        nodeboxes, starts, counts, lefts, rights = [], [], [], [], []
+        
+        def addnode(start, end):
+            sel = self.order[start:end]
+            nodeboxes.append([boxes[sel, 0].min(axis=0),
+                              boxes[sel, 1].max(axis=0)])
+            starts.append(start)
+            counts.append(end - start)
+            lefts.append(-1)
+            rights.append(-1)
+            return len(starts) - 1
+        
+        stack = [addnode(0, len(boxes))] if len(boxes) > 0 else []
+        while stack:
+            node = stack.pop()
+            start, count = starts[node], counts[node]
+            if count <= leafsize:
+                continue
+            # Split at the median of the longest axis of the centers.
+            sel = self.order[start:start + count]
+            c = centers[sel]
+            axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+            half = count // 2
+            part = np.argpartition(c[:, axis], half)
+            self.order[start:start + count] = sel[part]
+            lefts[node] = addnode(start, start + half)
+            rights[node] = addnode(start + half, start + count)
+            stack.extend([lefts[node], rights[node]])
+        
+        self.nodeboxes = np.array(nodeboxes, dtype=np.float32).reshape(-1, 2, 3)
+        self.nodestart = np.array(starts, dtype=np.int64)
+        self.nodecount = np.array(counts, dtype=np.int64)
+        self.nodeleft = np.array(lefts, dtype=np.int64)
+        self.noderight = np.array(rights, dtype=np.int64)
+    
+    def cull(self, planes):
+        '''
+        Returns a boolean mask of the (possibly) visible boxes. The hierarchy
+        is traversed level by level, all nodes of a level are tested at once.
+        '''
+        visible = np.zeros(len(self.boxes), dtype=bool)
+        # Visible box ranges in order, marked via a difference array.
+        marks = np.zeros(len(self.boxes) + 1, dtype=np.int64)
+        leaves = []
+        nodes = np.arange(min(1, len(self.nodestart)))
+        while len(nodes) > 0:
+            result = classifyboxes(planes, self.nodeboxes[nodes])
+            inside = nodes[result == CULL_INSIDE]
+            np.add.at(marks, self.nodestart[inside], 1)
+            np.add.at(marks, self.nodestart[inside] + self.nodecount[inside], -1)
+            nodes = nodes[result == CULL_INTERSECT]
+            isleaf = self.nodeleft[nodes] < 0
+            leaves.append(nodes[isleaf])
+            nodes = nodes[~isleaf]
+            nodes = np.concatenate([self.nodeleft[nodes], self.noderight[nodes]])
+        visible[self.order[np.cumsum(marks[:-1]) > 0]] = True
+        
+        # Test the boxes of the intersecting leaves individually.
+        leaves = np.concatenate(leaves) if leaves else np.zeros(0, np.int64)
+        if len(leaves) > 0:
+            counts = self.nodecount[leaves]
+            offsets = np.repeat(self.nodestart[leaves] - (np.cumsum(counts) - counts), counts)
+            sel = self.order[np.arange(counts.sum()) + offsets]
+            visible[sel] = cullboxes(planes, self.boxes[sel])
+        return visible
@@ -33,68 +33,469 @@
 ##############################################################################
 import numpy as np
 import math
+import threading
 
-def identity():
-    '''Create the identity matrix.'''
-    return np.identity(4, dtype=np.float32)
+_IDENTITY = np.identity(4, dtype=np.float32)
+
+class Workspace(object):
+    '''
+    Scratch matrices for the allocation free variants of the matrix
+    functions, i.e. when they are called with a preallocated float32 out
+    matrix. out may be the old matrix for an in-place composition, and old
+    may be None to just write the transformation into out.
+    A workspace must not be shared between threads, if none is given a per
+    thread default is used.
+    '''
+    def __init__(self):
+        self.M = np.identity(4, dtype=np.float32)
+        self.result = np.empty((4, 4), dtype=np.float32)
+
+_local = threading.local()
+
+def _workspace(workspace):
+    if workspace is None:
+        workspace = getattr(_local, 'workspace', None)
+        if workspace is None:
+            workspace = _local.workspace = Workspace()
+    return workspace
+
+def _matrix(out, workspace):
+    '''Returns an identity matrix to build a transformation in.'''
+    if out is None:
+        return np.identity(4, dtype=np.float32)
+    M = _workspace(workspace).M
+    np.copyto(M, _IDENTITY)
+    return M
+
+def _compose(old, M, out, workspace):
+    '''
+    Returns old * M. If out is given, the product is written into it (out may
+    be old for an in-place composition). old and out must be float32 then.
+    '''
+    if out is None:
+        return np.dot(old, M)
+    if old is None:
+        np.copyto(out, M)
+    elif np.may_share_memory(old, out):
+        result = _workspace(workspace).result
+        np.dot(old, M, out=result)
+        np.copyto(out, result)
+    else:
+        np.dot(old, M, out=out)
+    return out
+
+def identity(out = None):
+    '''Create the identity matrix (or reset out to it).'''
+    if out is None:
+        return np.identity(4, dtype=np.float32)
+    np.copyto(out, _IDENTITY)
+    return out
     
-def translation(old, trans):
+def translation(old, trans, out = None, workspace = None):
     '''Multiplies the old matrix with a translation in dir.'''
-    M = np.identity(4, dtype=np.float32)
+    M = _matrix(out, workspace)
     M[:3, 3] = trans[:3]
-    return np.dot(old, M)
+    return _compose(old, M, out, workspace)
     
-def rotation(old, angle, vec):
+def rotation(old, angle, vec, out = None, workspace = None):
     '''Multiplies the old matrix with a rotation around a vector.'''
     cosa = math.cos(angle * math.pi / 180)
     sina = math.sin(angle * math.pi / 180)
     cosa1 = 1 - cosa
-    M = np.array([[vec[0]**2 * cosa1 + cosa             , vec[0] * vec[1] * cosa1 - vec[2]*sina, vec[0] * vec[2] * cosa1 + vec[1]*sina, 0],
-                  [vec[1] * vec[0] * cosa1 + vec[2]*sina, vec[1]**2 * cosa1 + cosa             , vec[1] * vec[2] * cosa1 - vec[0]*sina, 0],
-                  [vec[2] * vec[0] * cosa1 - vec[1]*sina, vec[2] * vec[1] * cosa1 + vec[0]*sina, vec[2]**2 * cosa1 + cosa             , 0],
-                  [0,0,0,1]
-                 ], dtype=np.float32)
-    return np.dot(old, M)
+    x, y, z = vec[0], vec[1], vec[2]
+    M = _matrix(out, workspace)
+    M[0, 0] = x**2 * cosa1 + cosa
+    M[0, 1] = x * y * cosa1 - z * sina
+    M[0, 2] = x * z * cosa1 + y * sina
+    M[1, 0] = y * x * cosa1 + z * sina
+    M[1, 1] = y**2 * cosa1 + cosa
+    M[1, 2] = y * z * cosa1 - x * sina
+    M[2, 0] = z * x * cosa1 - y * sina
+    M[2, 1] = z * y * cosa1 + x * sina
+    M[2, 2] = z**2 * cosa1 + cosa
+    return _compose(old, M, out, workspace)
           
-def scale(old, axes):
+def scale(old, axes, out = None, workspace = None):
     '''Multiplies the old matrix with a scaleing matrix.'''
-    M = np.array([[axes[0], 0, 0, 0],
-                  [0, axes[1], 0, 0],
-                  [0, 0, axes[2], 0],
-                  [0, 0, 0, 1]
-                 ], dtype=np.float32)
-    return np.dot(old, M)
-
-def ortho(old, l, r, b, t, n, f):
+    M = _matrix(out, workspace)
+    M[0, 0] = axes[0]
+    M[1, 1] = axes[1]
+    M[2, 2] = axes[2]
+    return _compose(old, M, out, workspace)
+
+def ortho(old, l, r, b, t, n, f, out = None, workspace = None):
     '''Multiplies the old matrix with a orthogonal projection.'''
-    M = np.array([[2.0 / (r - l), 0, 0, -float(r + l) / (r - l)],
-                  [0, 2.0 / (t - b), 0, -float(t + b) / (t - b)],
-                  [0, 0, 2.0 / (f - n), -float(f + n) / (f - n)],
-                  [0,0,0,1]
-                 ], dtype=np.float32)
-    return np.dot(old, M)
+    M = _matrix(out, workspace)
+    M[0, 0] = 2.0 / (r - l)
+    M[0, 3] = -float(r + l) / (r - l)
+    M[1, 1] = 2.0 / (t - b)
+    M[1, 3] = -float(t + b) / (t - b)
+    M[2, 2] = 2.0 / (f - n)
+    M[2, 3] = -float(f + n) / (f - n)
+    return _compose(old, M, out, workspace)
                     
-def perspective(old, fovy, aspect, near, far):
+def perspective(old, fovy, aspect, near, far, out = None, workspace = None):
     '''Multiplies the old matrix with a perspective projection.'''
     f = 1.0 / math.tan(fovy * math.pi / 360.0)
-    M = np.array([[f / aspect, 0, 0, 0],
-                  [0, f, 0, 0],
-                  [0, 0, float(far + near) / (near - far), (2.0 * far * near) / (near - far)],
-                  [0, 0, -1, 0]
-                 ], dtype=np.float32)
-    return np.dot(old, M)
+    M = _matrix(out, workspace)
+    M[0, 0] = f / aspect
+    M[1, 1] = f
+    M[2, 2] = float(far + near) / (near - far)
+    M[2, 3] = (2.0 * far * near) / (near - far)
+    M[3, 2] = -1
+    M[3, 3] = 0
+    return _compose(old, M, out, workspace)
                     
-def lookat(old, eye, at, up = np.array([0,1,0,1])):
+def lookat(old, eye, at, up = np.array([0,1,0,1]), out = None, workspace = None):
     '''Multiplies the old matrix with a lookat transformation.'''
-    f = at[:3] - eye[:3]
-    f *= 1 / np.linalg.norm(f)
-    up /= np.linalg.norm(up[:3])
-    s = np.cross(f, up[:3])
+    if out is None:
+        f = at[:3] - eye[:3]
+        f *= 1 / np.linalg.norm(f)
+        up /= np.linalg.norm(up[:3])
+        s = np.cross(f, up[:3])
+        u = np.cross(s, f)
+        M = np.identity(4, dtype=np.float32)
+        M[0, :3] = s
+        M[1, :3] = u
+        M[2, :3] = -f
+        return np.dot(old, translation(M, -eye))
+    
+    # The same with scalars only, so that no arrays are allocated.
+    ex, ey, ez = float(eye[0]), float(eye[1]), float(eye[2])
+    fx, fy, fz = float(at[0]) - ex, float(at[1]) - ey, float(at[2]) - ez
+    norm = math.sqrt(fx * fx + fy * fy + fz * fz)
+    fx, fy, fz = fx / norm, fy / norm, fz / norm
+    ux, uy, uz = float(up[0]), float(up[1]), float(up[2])
+    norm = math.sqrt(ux * ux + uy * uy + uz * uz)
+    ux, uy, uz = ux / norm, uy / norm, uz / norm
+    sx, sy, sz = fy * uz - fz * uy, fz * ux - fx * uz, fx * uy - fy * ux
+    ux, uy, uz = sy * fz - sz * fy, sz * fx - sx * fz, sx * fy - sy * fx
+    M = _matrix(out, workspace)
+    M[0, 0], M[0, 1], M[0, 2] = sx, sy, sz
+    M[1, 0], M[1, 1], M[1, 2] = ux, uy, uz
+    M[2, 0], M[2, 1], M[2, 2] = -fx, -fy, -fz
+    M[0, 3] = -(sx * ex + sy * ey + sz * ez)
+    M[1, 3] = -(ux * ex + uy * ey + uz * ez)
+    M[2, 3] = fx * ex + fy * ey + fz * ez
+    return _compose(old, M, out, workspace)
+
+def batchidentity(n):
+    '''Create a stack of n identity matrices.'''
+    M = np.zeros((n, 4, 4), dtype=np.float32)
+    M[:, [0, 1, 2, 3], [0, 1, 2, 3]] = 1
+    return M
+
+def batchmultiply(old, M):
+    '''
+    Multiplies the old matrices with the matrices M. Both may be single 4x4
+    matrices or (N, 4, 4) stacks, single matrices are broadcast.
+    '''
+    return np.matmul(old, M)
+
+def batchtranslation(old, trans):
+    '''Multiplies the old matrix (or matrices) with N translations (N, 3).'''
+    trans = np.asarray(trans, dtype=np.float32)
+    M = batchidentity(len(trans))
+    M[:, :3, 3] = trans[:, :3]
+    return np.matmul(old, M)
+
+def batchrotation(old, angles, vecs):
+    '''
+    Multiplies the old matrix (or matrices) with N rotations around vectors.
+    angles has the shape (N,), vecs (N, 3) or (3,) for a common axis.
+    '''
+    angles = np.asarray(angles, dtype=np.float64) * (math.pi / 180)
+    vecs = np.broadcast_to(np.asarray(vecs, dtype=np.float64)[..., :3],
+                           (len(angles), 3))
+    cosa = np.cos(angles)
+    sina = np.sin(angles)
+    cosa1 = 1 - cosa
+    x, y, z = vecs[:, 0], vecs[:, 1], vecs[:, 2]
+    M = batchidentity(len(angles))
+    M[:, 0, 0] = x**2 * cosa1 + cosa
+    M[:, 0, 1] = x * y * cosa1 - z * sina
+    M[:, 0, 2] = x * z * cosa1 + y * sina
+    M[:, 1, 0] = y * x * cosa1 + z * sina
+    M[:, 1, 1] = y**2 * cosa1 + cosa
+    M[:, 1, 2] = y * z * cosa1 - x * sina
+    M[:, 2, 0] = z * x * cosa1 - y * sina
+    M[:, 2, 1] = z * y * cosa1 + x * sina
+    M[:, 2, 2] = z**2 * cosa1 + cosa
+    return np.matmul(old, M)
+
+def batchscale(old, axes):
+    '''Multiplies the old matrix (or matrices) with N scaleing matrices.'''
+    axes = np.asarray(axes, dtype=np.float32)
+    M = batchidentity(len(axes))
+    M[:, [0, 1, 2], [0, 1, 2]] = axes[:, :3]
+    return np.matmul(old, M)
+
+def batchlookat(old, eyes, ats, ups = np.array([0,1,0])):
+    '''
+    Multiplies the old matrix (or matrices) with N lookat transformations.
+    eyes and ats have the shape (N, 3), ups (N, 3) or (3,).
+    '''
+    eyes = np.asarray(eyes, dtype=np.float64)[:, :3]
+    ats = np.asarray(ats, dtype=np.float64)[:, :3]
+    ups = np.asarray(ups, dtype=np.float64)[..., :3]
+    f = ats - eyes
+    f /= np.linalg.norm(f, axis=-1)[:, np.newaxis]
+    ups = ups / np.linalg.norm(ups, axis=-1)[..., np.newaxis]
+    s = np.cross(f, ups)
     u = np.cross(s, f)
-    M = np.identity(4, dtype=np.float32)
-    M[0, :3] = s
-    M[1, :3] = u
-    M[2, :3] = -f
-    return np.dot(old, translation(M, -eye))
+    M = batchidentity(len(eyes))
+    M[:, 0, :3] = s
+    M[:, 1, :3] = u
+    M[:, 2, :3] = -f
+    # Equals M * translation(-eye)
+    M[:, :3, 3] = -np.einsum('nij,nj->ni', M[:, :3, :3], eyes)
+    return np.matmul(old, M)
+
+def _chunks(n, chunksize):
+    for start in range(0, n, chunksize):
+        yield start, min(start + chunksize, n)
+
+def _points(points):
+    points = np.asarray(points, dtype=np.float32)
+    if points.ndim != 2 or points.shape[1] not in [3, 4]:
+        raise Exception, 'Points must be of shape (N, 3) or (N, 4).'
+    return points
+
+def transformpoints(M, points, divide = False, out = None, chunksize = 1 << 16):
+    '''
+    Transforms the points (N, 3) or (N, 4) with the matrix M or with one of
+    the matrices (N, 4, 4) each. Missing w coordinates are 1, so the vertices
+    of an ObjFileParser can be passed directly. Returns the homogeneous
+    results (N, 4), or the (N, 3) results of the perspective divide if
+    divide is set. The points are processed in chunks of chunksize points to
+    bound the temporary memory.
+    '''
+    points = _points(points)
+    M = np.asarray(M, dtype=np.float32)
+    hasw = points.shape[1] == 4
+    if out is None:
+        out = np.empty((len(points), 3 if divide else 4), dtype=np.float32)
+    for start, end in _chunks(len(points), chunksize):
+        p = points[start:end]
+        if M.ndim == 2:
+            h = np.dot(p[:, :3], M[:, :3].T)
+            h += p[:, 3:] * M[:, 3] if hasw else M[:, 3]
+        else:
+            m = M[start:end]
+            h = np.einsum('nij,nj->ni', m[:, :, :3], p[:, :3])
+            h += m[:, :, 3] * p[:, 3:] if hasw else m[:, :, 3]
+        if divide:
+            np.divide(h[:, :3], h[:, 3:], out=out[start:end])
+        else:
+            out[start:end] = h
+    return out
+
+def transformvectors(M, vecs, out = None, chunksize = 1 << 16):
+    '''
+    Transforms the direction vectors (N, 3) or (N, 4) (the w coordinate is
+    ignored) with the upper 3x3 part of the matrix M or of one of the
+    matrices (N, 4, 4) each. Returns the (N, 3) results.
+    '''
+    vecs = _points(vecs)
+    M = np.asarray(M, dtype=np.float32)
+    if out is None:
+        out = np.empty((len(vecs), 3), dtype=np.float32)
+    for start, end in _chunks(len(vecs), chunksize):
+        if M.ndim == 2:
+            out[start:end] = np.dot(vecs[start:end, :3], M[:3, :3].T)
+        else:
+            out[start:end] = np.einsum('nij,nj->ni', M[start:end, :3, :3],
+                                       vecs[start:end, :3])
+    return out
+
+# Flat indices (a, b, c, d) of the 2x2 determinants a * b - c * d, that are
+# the cofactors of a 3x3 matrix.
+_COFACTORS3 = np.array([[4, 5, 3, 7, 8, 6, 1, 2, 0],
+                        [8, 6, 7, 2, 0, 1, 5, 3, 4],
+                        [5, 3, 4, 8, 6, 7, 2, 0, 1],
+                        [7, 8, 6, 1, 2, 0, 4, 5, 3]])
+
+def _cofactors3(a, b, c, d, e, f, g, h, i):
+    '''Returns the cofactors and the determinant of a 3x3 matrix (floats).'''
+    C = [e * i - f * h, f * g - d * i, d * h - e * g,
+         c * h - b * i, a * i - c * g, b * g - a * h,
+         b * f - c * e, c * d - a * f, a * e - b * d]
+    return C, a * C[0] + b * C[1] + c * C[2]
+
+def _inverse3(A):
+    '''
+    Returns the transposed inverses of the 3x3 matrices A (..., 3, 3),
+    i.e. their cofactor matrices divided by their determinants.
+    '''
+    # One row per matrix element, so gathers copy whole rows.
+    a = A.reshape(-1, 9).T.copy()
+    C = a[_COFACTORS3[0]] * a[_COFACTORS3[1]]
+    C -= a[_COFACTORS3[2]] * a[_COFACTORS3[3]]
+    det = np.sum(a[:3] * C[:3], axis=0)
+    if not np.all(det):
+        raise np.linalg.LinAlgError, 'Singular matrix'
+    C /= det
+    return C.T.reshape(A.shape)
+
+def normalmatrix(M):
+    '''
+    Returns the normal matrices (the inverse transpose of the upper 3x3 part)
+    of the matrix M or the matrices (N, 4, 4) as contiguous float32 array,
+    ready for glUniformMatrix3fv. Raises np.linalg.LinAlgError if any upper
+    3x3 part is singular.
+    '''
+    M = np.asarray(M)
+    if M.ndim == 2:
+        # Plain float math beats array operations on a single matrix.
+        (a, b, c, _), (d, e, f, _), (g, h, i, _) = M[:3].tolist()
+        C, det = _cofactors3(a, b, c, d, e, f, g, h, i)
+        if det == 0:
+            raise np.linalg.LinAlgError, 'Singular matrix'
+        r = 1.0 / det
+        return np.fromiter([x * r for x in C], np.float32, 9).reshape(3, 3)
+    M = np.asarray(M, dtype=np.float64)
+    if M.size < 64 * 16:
+        # LAPACK is faster for a few matrices.
+        return np.ascontiguousarray(np.swapaxes(
+            np.linalg.inv(M[..., :3, :3]), -1, -2), dtype=np.float32)
+    return np.ascontiguousarray(_inverse3(M[..., :3, :3]), dtype=np.float32)
+
+def rigidinverse(M):
+    '''
+    Inverts rigid transformations (rotations and translations only) given
+    as 4x4 matrix or (N, 4, 4) matrices.
+    '''
+    M = np.asarray(M, dtype=np.float32)
+    I = np.zeros(M.shape, dtype=np.float32)
+    R = np.swapaxes(M[..., :3, :3], -1, -2)
+    I[..., :3, :3] = R
+    I[..., :3, 3] = -np.einsum('...ij,...j->...i', R, M[..., :3, 3])
+    I[..., 3, 3] = 1
+    return I
+
+def affineinverse(M):
+    '''
+    Inverts affine transformations (the last row is 0, 0, 0, 1) given as 4x4
+    matrix or (N, 4, 4) matrices. Raises np.linalg.LinAlgError if any matrix
+    is singular.
+    '''
+    M = np.asarray(M)
+    if M.ndim == 2:
+        (a, b, c, x), (d, e, f, y), (g, h, i, z) = M[:3].tolist()
+        C, det = _cofactors3(a, b, c, d, e, f, g, h, i)
+        if det == 0:
+            raise np.linalg.LinAlgError, 'Singular matrix'
+        r = 1.0 / det
+        # The inverse of the upper 3x3 part is the transposed cofactor matrix.
+        R = [[C[0] * r, C[3] * r, C[6] * r],
+             [C[1] * r, C[4] * r, C[7] * r],
+             [C[2] * r, C[5] * r, C[8] * r]]
+        return np.array([R[0] + [-(R[0][0] * x + R[0][1] * y + R[0][2] * z)],
+                         R[1] + [-(R[1][0] * x + R[1][1] * y + R[1][2] * z)],
+                         R[2] + [-(R[2][0] * x + R[2][1] * y + R[2][2] * z)],
+                         [0.0, 0.0, 0.0, 1.0]], dtype=np.float32)
+    M = np.asarray(M, dtype=np.float64)
+    if M.size < 64 * 16:
+        # LAPACK is faster for a few matrices.
+        return np.linalg.inv(M).astype(np.float32)
+    I = np.zeros(M.shape, dtype=np.float32)
+    R = np.swapaxes(_inverse3(M[..., :3, :3]), -1, -2)
+    I[..., :3, :3] = R
+    I[..., :3, 3] = -np.einsum('...ij,...j->...i', R, M[..., :3, 3])
+    I[..., 3, 3] = 1
+    return I
+
+# Flat indices (a, b, c, d) of the 2x2 determinants a * b - c * d of the upper
+# (s0..s5) and lower (c0..c5) two rows of a 4x4 matrix.
+_MINORS4 = np.array([[0, 0, 0, 1, 1, 2, 8, 8, 8, 9, 9, 10],
+                     [5, 6, 7, 6, 7, 7, 13, 14, 15, 14, 15, 15],
+                     [4, 4, 4, 5, 5, 6, 12, 12, 12, 13, 13, 14],
+                     [1, 2, 3, 2, 3, 3, 9, 10, 11, 10, 11, 11]])
+
+# Every adjugate entry is sign * (m0 * minor0 - m1 * minor1 + m2 * minor2),
+# given by the flat matrix indices, the minor indices and the signs.
+_ADJUGATE4 = np.array([[5, 1, 13, 9, 4, 0, 12, 8, 4, 0, 12, 8, 4, 0, 12, 8],
+                       [6, 2, 14, 10, 6, 2, 14, 10, 5, 1, 13, 9, 5, 1, 13, 9],
+                       [7, 3, 15, 11, 7, 3, 15, 11, 7, 3, 15, 11, 6, 2, 14, 10],
+                       [11, 11, 5, 5, 11, 11, 5, 5, 10, 10, 4, 4, 9, 9, 3, 3],
+                       [10, 10, 4, 4, 8, 8, 2, 2, 8, 8, 2, 2, 7, 7, 1, 1],
+                       [9, 9, 3, 3, 7, 7, 1, 1, 6, 6, 0, 0, 6, 6, 0, 0]])
+_ADJUGATESIGNS4 = np.array([1, -1, 1, -1, -1, 1, -1, 1,
+                            1, -1, 1, -1, -1, 1, -1, 1], dtype=np.float64)
+_DETSIGNS4 = np.array([1, -1, 1, 1, -1, 1], dtype=np.float64)
+
+def inverse(M):
+    '''
+    Inverts general 4x4 matrices (e.g. projections) given as 4x4 matrix or
+    (N, 4, 4) matrices. Raises np.linalg.LinAlgError if any matrix is
+    singular. A single matrix and large batches use the closed form of the
+    adjugate, small batches np.linalg.inv, whichever is faster.
+    '''
+    M = np.asarray(M)
+    if M.ndim == 2:
+        # Plain float math beats array operations on a single matrix.
+        (a, b, c, d), (e, f, g, h), (i, j, k, l), (m, n, o, p) = M.tolist()
+        s0 = a * f - e * b
+        s1 = a * g - e * c
+        s2 = a * h - e * d
+        s3 = b * g - f * c
+        s4 = b * h - f * d
+        s5 = c * h - g * d
+        c5 = k * p - o * l
+        c4 = j * p - n * l
+        c3 = j * o - n * k
+        c2 = i * p - m * l
+        c1 = i * o - m * k
+        c0 = i * n - m * j
+        det = s0 * c5 - s1 * c4 + s2 * c3 + s3 * c2 - s4 * c1 + s5 * c0
+        if det == 0:
+            raise np.linalg.LinAlgError, 'Singular matrix'
+        # Scaling the minors by 1 / det divides every entry by det.
+        r = 1.0 / det
+        s0, s1, s2, s3, s4, s5 = s0 * r, s1 * r, s2 * r, s3 * r, s4 * r, s5 * r
+        c0, c1, c2, c3, c4, c5 = c0 * r, c1 * r, c2 * r, c3 * r, c4 * r, c5 * r
+        return np.fromiter((
+            f * c5 - g * c4 + h * c3, -b * c5 + c * c4 - d * c3,
+            n * s5 - o * s4 + p * s3, -j * s5 + k * s4 - l * s3,
+            -e * c5 + g * c2 - h * c1, a * c5 - c * c2 + d * c1,
+            -m * s5 + o * s2 - p * s1, i * s5 - k * s2 + l * s1,
+            e * c4 - f * c2 + h * c0, -a * c4 + b * c2 - d * c0,
+            m * s4 - n * s2 + p * s0, -i * s4 + j * s2 - l * s0,
+            -e * c3 + f * c1 - g * c0, a * c3 - b * c1 + c * c0,
+            -m * s3 + n * s1 - o * s0, i * s3 - j * s1 + k * s0),
+            np.float32, 16).reshape(4, 4)
+    if M.size < 128 * 16:
+        # LAPACK is faster for a few matrices.
+        return np.linalg.inv(np.asarray(M, dtype=np.float64)).astype(np.float32)
+    # One row per matrix element, so gathers copy whole rows.
+    m = np.asarray(M, dtype=np.float64).reshape(-1, 16).T.copy()
+    minors = m[_MINORS4[0]] * m[_MINORS4[1]]
+    minors -= m[_MINORS4[2]] * m[_MINORS4[3]]
+    det = np.dot(_DETSIGNS4, minors[:6] * minors[:5:-1])
+    if not np.all(det):
+        raise np.linalg.LinAlgError, 'Singular matrix'
+    A = _ADJUGATE4
+    I = m[A[0]] * minors[A[3]]
+    I -= m[A[1]] * minors[A[4]]
+    I += m[A[2]] * minors[A[5]]
+    I *= _ADJUGATESIGNS4[:, np.newaxis]
+    I /= det
+    return np.ascontiguousarray(I.T.reshape(M.shape), dtype=np.float32)
 
-    
\ No newline at end of file
+def transformnormals(M, normals, normalize = True, out = None,
+                     chunksize = 1 << 16):
+    '''
+    Transforms the normals (N, 3) or (N, 4) (e.g. ObjFileParser.vn) with the
+    normal matrix (the inverse transpose of the upper 3x3 part) of M or of one
+    of the matrices (N, 4, 4) each. Returns the (normalized) (N, 3) results.
+    '''
+    M = np.asarray(M, dtype=np.float32)
+    N = np.zeros(M.shape, dtype=np.float32)
+    N[..., :3, :3] = normalmatrix(M)
+    out = transformvectors(N, normals, out, chunksize)
+    if normalize:
+        for start, end in _chunks(len(out), chunksize):
+            norm = np.sqrt(np.sum(out[start:end] ** 2, axis=1))
+            norm[norm == 0] = 1
+            out[start:end] /= norm[:, np.newaxis]
+    return out
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+# 
+#  Meshcache - a persistent cache for parsed wavefront obj-files.
+#  Authors:
+#   - Richard Petri <dasricht at gmail.com>
+#
+#  This is free and unencumbered software released into the public domain.
+#  
+#  Anyone is free to copy, modify, publish, use, compile, sell, or
+#  distribute this software, either in source code form or as a compiled
+#  binary, for any purpose, commercial or non-commercial, and by any
+#  means.
+#  
+#  In jurisdictions that recognize copyright laws, the author or authors
+#  of this software dedicate any and all copyright interest in the
+#  software to the public domain. We make this dedication for the benefit
+#  of the public at large and to the detriment of our heirs and
+#  successors. We intend this dedication to be an overt act of
+#  relinquishment in perpetuity of all present and future rights to this
+#  software under copyright law.
+#  
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#   
+#  For more information, please refer to <http://unlicense.org/>
+#
+##############################################################################
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from wavefront import ObjFileParser
+
+# Increase when the layout of the cache entries changes.
+MESHCACHE_VERSION = 3
+
+MESHCACHE_ARRAYS = ['v', 'vn', 'vt', 'f']
+
+class MeshCache(object):
+    '''
+    A persistent on-disk cache for parsed obj-files.
+    
+    Every file gets a directory in the cache, which holds one entry for the
+    current mtime, size and parser options. An entry stores the v/vn/vt/f
+    arrays and any generated indexed buffers as .npy files. Warm loads map
+    them read-only via np.memmap, so no data is copied or parsed.
+    The cache size is bounded by maxsize bytes, least recently used entries
+    are evicted first.
+    '''
+    def __init__(self, directory, maxsize = 1 << 30):
+        self.directory = directory
+        self.maxsize = maxsize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def _filedir(self, filename):
+        path = os.path.realpath(filename)
+        return os.path.join(self.directory, hashlib.sha1(path).hexdigest())
+    
+    def _entrydir(self, filename, padnormals, padtexcoords):
+        stat = os.stat(filename)
+        key = '%i:%r:%i:%i:%i' % (MESHCACHE_VERSION, stat.st_mtime,
+            stat.st_size, padnormals, padtexcoords)
+        return os.path.join(self._filedir(filename),
+            hashlib.sha1(key).hexdigest())
+    
+    def _touch(self, entry):
+        # The mtime of the entry directory tracks the last use.
+        os.utime(entry, None)
+    
+    def _store(self, entry, arrays, meta = None):
+        '''Writes the arrays (and meta data) atomically into the entry.'''
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), array)
+            if meta is not None:
+                with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                    json.dump(meta, f)
+            if not os.path.isdir(entry):
+                self._dropstale(parent, meta)
+                try:
+                    os.rename(tmp, entry)
+                except OSError:
+                    # Another process was faster.
+                    if not os.path.isdir(entry):
+                        raise
+            else:
+                for name in os.listdir(tmp):
+                    os.rename(os.path.join(tmp, name),
+                              os.path.join(entry, name))
+        finally:
+            shutil.rmtree(tmp, True)
+        self._touch(entry)
+        self._evict()
+    
+    def _dropstale(self, filedir, meta):
+        '''Removes the entries of older versions of a file.'''
+        for entry in os.listdir(filedir):
+            metafile = os.path.join(filedir, entry, 'meta.json')
+            if not os.path.exists(metafile):
+                continue
+            with open(metafile, 'r') as f:
+                old = json.load(f)
+            if (old['mtime'], old['size']) != (meta['mtime'], meta['size']):
+                shutil.rmtree(os.path.join(filedir, entry), True)
+    
+    def _load(self, entry, name):
+        return np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+    
+    def load(self, filename, padnormals = 4, padtexcoords = 4):
+        '''
+        Returns an ObjFileParser for the file. On a cache hit, its arrays are
+        memory mapped from the cache, otherwise the file is parsed (in bulk
+        mode) and stored.
+        '''
+        entry = self._entrydir(filename, padnormals, padtexcoords)
+        metafile = os.path.join(entry, 'meta.json')
+        if os.path.exists(metafile):
+            with open(metafile, 'r') as f:
+                meta = json.load(f)
+            arrays = [self._load(entry, name) for name in MESHCACHE_ARRAYS]
+            self._touch(entry)
+            return ObjFileParser.fromarrays(*arrays,
+                faceformat=meta['faceformat'], padnormals=padnormals,
+                padtexcoords=padtexcoords,
+                minpos=np.array(meta['minpos'], dtype=np.float32),
+                maxpos=np.array(meta['maxpos'], dtype=np.float32),
+                materialranges=meta['materialranges'], mtllibs=meta['mtllibs'],
+                o=meta['o'], g=meta['g'])
+        
+        stat = os.stat(filename)
+        parser = ObjFileParser(filename, padnormals, padtexcoords, bulk=True)
+        meta = {
+            'source' : os.path.realpath(filename),
+            'mtime' : stat.st_mtime,
+            'size' : stat.st_size,
+            'faceformat' : parser.faceformat,
+            'minpos' : parser.minpos.tolist(),
+            'maxpos' : parser.maxpos.tolist(),
+            'materialranges' : parser.materialranges,
+            'mtllibs' : [os.path.abspath(name) for name in parser.mtllibs],
+            'o' : parser.o,
+            'g' : parser.g,
+        }
+        self._store(entry, dict((name, getattr(parser, name))
+            for name in MESHCACHE_ARRAYS), meta)
+        return parser
+    
+    def indexedbuffer(self, filename, layout = [0,1], itype = None,
+                      padnormals = 4, padtexcoords = 4, formats = None):
+        '''
+        Returns the (cached) VBO and IBO as generated by
+        ObjFileParser.generateIndexedBuffer.
+        '''
+        entry = self._entrydir(filename, padnormals, padtexcoords)
+        name = 'buffer-%s-%s' % ('_'.join(str(attr) for attr in layout),
+            'auto' if itype is None else np.dtype(itype).name)
+        if formats is not None:
+            name += '-' + '_'.join(formats)
+        if os.path.exists(os.path.join(entry, name + '-ibo.npy')):
+            vertexbuffer = self._load(entry, name + '-vbo')
+            indexbuffer = self._load(entry, name + '-ibo')
+            self._touch(entry)
+            return vertexbuffer, indexbuffer
+        
+        parser = self.load(filename, padnormals, padtexcoords)
+        vertexbuffer, indexbuffer = parser.generateIndexedBuffer(layout, itype,
+                                                                 formats=formats)
+        self._store(entry, {name + '-vbo' : vertexbuffer,
+                            name + '-ibo' : indexbuffer})
+        return vertexbuffer, indexbuffer
+    
+    def invalidate(self, filename = None):
+        '''
+        Removes all entries of the file from the cache, or all entries if no
+        file is given.
+        '''
+        if filename is None:
+            for name in os.listdir(self.directory):
+                shutil.rmtree(os.path.join(self.directory, name), True)
+        else:
+            shutil.rmtree(self._filedir(filename), True)
+    
+    def _entries(self):
+        '''Yields (last use, size, path) of all entries.'''
+        for filedir in os.listdir(self.directory):
+            filedir = os.path.join(self.directory, filedir)
+            if not os.path.isdir(filedir):
+                continue
+            for entry in os.listdir(filedir):
+                entry = os.path.join(filedir, entry)
+                size = sum(os.path.getsize(os.path.join(entry, name))
+                           for name in os.listdir(entry))
+                yield os.path.getmtime(entry), size, entry
+    
+    def size(self):
+        '''Returns the size of the cache in bytes.'''
+        return sum(size for _, size, _ in self._entries())
+    
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        # Never evict the most recently used entry.
+        for _, size, entry in entries[:-1]:
+            if total <= self.maxsize:
+                break
+            shutil.rmtree(entry, True)
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(entry))
+            except OSError:
+                pass
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+# 
+#  Mesh Optimization - vertex cache and overdraw friendly reordering.
+#  Authors:
+#   - Richard Petri <dasricht at gmail.com>
+#
+#  This is free and unencumbered software released into the public domain.
+#  
+#  Anyone is free to copy, modify, publish, use, compile, sell, or
+#  distribute this software, either in source code form or as a compiled
+#  binary, for any purpose, commercial or non-commercial, and by any
+#  means.
+#  
+#  In jurisdictions that recognize copyright laws, the author or authors
+#  of this software dedicate any and all copyright interest in the
+#  software to the public domain. We make this dedication for the benefit
+#  of the public at large and to the detriment of our heirs and
+#  successors. We intend this dedication to be an overt act of
+#  relinquishment in perpetuity of all present and future rights to this
+#  software under copyright law.
+#  
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#   
+#  For more information, please refer to <http://unlicense.org/>
+#
+##############################################################################
+import numpy as np
+
+def cachestats(indices, cachesize = 32, nverts = None):
+    '''
+    Simulates a FIFO post-transform vertex cache of the given size for the
+    triangle list indices. Returns the average cache miss ratio (transformed
+    vertices per triangle, 0.5 at best for large meshes) and the average
+    transform to vertex ratio (transformed vertices per referenced vertex,
+    1.0 at best).
+    '''
+    indices = np.asarray(indices).reshape(-1)
+    if len(indices) < 3:
+        return 0.0, 0.0
+    if nverts is None:
+        nverts = int(indices.max()) + 1
+    # A vertex is in the cache iff it missed within the last cachesize misses.
+    lastmiss = [-cachesize - 1] * nverts
+    misses = 0
+    for i in indices.tolist():
+        if misses - lastmiss[i] > cachesize:
+            lastmiss[i] = misses
+            misses += 1
+    referenced = np.count_nonzero(np.bincount(indices, minlength=nverts))
+    return (float(misses) / (len(indices) // 3),
+            float(misses) / referenced)
+
+def _adjacency(tris, nverts):
+    # Triangles using each vertex (CSR).
+    corners = tris.reshape(-1)
+    adjacent = np.argsort(corners, kind='mergesort') // 3
+    offsets = np.zeros(nverts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(corners, minlength=nverts), out=offsets[1:])
+    return adjacent.tolist(), offsets.tolist()
+
+def tipsify(indices, cachesize = 16, nverts = None):
+    '''
+    Reorders the triangle list indices for the post-transform vertex cache
+    with the Tipsify algorithm (Sander et al., Fast Triangle Reordering for
+    Vertex Locality and Reduced Overdraw). Returns the reordered (N, 3)
+    triangles and the triangle numbers, where the cache was flushed. These
+    split the triangles into clusters, that can be reordered freely.
+    '''
+    tris = np.asarray(indices).reshape(-1, 3)
+    if nverts is None:
+        nverts = int(tris.max()) + 1 if len(tris) else 0
+    adjacent, offsets = _adjacency(tris, nverts)
+    corners = tris.tolist()
+    live = [offsets[i + 1] - offsets[i] for i in range(nverts)]
+    cachetime = [0] * nverts
+    emitted = [False] * len(corners)
+    deadend = []
+    output = []
+    clusters = [0]
+    time = cachesize + 1
+    cursor = 0
+    fan = 0 if len(corners) else -1
+    while fan >= 0:
+        candidates = []
+        for t in adjacent[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            for v in corners[t]:
+                deadend.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cachetime[v] > cachesize:
+                    cachetime[v] = time
+                    time += 1
+            emitted[t] = True
+            output.append(t)
+        # The next fanning vertex is the oldest candidate, that still stays
+        # in the cache while its remaining triangles are emitted.
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                age = time - cachetime[v]
+                priority = age if age + 2 * live[v] <= cachesize else 0
+                if priority > best:
+                    best = priority
+                    fan = v
+        if fan < 0:
+            while deadend and fan < 0:
+                v = deadend.pop()
+                if live[v] > 0:
+                    fan = v
+            while fan < 0 and cursor < nverts:
+                if live[cursor] > 0:
+                    fan = cursor
+                cursor += 1
+            if fan >= 0:
+                clusters.append(len(output))
+    order = np.array(output, dtype=np.int64)
+    return tris[order], np.array(clusters, dtype=np.int64)
+
+def overdraworder(v, tris, clusters):
+    '''
+    Sorts the triangle clusters of tipsify front to back in a view
+    independent way: Clusters on the outside of the mesh, facing away from
+    its center, are likely to occlude others and are drawn first. Returns
+    the reordered (N, 3) triangles.
+    '''
+    if len(clusters) < 2:
+        return tris
+    p = np.asarray(v, dtype=np.float64)[:, :3][tris]
+    normals = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+    area = np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    centers = p.mean(axis=1)
+    center = (centers * area).sum(axis=0) / max(area.sum(), 1e-30)
+    # Area weighted cluster centroids and normals.
+    weight = np.add.reduceat(area, clusters)
+    ccenter = np.add.reduceat(centers * area, clusters) / np.maximum(weight, 1e-30)
+    cnormal = np.add.reduceat(normals, clusters)
+    cnormal /= np.maximum(np.linalg.norm(cnormal, axis=1), 1e-30)[:, np.newaxis]
+    measure = ((ccenter - center) * cnormal).sum(axis=1)
+    counts = np.diff(np.append(clusters, len(tris)))
+    order = np.argsort(-measure, kind='mergesort')
+    starts = np.repeat(clusters[order] - (np.cumsum(counts[order]) - counts[order]),
+                       counts[order])
+    return tris[starts + np.arange(len(tris))]
+
+def fetchorder(indices, nverts):
+    '''
+    Orders the vertices by their first use in indices, so vertex fetches
+    are mostly sequential. Unused vertices are moved to the end. Returns the
+    new indices and the vertex order, i.e. new vertex i is old vertex
+    order[i].
+    '''
+    indices = np.asarray(indices)
+    used, first = np.unique(indices.reshape(-1), return_index=True)
+    unused = np.setdiff1d(np.arange(nverts), used)
+    order = np.concatenate([used[np.argsort(first)], unused])
+    remap = np.empty(nverts, dtype=np.int64)
+    remap[order] = np.arange(nverts)
+    return remap[indices].astype(indices.dtype), order
+
+def _segments(obj, ntris):
+    '''
+    Returns the (first, end) triangles of the runs, that lie within one
+    material range and one range of every object and group, so reordering
+    triangles inside them keeps all ranges of the obj valid.
+    '''
+    bounds = set([0, ntris])
+    ranges = [(first, count) for _, first, count in
+              getattr(obj, 'materialranges', None) or []]
+    for keyword in ('o', 'g'):
+        for parts in (getattr(obj, keyword, None) or {}).values():
+            ranges.extend(parts)
+    for first, count in ranges:
+        bounds.update([first // 3, (first + count) // 3])
+    bounds = sorted(bounds)
+    return [(first, end) for first, end in zip(bounds[:-1], bounds[1:])
+            if end > first]
+
+def optimizeobj(obj, cachesize = 16, overdraw = True, statcachesize = 32):
+    '''
+    Reorders the triangles of an ObjFileParser for the vertex cache (and
+    overdraw) within each run of one material, object and group, and then
+    its vertices for fetch locality, in place. The result is used by
+    generateIndexedBuffer as usual.
+    
+    Returns a dict with the ACMR and ATVR (see cachestats) before and after
+    as (before, after) tuples, simulated with a FIFO cache of statcachesize
+    entries.
+    '''
+    nverts = len(obj.v)
+    f = np.asarray(obj.f)
+    dtype = f.dtype
+    f = f.reshape(-1, 3).astype(np.int64)
+    before = cachestats(f, statcachesize, nverts)
+    
+    parts = []
+    for first, end in _segments(obj, len(f)):
+        # Tipsify on the vertices of the run only.
+        used, local = np.unique(f[first:end], return_inverse=True)
+        part, clusters = tipsify(local.reshape(-1, 3), cachesize, len(used))
+        part = used[part]
+        if overdraw:
+            part = overdraworder(obj.v, part, clusters)
+        parts.append(part)
+    f, order = fetchorder(np.concatenate(parts) if parts else f, nverts)
+    
+    for name in ('v', 'vn', 'vt'):
+        a = getattr(obj, name)
+        if len(a) >= nverts and len(a) > 0:
+            a = np.asarray(a, dtype=np.float32)
+            setattr(obj, name, np.concatenate([a[order], a[nverts:]]))
+    obj.f = f.astype(dtype)
+    after = cachestats(f, statcachesize, nverts)
+    return {'acmr' : (before[0], after[0]), 'atvr' : (before[1], after[1])}
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+# 
+#  Quaternion - quaternions and dual quaternions for use with hommat.
+#  Authors:
+#   - Richard Petri <dasricht at gmail.com>
+#
+#  This is free and unencumbered software released into the public domain.
+#  
+#  Anyone is free to copy, modify, publish, use, compile, sell, or
+#  distribute this software, either in source code form or as a compiled
+#  binary, for any purpose, commercial or non-commercial, and by any
+#  means.
+#  
+#  In jurisdictions that recognize copyright laws, the author or authors
+#  of this software dedicate any and all copyright interest in the
+#  software to the public domain. We make this dedication for the benefit
+#  of the public at large and to the detriment of our heirs and
+#  successors. We intend this dedication to be an overt act of
+#  relinquishment in perpetuity of all present and future rights to this
+#  software under copyright law.
+#  
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#   
+#  For more information, please refer to <http://unlicense.org/>
+#
+##############################################################################
+import numpy as np
+import math
+
+# Quaternions are stored as (x, y, z, w) in the last axis of an array, so
+# that all functions work on single quaternions of shape (4,) as well as on
+# arrays of shape (..., 4). Dual quaternions are stored as the real and the
+# dual part in one array of shape (..., 8).
+# Rotations are composed like in hommat: multiply(a, b) rotates by b first
+# and tomatrix(multiply(a, b)) equals np.dot(tomatrix(a), tomatrix(b)).
+
+def _quaternions(q):
+    return np.asarray(q, dtype=np.float64)
+
+def identity(shape = ()):
+    '''Create identity quaternions of the given shape.'''
+    if isinstance(shape, int):
+        shape = (shape,)
+    q = np.zeros(tuple(shape) + (4,))
+    q[..., 3] = 1
+    return q
+
+def fromaxisangle(angles, axes):
+    '''
+    Create quaternions for rotations by angles (in degrees) around axes.
+    angles has the shape (...), axes (..., 3).
+    '''
+    angles = np.asarray(angles, dtype=np.float64) * (math.pi / 360)
+    axes = np.asarray(axes, dtype=np.float64)[..., :3]
+    axes = axes / np.linalg.norm(axes, axis=-1)[..., np.newaxis]
+    shape = np.broadcast(angles[..., np.newaxis], axes).shape[:-1]
+    q = np.empty(shape + (4,))
+    q[..., :3] = axes * np.sin(angles)[..., np.newaxis]
+    q[..., 3] = np.cos(angles)
+    return q
+
+def multiply(a, b):
+    '''Multiplies the quaternions a and b (broadcasting).'''
+    a, b = _quaternions(a), _quaternions(b)
+    ax, ay, az, aw = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bx, by, bz, bw = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    q = np.empty(np.broadcast(a, b).shape)
+    q[..., 0] = aw * bx + ax * bw + ay * bz - az * by
+    q[..., 1] = aw * by - ax * bz + ay * bw + az * bx
+    q[..., 2] = aw * bz + ax * by - ay * bx + az * bw
+    q[..., 3] = aw * bw - ax * bx - ay * by - az * bz
+    return q
+
+def conjugate(q):
+    '''Conjugates the quaternions (the inverse of unit quaternions).'''
+    q = np.array(q, dtype=np.float64)
+    q[..., :3] *= -1
+    return q
+
+def normalize(q):
+    '''Normalizes the quaternions.'''
+    q = _quaternions(q)
+    return q / np.linalg.norm(q, axis=-1)[..., np.newaxis]
+
+def rotate(q, vecs):
+    '''Rotates the vectors (..., 3) by the unit quaternions q.'''
+    q = _quaternions(q)
+    vecs = np.asarray(vecs, dtype=np.float64)[..., :3]
+    # v' = v + 2w (u x v) + 2u x (u x v)
+    u = q[..., :3]
+    t = 2 * np.cross(u, vecs)
+    return vecs + q[..., 3, np.newaxis] * t + np.cross(u, t)
+
+def _shortest(a, b):
+    '''Flips b where needed, so that a and b are on the same hemisphere.'''
+    d = np.sum(a * b, axis=-1)
+    b = np.where((d < 0)[..., np.newaxis], -b, b)
+    return np.abs(d), b
+
+def nlerp(a, b, t):
+    '''
+    Normalized linear interpolation between the quaternions a and b along the
+    shortest path. t is a scalar or an array of shape (...).
+    '''
+    a, b = _quaternions(a), _quaternions(b)
+    t = np.asarray(t, dtype=np.float64)[..., np.newaxis]
+    _, b = _shortest(a, b)
+    return normalize(a + t * (b - a))
+
+def slerp(a, b, t):
+    '''
+    Spherical linear interpolation between the unit quaternions a and b along
+    the shortest path. t is a scalar or an array of shape (...).
+    '''
+    a, b = _quaternions(a), _quaternions(b)
+    t = np.asarray(t, dtype=np.float64)
+    d, b = _shortest(a, b)
+    theta = np.arccos(np.minimum(d, 1.0))
+    sintheta = np.sin(theta)
+    # Nearly identical quaternions are interpolated linearly.
+    linear = sintheta < 1e-6
+    sintheta = np.where(linear, 1.0, sintheta)
+    wa = np.where(linear, 1 - t, np.sin((1 - t) * theta) / sintheta)
+    wb = np.where(linear, t, np.sin(t * theta) / sintheta)
+    return normalize(wa[..., np.newaxis] * a + wb[..., np.newaxis] * b)
+
+def tomatrix(q):
+    '''
+    Converts the unit quaternions (..., 4) to hommat compatible rotation
+    matrices (..., 4, 4) of type float32.
+    '''
+    q = _quaternions(q)
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    M = np.zeros(q.shape[:-1] + (4, 4), dtype=np.float32)
+    M[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    M[..., 0, 1] = 2 * (x * y - z * w)
+    M[..., 0, 2] = 2 * (x * z + y * w)
+    M[..., 1, 0] = 2 * (x * y + z * w)
+    M[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    M[..., 1, 2] = 2 * (y * z - x * w)
+    M[..., 2, 0] = 2 * (x * z - y * w)
+    M[..., 2, 1] = 2 * (y * z + x * w)
+    M[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    M[..., 3, 3] = 1
+    return M
+
+def frommatrix(M):
+    '''Converts the rotation part of the matrices (..., 4, 4) to quaternions.'''
+    M = np.asarray(M, dtype=np.float64)
+    m00, m11, m22 = M[..., 0, 0], M[..., 1, 1], M[..., 2, 2]
+    q = np.empty(M.shape[:-2] + (4,))
+    # Every quaternion is computed from its largest component for stability.
+    trace = m00 + m11 + m22
+    candidates = np.stack([1 + m00 - m11 - m22, 1 - m00 + m11 - m22,
+                           1 - m00 - m11 + m22, 1 + trace], axis=-1)
+    largest = np.argmax(candidates, axis=-1)
+    s = 0.5 / np.sqrt(np.max(candidates, axis=-1))
+    for i, (j, k) in enumerate([(1, 2), (2, 0), (0, 1)]):
+        sel = largest == i
+        q[sel, i] = 0.25 / s[sel]
+        q[sel, j] = (M[sel, j, i] + M[sel, i, j]) * s[sel]
+        q[sel, k] = (M[sel, k, i] + M[sel, i, k]) * s[sel]
+        q[sel, 3] = (M[sel, k, j] - M[sel, j, k]) * s[sel]
+    sel = largest == 3
+    q[sel, 3] = 0.25 / s[sel]
+    q[sel, 0] = (M[sel, 2, 1] - M[sel, 1, 2]) * s[sel]
+    q[sel, 1] = (M[sel, 0, 2] - M[sel, 2, 0]) * s[sel]
+    q[sel, 2] = (M[sel, 1, 0] - M[sel, 0, 1]) * s[sel]
+    return q
+
+def todual(q, trans):
+    '''
+    Creates dual quaternions (..., 8) for the rotations q followed by the
+    translations trans (..., 3), i.e. the transformation
+    hommat.translation(identity, trans) * tomatrix(q).
+    '''
+    q = _quaternions(q)
+    trans = np.asarray(trans, dtype=np.float64)[..., :3]
+    t = np.zeros(trans.shape[:-1] + (4,))
+    t[..., :3] = trans
+    shape = np.broadcast(q, t).shape
+    dq = np.empty(shape[:-1] + (8,))
+    dq[..., :4] = q
+    dq[..., 4:] = 0.5 * multiply(t, q)
+    return dq
+
+def dualmultiply(a, b):
+    '''Multiplies the dual quaternions a and b (broadcasting).'''
+    a, b = _quaternions(a), _quaternions(b)
+    ar, ad = a[..., :4], a[..., 4:]
+    br, bd = b[..., :4], b[..., 4:]
+    real = multiply(ar, br)
+    dq = np.empty(real.shape[:-1] + (8,))
+    dq[..., :4] = real
+    dq[..., 4:] = multiply(ar, bd) + multiply(ad, br)
+    return dq
+
+def dualnormalize(dq):
+    '''Normalizes the dual quaternions.'''
+    dq = _quaternions(dq)
+    return dq / np.linalg.norm(dq[..., :4], axis=-1)[..., np.newaxis]
+
+def dualtranslation(dq):
+    '''Returns the translations (..., 3) of the unit dual quaternions.'''
+    dq = _quaternions(dq)
+    return 2 * multiply(dq[..., 4:], conjugate(dq[..., :4]))[..., :3]
+
+def dualtomatrix(dq):
+    '''
+    Converts the unit dual quaternions (..., 8) to hommat compatible
+    matrices (..., 4, 4) of type float32.
+    '''
+    dq = _quaternions(dq)
+    M = tomatrix(dq[..., :4])
+    M[..., :3, 3] = dualtranslation(dq)
+    return M
+
+def dualblend(dqs, weights):
+    '''
+    Dual quaternion linear blending, e.g. for skinning. dqs has the shape
+    (..., K, 8), weights (..., K). Returns the normalized blends (..., 8).
+    '''
+    dqs = _quaternions(dqs)
+    weights = np.asarray(weights, dtype=np.float64)
+    # Blend all quaternions on the hemisphere of the first one.
+    signs = np.sign(np.sum(dqs[..., :1, :4] * dqs[..., :4], axis=-1))
+    signs[signs == 0] = 1
+    blend = np.sum((weights * signs)[..., np.newaxis] * dqs, axis=-2)
+    return dualnormalize(blend)
@@ -31,85 +31,1095 @@
 #  For more information, please refer to <http://unlicense.org/>
 #
 ##############################################################################
+import os
+import ctypes
+import struct
+import hashlib
+import tempfile
+import numpy as np
+from collections import OrderedDict
 from OpenGL.GL import glCreateProgram, glDeleteProgram, glAttachShader, glLinkProgram, glGetProgramiv, glGetProgramInfoLog, glUseProgram
 from OpenGL.GL import glCreateShader, glDeleteShader, glShaderSource, glCompileShader, glGetShaderInfoLog, glGetShaderiv
-from OpenGL.GL import glGetUniformLocation, glGetAttribLocation
+from OpenGL.GL import glGetUniformLocation, glGetAttribLocation, glGetString, glGetIntegerv
+from OpenGL.GL import glGetProgramBinary, glProgramBinary, glProgramParameteri
 from OpenGL.GL import GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_GEOMETRY_SHADER, GL_COMPILE_STATUS, GL_LINK_STATUS, GL_TRUE
+from OpenGL.GL import GL_VENDOR, GL_RENDERER, GL_VERSION, GL_PROGRAM_BINARY_LENGTH, GL_NUM_PROGRAM_BINARY_FORMATS, GL_PROGRAM_BINARY_RETRIEVABLE_HINT
 from OpenGL.raw.GL.VERSION.GL_3_0 import glBindFragDataLocation
+from OpenGL.GL.KHR.parallel_shader_compile import glInitParallelShaderCompileKHR, glMaxShaderCompilerThreadsKHR, GL_COMPLETION_STATUS_KHR
+from OpenGL.GL.ARB.parallel_shader_compile import glInitParallelShaderCompileARB, glMaxShaderCompilerThreadsARB
+from OpenGL.GL.ARB.uniform_buffer_object import glInitUniformBufferObjectARB
+from OpenGL.extensions import hasGLExtension
+from OpenGL.GL import glGetActiveUniform, glGetActiveAttrib, GL_ACTIVE_UNIFORMS, GL_ACTIVE_ATTRIBUTES
+from OpenGL.GL import glGetActiveUniformBlockName, glGetActiveUniformBlockiv, glGetActiveUniformsiv, glUniformBlockBinding
+from OpenGL.GL import GL_ACTIVE_UNIFORM_BLOCKS, GL_UNIFORM_BLOCK_NAME_LENGTH, GL_UNIFORM_BLOCK_ACTIVE_UNIFORMS, GL_UNIFORM_BLOCK_ACTIVE_UNIFORM_INDICES, GL_UNIFORM_OFFSET, GL_UNIFORM_IS_ROW_MAJOR
+from OpenGL.GL import glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferData, glBufferSubData, glBufferStorage, glMapBufferRange, glUnmapBuffer, glBindBufferRange
+from OpenGL.GL import GL_UNIFORM_BUFFER, GL_STREAM_DRAW, GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT, GL_MAP_WRITE_BIT, GL_MAP_PERSISTENT_BIT, GL_MAP_COHERENT_BIT
+from OpenGL.GL import glFenceSync, glClientWaitSync, glDeleteSync, GL_SYNC_GPU_COMMANDS_COMPLETE, GL_SYNC_FLUSH_COMMANDS_BIT, GL_WAIT_FAILED, GL_TIMEOUT_EXPIRED
+import OpenGL.GL as _gl
+import OpenGL.raw.GL.VERSION.GL_2_0 as _gl20
+import OpenGL.raw.GL.VERSION.GL_2_1 as _gl21
+import OpenGL.raw.GL.VERSION.GL_3_0 as _gl30
+
+def _uniformtypes():
+    '''
+    Maps the uniform types to (dtype, shape, setter). Matrices are stored row
+    major (as in hommat), so their shape is (rows, columns).
+    '''
+    types = {}
+    for prefix, dtype, suffix, module in [('FLOAT', np.float32, 'f', _gl20),
+                                          ('INT', np.int32, 'i', _gl20),
+                                          ('BOOL', np.int32, 'i', _gl20),
+                                          ('UNSIGNED_INT', np.uint32, 'ui', _gl30)]:
+        setter = getattr(module, 'glUniform1%sv' % suffix)
+        types[getattr(_gl, 'GL_' + prefix)] = (dtype, (), setter)
+        for n in (2, 3, 4):
+            setter = getattr(module, 'glUniform%i%sv' % (n, suffix))
+            types[getattr(_gl, 'GL_%s_VEC%i' % (prefix, n))] = (dtype, (n,), setter)
+    for columns in (2, 3, 4):
+        for rows in (2, 3, 4):
+            if rows == columns:
+                name, module = '%i' % rows, _gl20
+            else:
+                name, module = '%ix%i' % (columns, rows), _gl21
+            types[getattr(_gl, 'GL_FLOAT_MAT' + name)] = (np.float32,
+                (rows, columns), getattr(module, 'glUniformMatrix%sfv' % name))
+    # Samplers are set to texture units.
+    for prefix in ('', 'INT_', 'UNSIGNED_INT_'):
+        for kind in ('1D', '2D', '3D', 'CUBE', '1D_ARRAY', '2D_ARRAY', 'BUFFER',
+                     '2D_RECT', '2D_MULTISAMPLE', '2D_MULTISAMPLE_ARRAY'):
+            types[getattr(_gl, 'GL_%sSAMPLER_%s' % (prefix, kind))] = (np.int32,
+                (), _gl20.glUniform1iv)
+    for kind in ('1D', '2D', 'CUBE', '1D_ARRAY', '2D_ARRAY', '2D_RECT'):
+        types[getattr(_gl, 'GL_SAMPLER_%s_SHADOW' % kind)] = (np.int32, (),
+            _gl20.glUniform1iv)
+    return types
+
+_UNIFORM_TYPES = _uniformtypes()
+
+class GL(object):
+    '''
+    The OpenGL calls used by Shader and ProgramCache. Shader takes any object
+    with the same methods, so shaders and the program cache can be exercised
+    without an OpenGL context.
+    '''
+    def __init__(self):
+        self._binaries = None
+        self._parallel = None
+        self._uniformblocks = None
+    
+    def createshader(self, shadertype):
+        return glCreateShader(shadertype)
+    
+    def deleteshader(self, shader):
+        glDeleteShader(shader)
+    
+    def compileshader(self, shader, source):
+        glShaderSource(shader, source)
+        glCompileShader(shader)
+    
+    def compilestatus(self, shader):
+        return glGetShaderiv(shader, GL_COMPILE_STATUS) == GL_TRUE
+    
+    def shaderinfolog(self, shader):
+        return glGetShaderInfoLog(shader)
+    
+    def createprogram(self):
+        return glCreateProgram()
+    
+    def deleteprogram(self, program):
+        glDeleteProgram(program)
+    
+    def attachshader(self, program, shader):
+        glAttachShader(program, shader)
+    
+    def linkprogram(self, program):
+        glLinkProgram(program)
+    
+    def linkstatus(self, program):
+        return glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+    
+    def programinfolog(self, program):
+        return glGetProgramInfoLog(program)
+    
+    def useprogram(self, program):
+        glUseProgram(program)
+    
+    def bindfragdatalocation(self, program, colornumber, name):
+        glBindFragDataLocation(program, colornumber, name)
+    
+    def uniformlocation(self, program, name):
+        return glGetUniformLocation(program, name)
+    
+    def attriblocation(self, program, name):
+        return glGetAttribLocation(program, name)
+    
+    def activeuniforms(self, program):
+        '''Returns the (name, size, type) of all active uniforms.'''
+        count = glGetProgramiv(program, GL_ACTIVE_UNIFORMS)
+        return [glGetActiveUniform(program, i) for i in range(count)]
+    
+    def activeattributes(self, program):
+        '''Returns the (name, size, type) of all active attributes.'''
+        count = glGetProgramiv(program, GL_ACTIVE_ATTRIBUTES)
+        return [glGetActiveAttrib(program, i) for i in range(count)]
+    
+    def _blockiv(self, program, index, pname, count = 1):
+        params = np.zeros(count, dtype=np.int32)
+        glGetActiveUniformBlockiv(program, index, pname, params)
+        return params
+    
+    def _uniformsiv(self, program, indices, pname):
+        params = np.zeros(len(indices), dtype=np.int32)
+        glGetActiveUniformsiv(program, len(indices), indices, pname, params)
+        return params
+    
+    def hasuniformblocks(self):
+        '''True for GL 3.1 or ARB_uniform_buffer_object contexts.'''
+        if self._uniformblocks is None:
+            self._uniformblocks = bool(hasGLExtension('GL_VERSION_GL_3_1')
+                                       or glInitUniformBufferObjectARB())
+        return self._uniformblocks
+    
+    def activeuniformblocks(self, program):
+        '''
+        Returns the (name, index, members) of all active uniform blocks, the
+        members as (name, size, type, offset, rowmajor).
+        '''
+        blocks = []
+        for index in range(glGetProgramiv(program, GL_ACTIVE_UNIFORM_BLOCKS)):
+            length = int(self._blockiv(program, index, GL_UNIFORM_BLOCK_NAME_LENGTH)[0])
+            name = ctypes.create_string_buffer(length + 1)
+            glGetActiveUniformBlockName(program, index, length + 1,
+                                        np.zeros(1, dtype=np.int32), name)
+            count = int(self._blockiv(program, index, GL_UNIFORM_BLOCK_ACTIVE_UNIFORMS)[0])
+            indices = self._blockiv(program, index,
+                GL_UNIFORM_BLOCK_ACTIVE_UNIFORM_INDICES, count).astype(np.uint32)
+            offsets = self._uniformsiv(program, indices, GL_UNIFORM_OFFSET)
+            rowmajor = self._uniformsiv(program, indices, GL_UNIFORM_IS_ROW_MAJOR)
+            members = []
+            for i, uniform in enumerate(indices):
+                membername, size, gltype = glGetActiveUniform(program, int(uniform))
+                members.append((membername, size, gltype, int(offsets[i]),
+                                bool(rowmajor[i])))
+            blocks.append((name.value, index, members))
+        return blocks
+    
+    def uniformblockbinding(self, program, index, binding):
+        glUniformBlockBinding(program, index, binding)
+    
+    def uniformbufferalignment(self):
+        return int(glGetIntegerv(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT))
+    
+    def createuniformbuffer(self, size):
+        '''
+        Creates a uniform buffer, persistently and coherently mapped if the
+        driver has glBufferStorage. Returns (buffer, address), the address is
+        None if the buffer is not mapped.
+        '''
+        buffer = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, buffer)
+        if bool(glBufferStorage):
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            glBufferStorage(GL_UNIFORM_BUFFER, size, None, flags)
+            address = glMapBufferRange(GL_UNIFORM_BUFFER, 0, size, flags)
+            address = getattr(address, 'value', address)
+        else:
+            glBufferData(GL_UNIFORM_BUFFER, size, None, GL_STREAM_DRAW)
+            address = None
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        return buffer, address
+    
+    def deleteuniformbuffer(self, buffer, mapped):
+        if mapped:
+            glBindBuffer(GL_UNIFORM_BUFFER, buffer)
+            glUnmapBuffer(GL_UNIFORM_BUFFER)
+            glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        glDeleteBuffers(1, [buffer])
+    
+    def uniformbuffersubdata(self, buffer, offset, data):
+        glBindBuffer(GL_UNIFORM_BUFFER, buffer)
+        glBufferSubData(GL_UNIFORM_BUFFER, offset, data.nbytes, data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    
+    def binduniformrange(self, binding, buffer, offset, size):
+        glBindBufferRange(GL_UNIFORM_BUFFER, binding, buffer, offset, size)
+    
+    def fencesync(self):
+        return glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+    
+    def waitsync(self, fence):
+        '''Blocks until the GPU has passed the fence, then deletes it.'''
+        try:
+            # Flush once, then wait in steps of 100ms.
+            flags = GL_SYNC_FLUSH_COMMANDS_BIT
+            while True:
+                result = glClientWaitSync(fence, flags, 100000000)
+                if result == GL_WAIT_FAILED:
+                    raise Exception, "Waiting for a fence failed."
+                if result != GL_TIMEOUT_EXPIRED:
+                    return
+                flags = 0
+        finally:
+            glDeleteSync(fence)
+    
+    def uniformsetter(self, gltype):
+        '''
+        Returns the raw glUniform*v function for the type, called with
+        (location, count, pointer) or (location, count, transpose, pointer).
+        '''
+        return _UNIFORM_TYPES[gltype][2]
+    
+    def driverinfo(self):
+        '''Returns a string identifying the driver, binaries depend on it.'''
+        return '\n'.join(str(glGetString(name))
+                         for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+    
+    def hasprogrambinary(self):
+        '''True if the driver supports at least one program binary format.'''
+        if self._binaries is None:
+            self._binaries = (bool(glGetProgramBinary) and bool(glProgramBinary)
+                and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0)
+        return self._binaries
+    
+    def retrievablehint(self, program):
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    
+    def getprogrambinary(self, program):
+        '''Returns the (format, data) of a linked program.'''
+        size = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        length = np.zeros(1, dtype=np.int32)
+        binaryformat = np.zeros(1, dtype=np.uint32)
+        data = np.zeros(size, dtype=np.uint8)
+        glGetProgramBinary(program, size, length, binaryformat, data)
+        return int(binaryformat[0]), data[:length[0]].tostring()
+    
+    def programbinary(self, program, binaryformat, data):
+        data = np.fromstring(data, dtype=np.uint8)
+        glProgramBinary(program, binaryformat, data, len(data))
+    
+    def parallelcompile(self, threads = 0xFFFFFFFF):
+        '''
+        Enables KHR_parallel_shader_compile (or the ARB variant) with the
+        given number of compiler threads. Returns False if not supported.
+        '''
+        if self._parallel is None:
+            if glInitParallelShaderCompileKHR():
+                self._parallel = glMaxShaderCompilerThreadsKHR
+            elif glInitParallelShaderCompileARB():
+                self._parallel = glMaxShaderCompilerThreadsARB
+            else:
+                self._parallel = False
+        if self._parallel:
+            self._parallel(threads)
+        return bool(self._parallel)
+    
+    def shadercompleted(self, shader):
+        '''True if querying the compile status of the shader won't block.'''
+        return glGetShaderiv(shader, GL_COMPLETION_STATUS_KHR) == GL_TRUE
+    
+    def programcompleted(self, program):
+        '''True if querying the link status of the program won't block.'''
+        return glGetProgramiv(program, GL_COMPLETION_STATUS_KHR) == GL_TRUE
+
+defaultgl = GL()
+
+class ProgramCache(object):
+    '''
+    A persistent on-disk cache for linked program binaries. Entries are keyed
+    on a hash of all stage sources and the driver strings, so binaries of
+    another driver (version) are never loaded. The cache size is bounded by
+    maxsize bytes, least recently used entries are evicted first.
+    '''
+    def __init__(self, directory, maxsize = 64 << 20):
+        self.directory = directory
+        self.maxsize = maxsize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def key(self, stages, gl):
+        '''Returns the key for the (shadertype, source) stages of a program.'''
+        h = hashlib.sha1(gl.driverinfo())
+        for shadertype, source in stages:
+            h.update('\0%i\0%i\0' % (shadertype, len(source)))
+            h.update(source)
+        return h.hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+    
+    def load(self, key):
+        '''Returns the (format, data) of the entry, or None on a miss.'''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The mtime of the entry tracks the last use.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        if len(data) < 4:
+            self.drop(key)
+            return None
+        return struct.unpack('<I', data[:4])[0], data[4:]
+    
+    def store(self, key, binaryformat, data):
+        '''Writes the program binary atomically into the cache.'''
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('<I', binaryformat))
+                f.write(data)
+            os.rename(tmp, self._path(key))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._evict()
+    
+    def drop(self, key):
+        '''Removes an entry, e.g. a binary rejected by the driver.'''
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+    
+    def invalidate(self):
+        '''Removes all entries from the cache.'''
+        for _, _, path in list(self._entries()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def _entries(self):
+        '''Yields (last use, size, path) of all entries.'''
+        for name in os.listdir(self.directory):
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                yield os.path.getmtime(path), os.path.getsize(path), path
+            except OSError:
+                pass
+    
+    def size(self):
+        '''Returns the size of the cache in bytes.'''
+        return sum(size for _, size, _ in self._entries())
+    
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        # Never evict the most recently used entry.
+        for _, size, path in entries[:-1]:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class Uniform(object):
+    '''
+    A reflected uniform of a Shader with a typed setter. Values are converted
+    to its dtype, matrices are row major like those of hommat and transposed
+    on upload. As with glUniform, the program has to be in use.
+    '''
+    def __init__(self, name, location, size, gltype, gl):
+        self.name = name
+        self.location = location
+        self.size = size
+        self.type = gltype
+        if gltype in _UNIFORM_TYPES:
+            self.dtype, self.shape, _ = _UNIFORM_TYPES[gltype]
+            self.setter = gl.uniformsetter(gltype)
+        else:
+            self.dtype, self.shape, self.setter = None, (), None
+        self.matrix = len(self.shape) == 2
+        self.components = int(np.prod(self.shape))
+    
+    def args(self, count, pointer):
+        '''Returns the arguments of the setter for count elements at pointer.'''
+        if self.matrix:
+            return (self.location, count, GL_TRUE, pointer)
+        return (self.location, count, pointer)
+    
+    def set(self, value):
+        if self.setter is None:
+            raise Exception, "Unsupported type 0x%x of uniform %s." % (self.type, self.name)
+        value = np.ascontiguousarray(value, dtype=self.dtype)
+        count = min(value.size // self.components, self.size)
+        self.setter(*self.args(count, value))
+
+class UniformBatch(object):
+    '''
+    Values of several uniforms in one contiguous buffer, uploaded by apply()
+    with precomputed setter arguments. batch[name] is a view into the buffer
+    of the uniform's shape (with a leading axis for arrays), so values can be
+    written in place, e.g. hommat.perspective(..., out=batch['projection']).
+    '''
+    def __init__(self, uniforms):
+        for uniform in uniforms:
+            if uniform.setter is None:
+                raise Exception, "Unsupported type 0x%x of uniform %s." % (uniform.type, uniform.name)
+        sizes = [uniform.size * uniform.components * 4 for uniform in uniforms]
+        self.buffer = np.zeros(sum(sizes), dtype=np.uint8)
+        self.values = {}
+        self.calls = []
+        offset = 0
+        for uniform, size in zip(uniforms, sizes):
+            shape = uniform.shape
+            if uniform.size > 1:
+                shape = (uniform.size,) + shape
+            view = self.buffer[offset:offset + size].view(uniform.dtype)
+            self.values[uniform.name] = view.reshape(shape)
+            if uniform.name.endswith('[0]'):
+                self.values[uniform.name[:-3]] = self.values[uniform.name]
+            pointer = ctypes.c_void_p(view.ctypes.data)
+            self.calls.append((uniform.setter, uniform.args(uniform.size, pointer)))
+            offset += size
+    
+    def __getitem__(self, name):
+        return self.values[name]
+    
+    def __setitem__(self, name, value):
+        self.values[name][...] = value
+    
+    def apply(self):
+        '''Uploads all values into the program in use.'''
+        for setter, args in self.calls:
+            setter(*args)
+
+def _roundup(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+def std140layout(members):
+    '''
+    Lays out the (name, size, type, rowmajor) members of a uniform block by
+    the std140 rules. Returns the (offset, dtype, shape) of every member and
+    the size of the block. Every element of an array and every column (or
+    row) of a matrix is padded to a vec4.
+    '''
+    offset = 0
+    layout = []
+    for name, size, gltype, rowmajor in members:
+        if gltype not in _UNIFORM_TYPES:
+            raise Exception, "Unsupported type 0x%x of uniform %s." % (gltype, name)
+        dtype, shape, _ = _UNIFORM_TYPES[gltype]
+        if len(shape) == 2:
+            vectors = shape[0] if rowmajor else shape[1]
+            shape, alignment, nbytes = (vectors, 4), 16, vectors * 16
+        elif size > 1:
+            shape, alignment, nbytes = (4,), 16, 16
+        else:
+            components = shape[0] if shape else 1
+            alignment = 16 if components == 3 else 4 * components
+            nbytes = 4 * components
+        if size > 1:
+            shape, alignment, nbytes = (size,) + shape, 16, size * nbytes
+        offset = _roundup(offset, alignment)
+        layout.append((offset, dtype, shape))
+        offset += nbytes
+    return layout, _roundup(offset, 16)
+
+class UniformBlockLayout(object):
+    '''
+    The std140 layout of a reflected uniform block (see Shader.blocklayout).
+    dtype is a structured dtype of one block, with a field per member (names
+    without the [0] of arrays). The fields hold the padded std140 data, use
+    assign() to write values, e.g. hommat matrices, into them.
+    '''
+    def __init__(self, name, index, members):
+        self.name = name
+        self.index = index
+        members = sorted(members, key=lambda member: member[3])
+        layout, self.size = std140layout([(member[0], member[1], member[2],
+            member[4]) for member in members])
+        self.names, self.formats, self.offsets = [], [], []
+        self.assignments = {}
+        for (member, size, gltype, offset, rowmajor), (std140, dtype, shape) in zip(members, layout):
+            if offset is not None and offset != std140:
+                raise Exception, "Uniform block %s is not laid out by std140 (%s)." % (name, member)
+            if member.endswith('[0]'):
+                member = member[:-3]
+            self.names.append(member)
+            self.formats.append(np.dtype((dtype, shape)) if shape else np.dtype(dtype))
+            self.offsets.append(std140)
+            glshape = _UNIFORM_TYPES[gltype][1]
+            if len(glshape) == 2:
+                components = glshape[1] if rowmajor else glshape[0]
+                part = (Ellipsis, slice(0, components))
+            elif size > 1:
+                part = (Ellipsis, slice(0, glshape[0]) if glshape else 0)
+            else:
+                part = (Ellipsis,)
+            self.assignments[member] = (part, len(glshape) == 2 and not rowmajor)
+        self.dtype = self.arraydtype(self.size)
+    
+    def arraydtype(self, stride):
+        '''Returns the dtype of the block padded to stride bytes.'''
+        return np.dtype({'names' : self.names, 'formats' : self.formats,
+                         'offsets' : self.offsets, 'itemsize' : stride})
+    
+    def array(self, count, stride = None):
+        '''Returns a zeroed structured array of count blocks.'''
+        return np.zeros(count, dtype=self.arraydtype(stride or self.size))
+    
+    def assign(self, array, name, values):
+        '''
+        Writes the values of the member into the structured array. Matrices
+        are row major as in hommat and transposed for column major members.
+        '''
+        part, transposed = self.assignments[name]
+        values = np.asarray(values)
+        if transposed:
+            values = np.swapaxes(values, -1, -2)
+        array[name][part] = values
+
+class UniformRing(object):
+    '''
+    Per object uniform blocks for many draws. data holds count blocks of the
+    layout, each padded to the uniform buffer offset alignment. Every frame
+    fill data (e.g. with assign()), upload() it into the next of frames slots
+    of one uniform buffer, bind(i) the block of object i before its draw and
+    fence() after the last draw of the frame. The buffer is persistently
+    mapped where supported, so the upload is one memcpy; a slot is only
+    written after the fence of its previous frame has passed.
+    '''
+    def __init__(self, layout, count, binding, frames = 3, gl = None):
+        self.gl = gl if gl is not None else defaultgl
+        self.layout = layout
+        self.binding = binding
+        self.stride = _roundup(layout.size, self.gl.uniformbufferalignment())
+        self.data = layout.array(count, self.stride)
+        self.framesize = count * self.stride
+        self.buffer, address = self.gl.createuniformbuffer(frames * self.framesize)
+        self.mapped = None
+        if address is not None:
+            memory = (ctypes.c_ubyte * (frames * self.framesize)).from_address(address)
+            self.mapped = np.frombuffer(memory, dtype=np.uint8)
+        self.fences = [None] * frames
+        self.frame = 0
+        self.base = 0
+    
+    def assign(self, name, values):
+        self.layout.assign(self.data, name, values)
+    
+    def upload(self):
+        '''Copies data into the next slot, waiting for the GPU to release it.'''
+        fence = self.fences[self.frame]
+        if fence is not None:
+            self.fences[self.frame] = None
+            self.gl.waitsync(fence)
+        self.base = self.frame * self.framesize
+        if self.mapped is not None:
+            self.mapped[self.base:self.base + self.framesize] = self.data.view(np.uint8)
+        else:
+            self.gl.uniformbuffersubdata(self.buffer, self.base, self.data)
+    
+    def bind(self, i):
+        '''Binds the block of object i of the uploaded slot.'''
+        self.gl.binduniformrange(self.binding, self.buffer,
+                                 self.base + i * self.stride, self.layout.size)
+    
+    def fence(self):
+        '''Marks the end of the draws using the current slot.'''
+        self.fences[self.frame] = self.gl.fencesync()
+        self.frame = (self.frame + 1) % len(self.fences)
+    
+    def delete(self):
+        for fence in self.fences:
+            if fence is not None:
+                self.gl.waitsync(fence)
+        self.fences = [None] * len(self.fences)
+        self.gl.deleteuniformbuffer(self.buffer, self.mapped is not None)
+        self.mapped = None
 
 class Shader(object):
     '''
     A utility/wrapper for OpenGL Shader.
+    
+    With a ProgramCache, the linked program is loaded from its binary if the
+    driver supports program binaries. It is compiled as usual if there is no
+    entry or the driver rejects the binary. gl replaces the OpenGL calls.
+    
+    The active uniforms and attributes are reflected after linking, uniforms
+    maps their names (also without the [0] of arrays) to Uniform objects,
+    attributes to their (location, size, type) and blocks the uniform blocks
+    to their (index, members).
     '''
-    def __init__(self, vsource, fsource, gsource = None):
+    def __init__(self, vsource, fsource, gsource = None, cache = None, gl = None):
+        self.gl = gl if gl is not None else defaultgl
         self.uniformlocs = {}
         self.attributelocs = {}
         self.program = None
+        stages = [(GL_VERTEX_SHADER, vsource)]
+        if gsource != None:
+            stages.append((GL_GEOMETRY_SHADER, gsource))
+        stages.append((GL_FRAGMENT_SHADER, fsource))
+        if cache is not None and self.gl.hasprogrambinary():
+            key = cache.key(stages, self.gl)
+            self.program = self._loadProgram(cache, key)
+            if self.program != None:
+                self._reflect()
+                return
+        else:
+            cache = None
         try:
             shaders = []
-            shaders.append(self._createShader(GL_VERTEX_SHADER, vsource))
-            if gsource != None:
-                shaders.append(self._createShader(GL_GEOMETRY_SHADER, gsource))
-            shaders.append(self._createShader(GL_FRAGMENT_SHADER, fsource))
-            self.program = self._createProgram(shaders)
+            for shadertype, source in stages:
+                shaders.append(self._createShader(shadertype, source))
+            self.program = self._createProgram(shaders, cache is not None)
             # Flag shader for deletion.
         except:
             if self.program != None:
-                glDeleteProgram(self.program)
+                self.gl.deleteprogram(self.program)
             raise
         finally:
             for shader in shaders:
                 try:
-                    glDeleteShader(shader)
+                    self.gl.deleteshader(shader)
                 except:
                     pass
+        if cache is not None:
+            self._storeProgram(cache, key)
+        self._reflect()
+    
+    @classmethod
+    def fromprogram(cls, program, gl = None):
+        '''Wraps an already linked program (e.g. built by a ShaderBatch).'''
+        shader = cls.__new__(cls)
+        shader.gl = gl if gl is not None else defaultgl
+        shader.uniformlocs = {}
+        shader.attributelocs = {}
+        shader.program = program
+        shader.uniforms = {}
+        shader.attributes = {}
+        shader.blocks = {}
+        if program != None:
+            shader._reflect()
+        return shader
+    
+    def _reflect(self):
+        '''Builds the tables of the active uniforms and attributes.'''
+        self.uniforms = {}
+        for name, size, gltype in self.gl.activeuniforms(self.program):
+            location = self.gl.uniformlocation(self.program, name)
+            if location < 0:
+                # Member of a uniform block.
+                continue
+            uniform = Uniform(name, location, size, gltype, self.gl)
+            self.uniforms[name] = uniform
+            if name.endswith('[0]'):
+                self.uniforms[name[:-3]] = uniform
+        self.attributes = {}
+        for name, size, gltype in self.gl.activeattributes(self.program):
+            location = self.gl.attriblocation(self.program, name)
+            self.attributes[name] = (location, size, gltype)
+        self.blocks = {}
+        if self.gl.hasuniformblocks():
+            for name, index, members in self.gl.activeuniformblocks(self.program):
+                self.blocks[name] = (index, members)
+        for name, uniform in self.uniforms.items():
+            self.uniformlocs[name] = uniform.location
+        for name, (location, _, _) in self.attributes.items():
+            self.attributelocs[name] = location
+    
+    def setuniform(self, name, value):
+        '''Sets a uniform of the program in use through its typed setter.'''
+        self.uniforms[name].set(value)
+    
+    def uniformbatch(self, names):
+        '''Returns a UniformBatch for the named uniforms.'''
+        return UniformBatch([self.uniforms[name] for name in names])
+    
+    def blocklayout(self, name):
+        '''Returns the UniformBlockLayout of a std140 uniform block.'''
+        index, members = self.blocks[name]
+        return UniformBlockLayout(name, index, members)
+    
+    def bindblock(self, name, binding):
+        '''Assigns the uniform block to a uniform buffer binding point.'''
+        self.gl.uniformblockbinding(self.program, self.blocks[name][0], binding)
+    
+    def _loadProgram(self, cache, key):
+        entry = cache.load(key)
+        if entry is None:
+            return None
+        prog = self.gl.createprogram()
+        try:
+            self.gl.programbinary(prog, *entry)
+            if self.gl.linkstatus(prog):
+                return prog
+        except Exception:
+            pass
+        # Rejected by the driver, compile instead.
+        self.gl.deleteprogram(prog)
+        cache.drop(key)
+        return None
+    
+    def _storeProgram(self, cache, key):
+        try:
+            binaryformat, data = self.gl.getprogrambinary(self.program)
+        except Exception:
+            return
+        if len(data) > 0:
+            cache.store(key, binaryformat, data)
     
     def _createShader(self, shadertype, source):
         try:
             shader = None
-            shader = glCreateShader(shadertype)
-            glShaderSource(shader, source)
-            glCompileShader(shader)
-            if glGetShaderiv(shader, GL_COMPILE_STATUS) != GL_TRUE:
-                info = glGetShaderInfoLog(shader)
+            shader = self.gl.createshader(shadertype)
+            self.gl.compileshader(shader, source)
+            if not self.gl.compilestatus(shader):
+                info = self.gl.shaderinfolog(shader)
                 raise Exception, "Unable to compile shader. Infolog:\n%s" % (info,)
             return shader
         except Exception:
             # Cleanup on exception
             if shader != None:
-                glDeleteShader(shader)
+                self.gl.deleteshader(shader)
             raise
     
-    def _createProgram(self, shaders):
+    def _createProgram(self, shaders, retrievable = False):
         prog = None
         try:
-            prog = glCreateProgram()
+            prog = self.gl.createprogram()
             for shader in shaders: 
-                glAttachShader(prog, shader)
+                self.gl.attachshader(prog, shader)
+            if retrievable:
+                self.gl.retrievablehint(prog)
             
-            glLinkProgram(prog)            
-            if glGetProgramiv(prog, GL_LINK_STATUS) != GL_TRUE:
-                info = glGetProgramInfoLog(prog)
+            self.gl.linkprogram(prog)            
+            if not self.gl.linkstatus(prog):
+                info = self.gl.programinfolog(prog)
                 raise Exception, "Unable to link program. Info log:\n%s" % (info)
             
             return prog
         except Exception:
             if prog != None:
-                glDeleteProgram(prog)
+                self.gl.deleteprogram(prog)
             raise
         
     def use(self):
-        glUseProgram(self.program)
+        self.gl.useprogram(self.program)
         
     def bindfragdata(self, colornumber, name):
-        glBindFragDataLocation(self.program, colornumber, name)
+        self.gl.bindfragdatalocation(self.program, colornumber, name)
         
     def uniformlocation(self, name):
         if name not in self.uniformlocs:
-                self.uniformlocs[name] = glGetUniformLocation(self.program, name)
+                self.uniformlocs[name] = self.gl.uniformlocation(self.program, name)
         return self.uniformlocs[name]
         
     def attributelocation(self, name):
         if name not in self.attributelocs:
-                self.attributelocs[name] = glGetAttribLocation(self.program, name)
-        return self.attributelocs[name]
\ No newline at end of file
+                self.attributelocs[name] = self.gl.attriblocation(self.program, name)
+        return self.attributelocs[name]
+
+class ShaderFuture(object):
+    '''
+    The pending result of ShaderBatch.submit. It is completed by the polls of
+    its batch, result() polls until it is done.
+    '''
+    def __init__(self, batch):
+        self._batch = batch
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+    
+    def done(self):
+        return self._done
+    
+    def result(self):
+        '''Returns the Shader, or raises the compile/link error.'''
+        self._batch.resolve(self)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+    
+    def exception(self):
+        self._batch.resolve(self)
+        return self._exception
+    
+    def add_done_callback(self, fn):
+        '''Calls fn(future) when done, during the poll completing it.'''
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+    
+    def _finish(self, result = None, exception = None):
+        self._result = result
+        self._exception = exception
+        self._done = True
+        for fn in self._callbacks:
+            fn(self)
+        self._callbacks = []
+
+# States of the programs in a ShaderBatch.
+_BATCH_COMPILING = 0
+_BATCH_LINKING = 1
+
+class _BatchJob(object):
+    def __init__(self, stages, cache, key, future):
+        self.stages = stages
+        self.cache = cache
+        self.key = key
+        self.future = future
+        self.shaders = []
+        self.program = None
+        self.frombinary = False
+        self.state = _BATCH_COMPILING
+
+class ShaderBatch(object):
+    '''
+    Builds many shaders at once without waiting for the driver. submit()
+    issues the compiles (or loads a cached binary) and returns a
+    ShaderFuture, all status queries are deferred to poll(). With
+    KHR_parallel_shader_compile the driver compiles in background threads
+    and poll() only completes the programs that are ready, so it can be
+    called once per frame. Without it, poll() first links all compiled
+    programs and then checks them, which blocks until all are done.
+    '''
+    def __init__(self, cache = None, gl = None, threads = 0xFFFFFFFF):
+        self.gl = gl if gl is not None else defaultgl
+        self.cache = cache
+        if cache is not None and not self.gl.hasprogrambinary():
+            self.cache = None
+        self.parallel = self.gl.parallelcompile(threads)
+        self.jobs = []
+    
+    def submit(self, vsource, fsource, gsource = None):
+        '''Starts building the shader, returns its ShaderFuture.'''
+        stages = [(GL_VERTEX_SHADER, vsource)]
+        if gsource != None:
+            stages.append((GL_GEOMETRY_SHADER, gsource))
+        stages.append((GL_FRAGMENT_SHADER, fsource))
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(stages, self.gl)
+        job = _BatchJob(stages, self.cache, key, ShaderFuture(self))
+        try:
+            if not self._loadbinary(job):
+                self._compile(job)
+        except Exception, e:
+            self._cleanup(job)
+            job.future._finish(exception=e)
+            return job.future
+        self.jobs.append(job)
+        return job.future
+    
+    def pending(self):
+        '''Returns the number of unfinished shaders.'''
+        return len(self.jobs)
+    
+    def poll(self):
+        '''
+        Advances all submitted shaders as far as possible, returns the number
+        of unfinished ones.
+        '''
+        # Link everything compiled first, so the links overlap.
+        for job in self.jobs:
+            if job.state == _BATCH_COMPILING:
+                self._step(job, self._link)
+        for job in self.jobs:
+            if job.state == _BATCH_LINKING:
+                self._step(job, self._finish)
+        self.jobs = [job for job in self.jobs if not job.future.done()]
+        return len(self.jobs)
+    
+    def resolve(self, future = None):
+        '''Polls until the future (or all shaders) are done.'''
+        while self.jobs and (future is None or not future.done()):
+            self.poll()
+    
+    def _step(self, job, step):
+        try:
+            step(job)
+        except Exception, e:
+            self._cleanup(job)
+            job.future._finish(exception=e)
+    
+    def _cleanup(self, job):
+        for shader in job.shaders:
+            try:
+                self.gl.deleteshader(shader)
+            except:
+                pass
+        job.shaders = []
+        if job.program != None:
+            self.gl.deleteprogram(job.program)
+            job.program = None
+    
+    def _loadbinary(self, job):
+        if job.cache is None:
+            return False
+        entry = job.cache.load(job.key)
+        if entry is None:
+            return False
+        job.program = self.gl.createprogram()
+        try:
+            self.gl.programbinary(job.program, *entry)
+        except Exception:
+            self.gl.deleteprogram(job.program)
+            job.program = None
+            job.cache.drop(job.key)
+            return False
+        job.frombinary = True
+        job.state = _BATCH_LINKING
+        return True
+    
+    def _compile(self, job):
+        for shadertype, source in job.stages:
+            shader = self.gl.createshader(shadertype)
+            job.shaders.append(shader)
+            self.gl.compileshader(shader, source)
+        job.state = _BATCH_COMPILING
+    
+    def _link(self, job):
+        if self.parallel:
+            for shader in job.shaders:
+                if not self.gl.shadercompleted(shader):
+                    return
+        for shader in job.shaders:
+            if not self.gl.compilestatus(shader):
+                info = self.gl.shaderinfolog(shader)
+                raise Exception, "Unable to compile shader. Infolog:\n%s" % (info,)
+        job.program = self.gl.createprogram()
+        for shader in job.shaders:
+            self.gl.attachshader(job.program, shader)
+        if job.cache is not None:
+            self.gl.retrievablehint(job.program)
+        self.gl.linkprogram(job.program)
+        # Flag shader for deletion.
+        for shader in job.shaders:
+            self.gl.deleteshader(shader)
+        job.shaders = []
+        job.state = _BATCH_LINKING
+    
+    def _finish(self, job):
+        if self.parallel and not self.gl.programcompleted(job.program):
+            return
+        if not self.gl.linkstatus(job.program):
+            if job.frombinary:
+                # Rejected by the driver, compile instead.
+                self.gl.deleteprogram(job.program)
+                job.program = None
+                job.frombinary = False
+                job.cache.drop(job.key)
+                self._compile(job)
+                return
+            info = self.gl.programinfolog(job.program)
+            raise Exception, "Unable to link program. Info log:\n%s" % (info)
+        shader = Shader.fromprogram(job.program, self.gl)
+        if job.cache is not None and not job.frombinary:
+            shader._storeProgram(job.cache, job.key)
+        job.program = None
+        job.future._finish(shader)
+
+class ShaderRegistry(object):
+    '''
+    Shares compiled stages and linked programs between Shader users. Stages
+    are keyed on a hash of their type and source, programs on their stages,
+    so a vertex shader used by many programs is compiled once and the same
+    sources always yield the same Shader. acquire() and release() count the
+    references; programs without references are kept for reuse until more
+    than maxunused of them exist, the least recently released are deleted
+    first. Stages are deleted with the last program using them.
+    '''
+    def __init__(self, cache = None, gl = None, maxunused = 32):
+        self.gl = gl if gl is not None else defaultgl
+        self.cache = cache
+        if cache is not None and not self.gl.hasprogrambinary():
+            self.cache = None
+        self.maxunused = maxunused
+        # Stage key -> [shader object, references]
+        self.stages = {}
+        # Program key -> [Shader, references, stage keys]
+        self.programs = {}
+        self.keys = {}
+        self.unused = OrderedDict()
+    
+    def _stagekey(self, shadertype, source):
+        return hashlib.sha1('%i\0%s' % (shadertype, source)).hexdigest()
+    
+    def _acquirestage(self, key, shadertype, source, shader):
+        if key not in self.stages:
+            self.stages[key] = [shader._createShader(shadertype, source), 0]
+        self.stages[key][1] += 1
+        return self.stages[key][0]
+    
+    def _releasestage(self, key):
+        entry = self.stages[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.stages[key]
+            self.gl.deleteshader(entry[0])
+    
+    def acquire(self, vsource, fsource, gsource = None):
+        '''Returns the shared Shader for the sources, compiling only new stages.'''
+        stages = [(GL_VERTEX_SHADER, vsource)]
+        if gsource != None:
+            stages.append((GL_GEOMETRY_SHADER, gsource))
+        stages.append((GL_FRAGMENT_SHADER, fsource))
+        key = tuple(self._stagekey(*stage) for stage in stages)
+        if key in self.programs:
+            entry = self.programs[key]
+            entry[1] += 1
+            self.unused.pop(key, None)
+            return entry[0]
+        
+        shader = Shader.fromprogram(None, self.gl)
+        stagekeys = []
+        if self.cache is not None:
+            cachekey = self.cache.key(stages, self.gl)
+            shader.program = shader._loadProgram(self.cache, cachekey)
+        if shader.program == None:
+            try:
+                shaders = []
+                for stagekey, (shadertype, source) in zip(key, stages):
+                    shaders.append(self._acquirestage(stagekey, shadertype,
+                                                      source, shader))
+                    stagekeys.append(stagekey)
+                shader.program = shader._createProgram(shaders,
+                                                       self.cache is not None)
+            except:
+                for stagekey in stagekeys:
+                    self._releasestage(stagekey)
+                raise
+            if self.cache is not None:
+                shader._storeProgram(self.cache, cachekey)
+        shader._reflect()
+        self.programs[key] = [shader, 1, stagekeys]
+        self.keys[shader.program] = key
+        return shader
+    
+    def release(self, shader):
+        '''Drops a reference, unused programs are deleted by LRU.'''
+        if shader.program not in self.keys:
+            raise Exception, "Shader does not belong to the registry."
+        key = self.keys[shader.program]
+        entry = self.programs[key]
+        if entry[1] <= 0:
+            raise Exception, "Shader released more often than acquired."
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.unused[key] = None
+            self.evict(self.maxunused)
+    
+    def references(self, shader):
+        '''Returns the number of references to the Shader.'''
+        return self.programs[self.keys[shader.program]][1]
+    
+    def evict(self, keep = 0):
+        '''Deletes the least recently released unused programs but keep.'''
+        while len(self.unused) > keep:
+            key, _ = self.unused.popitem(last=False)
+            shader, _, stagekeys = self.programs.pop(key)
+            del self.keys[shader.program]
+            self.gl.deleteprogram(shader.program)
+            shader.program = None
+            for stagekey in stagekeys:
+                self._releasestage(stagekey)
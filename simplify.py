@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+# 
+#  Simplify - quadric error metric mesh decimation and LOD chains.
+#  Authors:
+#   - Richard Petri <dasricht at gmail.com>
+#
+#  This is free and unencumbered software released into the public domain.
+#  
+#  Anyone is free to copy, modify, publish, use, compile, sell, or
+#  distribute this software, either in source code form or as a compiled
+#  binary, for any purpose, commercial or non-commercial, and by any
+#  means.
+#  
+#  In jurisdictions that recognize copyright laws, the author or authors
+#  of this software dedicate any and all copyright interest in the
+#  software to the public domain. We make this dedication for the benefit
+#  of the public at large and to the detriment of our heirs and
+#  successors. We intend this dedication to be an overt act of
+#  relinquishment in perpetuity of all present and future rights to this
+#  software under copyright law.
+#  
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#   
+#  For more information, please refer to <http://unlicense.org/>
+#
+##############################################################################
+import numpy as np
+from wavefront import ObjFileParser
+
+def _planes(p, tris):
+    # Unit face planes (N, 4) and face areas.
+    a, b, c = p[tris[:, 0]], p[tris[:, 1]], p[tris[:, 2]]
+    n = np.cross(b - a, c - a)
+    length = np.linalg.norm(n, axis=1)
+    n /= np.maximum(length, 1e-30)[:, np.newaxis]
+    return np.hstack([n, -(n * a).sum(axis=1)[:, np.newaxis]]), 0.5 * length
+
+def _edges(tris, nverts):
+    '''
+    Returns the unique edges (a, b) with a < b of the triangles, the number
+    of triangles sharing them and one of those triangles.
+    '''
+    a = tris.reshape(-1)
+    b = tris[:, [1, 2, 0]].reshape(-1)
+    key = np.minimum(a, b) * nverts + np.maximum(a, b)
+    key, first, count = np.unique(key, return_index=True, return_counts=True)
+    return key // nverts, key % nverts, count, first // 3
+
+def _accumulate(Q, vertices, planes, weights):
+    # Adds the weighted plane quadrics to the quadrics of the vertices.
+    pp = weights[:, np.newaxis, np.newaxis] * planes[:, :, np.newaxis] * planes[:, np.newaxis, :]
+    for i in range(4):
+        for j in range(i, 4):
+            Q[:, i, j] += np.bincount(vertices, pp[:, i, j], minlength=len(Q))
+            Q[:, j, i] = Q[:, i, j]
+
+def _quadrics(p, tris, borderweight):
+    '''
+    Builds the (N, 4, 4) error quadrics of the vertices from the area
+    weighted face planes. Border edges (and attribute seams, which are
+    borders in the indexed mesh) add planes perpendicular to their face.
+    '''
+    Q = np.zeros((len(p), 4, 4))
+    planes, area = _planes(p, tris)
+    _accumulate(Q, tris.reshape(-1), np.repeat(planes, 3, axis=0),
+                np.repeat(area, 3))
+    a, b, count, tri = _edges(tris, len(p))
+    border = count == 1
+    a, b, tri = a[border], b[border], tri[border]
+    e = p[b] - p[a]
+    n = np.cross(e, planes[tri, :3])
+    n /= np.maximum(np.linalg.norm(n, axis=1), 1e-30)[:, np.newaxis]
+    planes = np.hstack([n, -(n * p[a]).sum(axis=1)[:, np.newaxis]])
+    weights = borderweight * (e * e).sum(axis=1)
+    _accumulate(Q, np.concatenate([a, b]), np.tile(planes, (2, 1)),
+                np.tile(weights, 2))
+    return Q, np.bincount(np.concatenate([a, b]), minlength=len(p)) > 0
+
+def _error(Q, x):
+    x = np.hstack([x, np.ones((len(x), 1))])
+    return np.maximum(np.einsum('ni,nij,nj->n', x, Q, x), 0)
+
+def _targets(Q, pa, pb, locked):
+    '''
+    Finds the best positions on the edges pa-pb for the summed quadrics Q,
+    where edges with a locked pa may only be collapsed onto pa. Returns the
+    interpolation parameters t (0 at pa) and the errors.
+    '''
+    e = pb - pa
+    # The minimum of the quadric projected onto the edge, if it exists.
+    A, rhs = Q[:, :3, :3], -Q[:, :3, 3]
+    solvable = np.abs(np.linalg.det(A)) > 1e-12
+    x = pa + 0.5 * e
+    if np.any(solvable):
+        x[solvable] = np.linalg.solve(A[solvable], rhs[solvable])
+    topt = np.clip(((x - pa) * e).sum(axis=1) /
+                   np.maximum((e * e).sum(axis=1), 1e-30), 0, 1)
+    ts = np.stack([np.zeros(len(e)), np.ones(len(e)), np.full(len(e), 0.5), topt])
+    errors = np.stack([_error(Q, pa + t[:, np.newaxis] * e) for t in ts])
+    errors[1:, locked] = np.inf
+    best = np.argmin(errors, axis=0)
+    rows = np.arange(len(e))
+    return ts[best, rows], errors[best, rows]
+
+def _neighbours(ea, eb, nverts):
+    # The neighbours of all vertices (CSR) from the edges of the mesh.
+    src = np.concatenate([ea, eb])
+    dst = np.concatenate([eb, ea])[np.argsort(src, kind='mergesort')]
+    offsets = np.zeros(nverts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=nverts), out=offsets[1:])
+    return offsets, dst
+
+def _ringmin(values, neighbours):
+    # The minimum of the values over every vertex and its neighbours.
+    offsets, dst = neighbours
+    result = values.copy()
+    connected = offsets[1:] > offsets[:-1]
+    result[connected] = np.minimum(result[connected], np.minimum.reduceat(
+        values[dst], offsets[:-1][connected]))
+    return result
+
+def _independent(a, b, rank, free, neighbours):
+    '''
+    Selects free edges (a, b) with unique ranks, that have a lower rank
+    than all other free edges within one edge of them, so the selected
+    edges can be collapsed at the same time.
+    '''
+    nverts = len(neighbours[0]) - 1
+    byrank = np.empty(len(a), dtype=np.int64)
+    byrank[rank] = np.arange(len(a))
+    # Written in descending rank order, so the lowest rank remains.
+    byrank = byrank[free[byrank]][::-1]
+    first = np.full(nverts, len(a))
+    first[a[byrank]] = rank[byrank]
+    lowest = first[b[byrank]] > rank[byrank]
+    first[b[byrank[lowest]]] = rank[byrank[lowest]]
+    near = _ringmin(first, neighbours)
+    return free & (near[a] == rank) & (near[b] == rank)
+
+def _linkcondition(a, b, count, neighbours):
+    '''
+    Checks, that the edges (a, b) shared by count triangles have no other
+    common neighbours than the opposite vertices of these triangles, i.e.
+    collapsing them keeps the mesh manifold.
+    '''
+    offsets, dst = neighbours
+    nverts = len(offsets) - 1
+    edge = np.arange(len(a))
+    keys = []
+    for v in (a, b):
+        degree = offsets[v + 1] - offsets[v]
+        start = np.repeat(offsets[v] - (np.cumsum(degree) - degree), degree)
+        keys.append(np.repeat(edge, degree) * nverts +
+                    dst[start + np.arange(degree.sum())])
+    keys, shared = np.unique(np.concatenate(keys), return_counts=True)
+    common = np.bincount(keys[shared > 1] // nverts, minlength=len(a))
+    return common <= count
+
+def _flips(p, tris, remap, moved, newpos):
+    '''
+    Returns the triangles (as a mask), whose normal flips (or turns by more
+    than about 75 degrees) when the vertices are remapped and moved to the
+    new positions.
+    '''
+    q = p.copy()
+    q[moved] = newpos
+    changed = remap != np.arange(len(p))
+    changed[moved] = True
+    new = remap[tris]
+    touched = np.any(changed[tris], axis=1)
+    touched &= (new[:, 0] != new[:, 1]) & (new[:, 1] != new[:, 2]) & (new[:, 2] != new[:, 0])
+    t, n = tris[touched], new[touched]
+    before = np.cross(p[t[:, 1]] - p[t[:, 0]], p[t[:, 2]] - p[t[:, 0]])
+    after = np.cross(q[n[:, 1]] - q[n[:, 0]], q[n[:, 2]] - q[n[:, 0]])
+    flipped = np.zeros(len(tris), dtype=bool)
+    flipped[touched] = (before * after).sum(axis=1) <= 0.25 * np.sqrt(
+        (before * before).sum(axis=1) * (after * after).sum(axis=1))
+    return flipped
+
+def decimate(v, vn, vt, f, targets, borderweight = 10.0, maxerror = np.inf,
+             groups = None):
+    '''
+    Decimates the indexed mesh (v, vn, vt, f) with quadric error metric edge
+    collapses down to each of the target triangle counts (descending) in
+    turn, so the results form a chain of levels of detail. Batches of
+    independent edges are collapsed at once with plain array operations.
+    Attribute seams and borders are preserved, normals and texture
+    coordinates are interpolated along the collapsed edges.
+    
+    Returns a list of (v, vn, vt, f) tuples, one per target, with unused
+    vertices removed. The decimation stops early, when no edge can be
+    collapsed with an error below maxerror.
+    
+    groups optionally assigns an id (e.g. of the material) to every triangle.
+    Vertices between groups stay put like seams, so the group borders are
+    kept, and the tuples get the groups of the remaining triangles as fifth
+    element.
+    '''
+    v = np.asarray(v, dtype=np.float32)
+    attrs = [a for a in (vn, vt) if len(a) > 0]
+    # All attributes are interpolated together in one array.
+    data = np.hstack([v] + [np.asarray(a, dtype=np.float32)[:len(v)]
+                            for a in attrs]).astype(np.float64)
+    nverts = len(v)
+    tris = np.asarray(f, dtype=np.int64).reshape(-1, 3)
+    p = data[:, :3]
+    Q, border = _quadrics(p, tris, borderweight)
+    # Vertices sharing a position are on an attribute seam and stay put.
+    _, inverse, counts = np.unique(p, axis=0, return_inverse=True,
+                                   return_counts=True)
+    locked = counts[inverse] > 1
+    if groups is not None:
+        groups = np.asarray(groups, dtype=np.int64)
+        corners = tris.reshape(-1)
+        low = np.full(nverts, np.iinfo(np.int64).max, dtype=np.int64)
+        high = np.full(nverts, np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(low, corners, np.repeat(groups, 3))
+        np.maximum.at(high, corners, np.repeat(groups, 3))
+        locked |= (low != high) & (high >= low)
+    
+    random = np.random.RandomState(0)
+    results = []
+    for target in targets:
+        while len(tris) > target:
+            a, b, count, _ = _edges(tris, nverts)
+            neighbours = _neighbours(a, b, nverts)
+            valid = (count <= 2) & ~(locked[a] & locked[b])
+            # Border vertices may only be collapsed along the border.
+            valid &= (count == 1) | ~(border[a] & border[b])
+            a, b, count = a[valid], b[valid], count[valid]
+            # Collapse onto the locked vertex, if any.
+            swap = locked[b]
+            a, b = np.where(swap, b, a), np.where(swap, a, b)
+            t, error = _targets(Q[a] + Q[b], p[a], p[b], locked[a])
+            keep = np.flatnonzero(error <= maxerror)
+            if len(keep) == 0:
+                break
+            # Only the cheapest edges are candidates, they are selected in a
+            # few rounds with random ranks to get many independent ones.
+            window = max(1, len(keep) // 4)
+            order = np.argpartition(error[keep], window - 1)[:window]
+            order = keep[order[np.argsort(error[keep][order], kind='mergesort')]]
+            a, b, t, count = a[order], b[order], t[order], count[order]
+            rank = random.permutation(len(a))
+            accepted = np.zeros(len(a), dtype=bool)
+            free = np.ones(len(a), dtype=bool)
+            for _ in range(8):
+                selected = _independent(a, b, rank, free, neighbours)
+                if not np.any(selected):
+                    break
+                rejected = np.zeros(len(a), dtype=bool)
+                rejected[selected] = ~_linkcondition(a[selected], b[selected],
+                                                     count[selected], neighbours)
+                selected &= ~rejected
+                remap = np.arange(nverts)
+                remap[b[selected]] = a[selected]
+                newpos = p[a[selected]] + t[selected, np.newaxis] * (
+                    p[b[selected]] - p[a[selected]])
+                flipped = _flips(p, tris, remap, a[selected], newpos)
+                bad = np.zeros(nverts, dtype=bool)
+                bad[tris[flipped]] = True
+                rejected |= selected & (bad[a] | bad[b])
+                selected &= ~rejected
+                accepted |= selected
+                # Edges near accepted collapses are not independent anymore.
+                ring = np.zeros(nverts, dtype=np.int64)
+                ring[a[accepted]] = ring[b[accepted]] = -1
+                blocked = _ringmin(ring, neighbours) < 0
+                free &= ~(blocked[a] | blocked[b]) & ~rejected
+            # Every collapse removes up to two triangles.
+            accepted &= np.cumsum(accepted) <= max(1, (len(tris) - target + 1) // 2)
+            a, b, t = a[accepted], b[accepted], t[accepted]
+            if len(a) == 0:
+                break
+            data[a] += t[:, np.newaxis] * (data[b] - data[a])
+            remap = np.arange(nverts)
+            remap[b] = a
+            Q[a] += Q[b]
+            border[a] |= border[b]
+            tris = remap[tris]
+            keep = ((tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2]) &
+                    (tris[:, 2] != tris[:, 0]))
+            tris = tris[keep]
+            if groups is not None:
+                groups = groups[keep]
+        result = _compact(data, tris, v.shape[1], vn, vt)
+        if groups is not None:
+            result += (groups.copy(),)
+        results.append(result)
+    return results
+
+def _compact(data, tris, width, vn, vt):
+    # Removes the unused vertices and splits the attributes again.
+    used, f = np.unique(tris, return_inverse=True)
+    data = data[used].astype(np.float32)
+    out = [data[:, :width]]
+    for a in (vn, vt):
+        if len(a) > 0:
+            a = data[:, width:width + np.shape(a)[1]]
+            width += a.shape[1]
+        out.append(a)
+    if len(vn) > 0:
+        # Interpolated normals need to be normalized again.
+        n = out[1]
+        n[:, :3] /= np.maximum(np.linalg.norm(n[:, :3], axis=1), 1e-30)[:, np.newaxis]
+    return out[0], out[1], out[2], f.reshape(-1, 3).astype(np.int32)
+
+def _rangeruns(obj, ntris):
+    '''
+    Splits the triangles of obj into runs within one material, object and
+    group range each. Returns the run of every triangle and the (material,
+    object, group) names of the runs.
+    '''
+    ranges = [('m', name, first, count)
+              for name, first, count in obj.materialranges]
+    for keyword in ('o', 'g'):
+        for name, parts in getattr(obj, keyword).items():
+            ranges.extend((keyword, name, first, count) for first, count in parts)
+    bounds = set([0, ntris])
+    for _, _, first, count in ranges:
+        bounds.update([first // 3, (first + count) // 3])
+    starts = np.array(sorted(b for b in bounds if b < ntris), dtype=np.int64)
+    names = [{} for _ in starts]
+    for keyword, name, first, count in ranges:
+        for run in range(np.searchsorted(starts, first // 3),
+                         np.searchsorted(starts, (first + count) // 3)):
+            names[run][keyword] = name
+    runs = np.searchsorted(starts, np.arange(ntris), side='right') - 1
+    return runs, [(n.get('m'), n.get('o'), n.get('g')) for n in names]
+
+def _runranges(runs, names):
+    '''
+    Builds the material ranges and the object and group ranges of triangles
+    sorted by run (see _rangeruns).
+    '''
+    materialranges, o, g = [], {}, {}
+    ids = np.flatnonzero(np.bincount(runs, minlength=len(names)))
+    firsts = 3 * np.searchsorted(runs, ids)
+    counts = 3 * np.bincount(runs, minlength=len(names))[ids]
+    for run, first, count in zip(ids.tolist(), firsts.tolist(), counts.tolist()):
+        material, objectname, groupname = names[run]
+        if materialranges and materialranges[-1][0] == material:
+            materialranges[-1] = (material, materialranges[-1][1],
+                                  materialranges[-1][2] + count)
+        else:
+            materialranges.append((material, first, count))
+        for ranges, name in ((o, objectname), (g, groupname)):
+            if name is None:
+                continue
+            parts = ranges.setdefault(name, [])
+            if parts and sum(parts[-1]) == first:
+                parts[-1] = (parts[-1][0], parts[-1][1] + count)
+            else:
+                parts.append((first, count))
+    return materialranges, o, g
+
+def lodchain(obj, ratios = (0.5, 0.25, 0.125), **kwargs):
+    '''
+    Generates levels of detail of an ObjFileParser at the given ratios of
+    its triangle count. Returns a list of ObjFileParser objects (obj itself
+    for ratios >= 1), so every level can be turned into buffers with
+    generateIndexedBuffer and the same layout. The borders between material,
+    object and group ranges are kept and the levels get the ranges and
+    materials of obj. Further keyword arguments are passed to decimate.
+    '''
+    ntris = len(obj.f)
+    targets = [int(ntris * r) for r in ratios]
+    order = np.argsort(targets)[::-1]
+    runs, names = _rangeruns(obj, ntris)
+    levels = decimate(obj.v, obj.vn, obj.vt, obj.f,
+                      [targets[i] for i in order], groups=runs, **kwargs)
+    lods = [None] * len(ratios)
+    for i, (v, vn, vt, f, lodruns) in zip(order, levels):
+        if ratios[i] >= 1:
+            lods[i] = obj
+            continue
+        # Collapses keep the runs of the triangles, but not their order.
+        sort = np.argsort(lodruns, kind='mergesort')
+        materialranges, o, g = _runranges(lodruns[sort], names)
+        lod = ObjFileParser.fromarrays(v, vn, vt, f[sort], obj.faceformat,
+            obj.padnormals, obj.padtexcoords, materialranges=materialranges,
+            o=o, g=g)
+        # Share the Material objects of obj.
+        lod.mtllibs = list(obj.mtllibs)
+        lod.materials = obj.materials
+        lods[i] = lod
+    return lods
+
+def lodbuffers(obj, ratios = (1.0, 0.5, 0.25, 0.125), layout = [0,1],
+               itype = None, **kwargs):
+    '''
+    Returns the vertex and index buffers (see generateIndexedBuffer) of the
+    levels of detail of obj at the given ratios.
+    '''
+    return [lod.generateIndexedBuffer(layout, itype)
+            for lod in lodchain(obj, ratios, **kwargs)]
@@ -31,6 +31,11 @@
 #  For more information, please refer to <http://unlicense.org/>
 #
 ##############################################################################
+import os
+import re
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 
 OBJFILE_FORMAT_V = 1
@@ -39,15 +44,643 @@ OBJFILE_FORMAT_VN = 5
 OBJFILE_FORMAT_VTN = 7
 
 OBJFILE_FORMAT_V_BIT = 1
-OBJFILE_FORMAT_N_BIT = 2
-OBJFILE_FORMAT_T_BIT = 4
+OBJFILE_FORMAT_N_BIT = 4
+OBJFILE_FORMAT_T_BIT = 2
+
+# Weightings of the face normals for ObjFileParser.generatenormals.
+NORMALS_AREA = 'area'
+NORMALS_ANGLE = 'angle'
+
+##############################################################################
+# Bulk parsing
+#
+# Instead of handling the file line by line, the bulk parser looks at the
+# whole file as one byte array. Lines are classified by their first
+# characters, the statement keywords are blanked out and all records of one
+# kind are converted with a single call to np.fromstring.
+##############################################################################
+(_LINE_NONE, _LINE_V, _LINE_VN, _LINE_VT, _LINE_F, _LINE_VP, _LINE_USEMTL,
+ _LINE_MTLLIB, _LINE_O, _LINE_G, _LINE_S) = range(11)
+
+# Statements, that name the faces following them.
+_NAMING_STATEMENTS = [('usemtl', _LINE_USEMTL), ('mtllib', _LINE_MTLLIB),
+                      ('o', _LINE_O), ('g', _LINE_G), ('s', _LINE_S)]
+
+_COMMENT_RE = re.compile(br'#[^\n]*')
+_INDENT_RE = re.compile(br'\n[ \t]+')
+
+# Number of integers per face vertex and the columns of (v, vn, vt) in it.
+_FACEFORMAT_COLUMNS = {
+    OBJFILE_FORMAT_V : (1, (0, None, None)),
+    OBJFILE_FORMAT_VT : (2, (0, None, 1)),
+    OBJFILE_FORMAT_VN : (2, (0, 1, None)),
+    OBJFILE_FORMAT_VTN : (3, (0, 2, 1)),
+}
+
+def _isspace(chars):
+    return (chars == 32) | (chars == 9) | (chars == 10)
+
+def _normalizebuffer(data):
+    '''
+    Strips comments, carriage returns and indentation from raw obj-file data
+    without changing the line numbering. Returns a writable bytearray that
+    always ends with a newline.
+    '''
+    if b'#' in data:
+        data = _COMMENT_RE.sub(b'', data)
+    if b'\r' in data:
+        data = data.replace(b'\r', b' ')
+    data = data.lstrip(b' \t')
+    if _INDENT_RE.search(data) is not None:
+        data = _INDENT_RE.sub(b'\n', data)
+    data = bytearray(data)
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    return data
+
+def _classifylines(chars):
+    '''
+    Splits the buffer into lines and classifies every line by its statement.
+    Returns the start/end offsets and the kind (_LINE_*) of each line.
+    '''
+    ends = np.flatnonzero(chars == 10)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    last = len(chars) - 1
+    c0 = chars[starts]
+    c1 = chars[np.minimum(starts + 1, last)]
+    c2 = chars[np.minimum(starts + 2, last)]
+    kinds = np.zeros(len(starts), dtype=np.int8)
+    isv = c0 == ord('v')
+    kinds[isv & _isspace(c1)] = _LINE_V
+    kinds[isv & (c1 == ord('n')) & _isspace(c2)] = _LINE_VN
+    kinds[isv & (c1 == ord('t')) & _isspace(c2)] = _LINE_VT
+    kinds[isv & (c1 == ord('p')) & _isspace(c2)] = _LINE_VP
+    kinds[(c0 == ord('f')) & _isspace(c1)] = _LINE_F
+    for keyword, kind in _NAMING_STATEMENTS:
+        match = np.ones(len(starts), dtype=bool)
+        for i, c in enumerate(bytearray(keyword)):
+            match &= chars[np.minimum(starts + i, last)] == c
+        match &= _isspace(chars[np.minimum(starts + len(keyword), last)])
+        kinds[match] = kind
+    return starts, ends, kinds
+
+def _gatherlines(data, starts, ends, rows):
+    '''Joins the given lines of the buffer to one string.'''
+    if len(rows) == 0:
+        return b''
+    # Consecutive lines are copied as one slice.
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    first = rows[np.concatenate([[0], breaks])]
+    last = rows[np.concatenate([breaks - 1, [len(rows) - 1]])]
+    return bytes(bytearray(b'\n').join(data[s:e]
+        for s, e in zip(starts[first], ends[last])))
+
+def _countinrange(positions, starts, ends):
+    '''Counts the (sorted) positions in each of the ranges [start, end).'''
+    return (np.searchsorted(positions, ends) -
+            np.searchsorted(positions, starts))
+
+def _namingstatements(data, starts, ends, kinds, frows):
+    '''
+    Collects the usemtl, mtllib, o and g statements. Returns a dict of
+    (positions, names) per keyword, where position is the number of faces
+    before the statement.
+    '''
+    statements = {}
+    for keyword, kind in _NAMING_STATEMENTS:
+        rows = np.flatnonzero(kinds == kind)
+        names = [bytes(data[starts[row]:ends[row]])[len(keyword):].strip()
+                 for row in rows]
+        statements[keyword] = (np.searchsorted(frows, rows).tolist(), names)
+    return statements
+
+def _parseerror(line, message):
+    return Exception('Parsing error at line %i: %s' % (line, message))
+
+def _parsenumbers(data, starts, ends, rows, counts, dtype, firstline):
+    '''
+    Converts the whitespace separated numbers of the given lines with one
+    np.fromstring call. Falls back to a per line conversion to locate the
+    offending line, if the data is malformed.
+    '''
+    text = _gatherlines(data, starts, ends, rows)
+    values = np.fromstring(text, dtype=dtype, sep=' ')
+    if len(values) == counts.sum():
+        return values
+    convert = float if np.dtype(dtype).kind == 'f' else int
+    for row in rows:
+        try:
+            for field in bytes(data[starts[row]:ends[row]]).split():
+                convert(field)
+        except ValueError as e:
+            raise _parseerror(row + firstline, e)
+    raise Exception, 'Parsing error: Malformed numbers.'
+
+def _parserecords(data, starts, ends, rows, counts, width, fill, firstline):
+    '''
+    Parses the vertex records of the given lines into a preallocated float32
+    array of the given width. Columns not present in a record keep the fill
+    values.
+    '''
+    out = np.empty((len(rows), width), dtype=np.float32)
+    out[:] = fill
+    values = _parsenumbers(data, starts, ends, rows, counts, np.float32,
+        firstline)
+    if len(rows) > 0 and np.all(counts == counts[0]):
+        out[:, :counts[0]] = values.reshape(len(rows), counts[0])
+    else:
+        out[np.arange(width) < counts[:, np.newaxis]] = values
+    return out
+
+def _checkcounts(counts, rows, allowed, message, firstline):
+    bad = np.flatnonzero(~np.in1d(counts, allowed))
+    if len(bad) > 0:
+        raise _parseerror(rows[bad[0]] + firstline, message)
+
+def _bulkparse(data, padnormals, padtexcoords, offsets = (0, 0, 0),
+               faceformat = None, firstline = 1):
+    '''
+    Parses the v, vn, vt and f statements of the raw obj-file data.
+    Returns the v, vn and vt arrays, the face vertices as a (N, 3) array of
+    (v, vn, vt) indices (-1 for absent attributes), the number of vertices of
+    every face, the faceformat and the naming statements (see
+    _namingstatements).
+    
+    When parsing a part of a file, offsets holds the number of v, vn and vt
+    statements before the part, faceformat the format of the previous faces
+    (if any) and firstline the line number the part starts at.
+    '''
+    data = _normalizebuffer(data)
+    chars = np.frombuffer(data, dtype=np.uint8)
+    starts, ends, kinds = _classifylines(chars)
+    vp = np.flatnonzero(kinds == _LINE_VP)
+    if len(vp) > 0:
+        raise _parseerror(vp[0] + firstline, 'Parameter space not implemented.')
+    vrows = np.flatnonzero(kinds == _LINE_V)
+    vnrows = np.flatnonzero(kinds == _LINE_VN)
+    vtrows = np.flatnonzero(kinds == _LINE_VT)
+    frows = np.flatnonzero(kinds == _LINE_F)
+    statements = _namingstatements(data, starts, ends, kinds, frows)
+
+    # The slashes of the faces are needed to determine the faceformat.
+    isslash = chars == ord('/')
+    slashes = np.flatnonzero(isslash)
+    doubleslashes = np.flatnonzero(isslash[:-1] & isslash[1:])
+    fslashes = _countinrange(slashes, starts[frows], ends[frows])
+    fdoubleslashes = _countinrange(doubleslashes, starts[frows], ends[frows])
+    del isslash, slashes, doubleslashes
+
+    # Blank out the statement keywords and the slashes, so that only
+    # whitespace separated numbers remain.
+    chars[starts[(kinds != _LINE_NONE) & (kinds <= _LINE_VP)]] = 32
+    chars[starts[(kinds == _LINE_VN) | (kinds == _LINE_VT)] + 1] = 32
+    chars[chars == ord('/')] = 32
+    isspace = _isspace(chars)
+    fields = np.flatnonzero(~isspace[1:] & isspace[:-1]) + 1
+    del isspace
+    counts = lambda rows: _countinrange(fields, starts[rows], ends[rows])
+
+    vcounts = counts(vrows)
+    _checkcounts(vcounts, vrows, [3, 4], 'Vertex must have 3 or 4 parameters.',
+        firstline)
+    v = _parserecords(data, starts, ends, vrows, vcounts, 4, [0, 0, 0, 1],
+        firstline)
+
+    vncounts = counts(vnrows)
+    _checkcounts(vncounts, vnrows, [3], 'Normals must have 3 parameters.',
+        firstline)
+    vn = _parserecords(data, starts, ends, vnrows, vncounts,
+        max(3, padnormals), 0, firstline)
+    norm = np.sqrt(np.sum(vn[:, :3] ** 2, axis=1))
+    invalid = np.flatnonzero(norm == 0.0)
+    if len(invalid) > 0:
+        raise _parseerror(vnrows[invalid[0]] + firstline, 'Invalid normal.')
+    vn[:, :3] /= norm[:, np.newaxis]
+
+    vtcounts = counts(vtrows)
+    _checkcounts(vtcounts, vtrows, [2, 3],
+        'Texturecoordinates must have 2 or 3 parameters.', firstline)
+    vt = _parserecords(data, starts, ends, vtrows, vtcounts,
+        max(3, padtexcoords), 0, firstline)
+
+    faces = np.zeros((0, 3), dtype=np.int64)
+    nverts = np.zeros(0, dtype=np.int64)
+    if len(frows) > 0:
+        fcounts = counts(frows)
+        # Determine the faceformat from the first face, like _f does.
+        if faceformat is None:
+            if fdoubleslashes[0] > 0:
+                faceformat = OBJFILE_FORMAT_VN
+            elif fslashes[0] == 0:
+                faceformat = OBJFILE_FORMAT_V
+            elif 3 * fslashes[0] == 2 * fcounts[0]:
+                faceformat = OBJFILE_FORMAT_VTN
+            else:
+                faceformat = OBJFILE_FORMAT_VT
+        width, columns = _FACEFORMAT_COLUMNS[faceformat]
+        nverts = fcounts // width
+        expectedslashes = {OBJFILE_FORMAT_V : 0, OBJFILE_FORMAT_VT : nverts,
+            OBJFILE_FORMAT_VN : 2 * nverts, OBJFILE_FORMAT_VTN : 2 * nverts}
+        expecteddoubles = nverts if faceformat == OBJFILE_FORMAT_VN else 0
+        bad = np.flatnonzero((fcounts % width != 0) |
+                             (fslashes != expectedslashes[faceformat]) |
+                             (fdoubleslashes != expecteddoubles))
+        if len(bad) > 0:
+            raise _parseerror(frows[bad[0]] + firstline,
+                'All faces must have the same faceformat.')
+        bad = np.flatnonzero(nverts < 3)
+        if len(bad) > 0:
+            raise _parseerror(frows[bad[0]] + firstline,
+                'A face must have at least 3 vertices.')
+        values = _parsenumbers(data, starts, ends, frows, fcounts, np.int64,
+            firstline)
+        values = values.reshape(-1, width)
+
+        # Resolve the (1-based or relative) indices. Only attributes defined
+        # before a face can be referenced by it.
+        faces = np.empty((len(values), 3), dtype=np.int64)
+        facerows = np.repeat(frows, nverts)
+        messages = ['Invalid vertex position index.',
+                    'Invalid vertex normal index.',
+                    'Invalid vertex texture coordinate index.']
+        for attr, (column, rows, offset) in enumerate(zip(columns,
+                [vrows, vnrows, vtrows], offsets)):
+            if column is None:
+                faces[:, attr] = -1
+                continue
+            index = values[:, column]
+            defined = np.searchsorted(rows, facerows) + offset
+            index = np.where(index < 0, defined + index, index - 1)
+            bad = np.flatnonzero((index < 0) | (index >= defined) |
+                                 (values[:, column] == 0))
+            if len(bad) > 0:
+                raise _parseerror(facerows[bad[0]] + firstline, messages[attr])
+            faces[:, attr] = index
+    return v, vn, vt, faces, nverts, faceformat, statements
+
+def _uniquecorners(faces):
+    '''
+    Finds the unique (v, vn, vt) triples of the (N, 3) face vertex array.
+    Returns the row of the first appearance of every unique triple (in order
+    of appearance) and the number of the unique triple for every row.
+    '''
+    # Pack every triple into one integer key (absent attributes are -1).
+    radix = faces.max(axis=0) + 2
+    if np.prod(radix.astype(np.float64)) < 2.0 ** 63:
+        keys = faces[:, 0] + 1
+        keys = keys * radix[1] + (faces[:, 1] + 1)
+        keys = keys * radix[2] + (faces[:, 2] + 1)
+    else:
+        keys = np.ascontiguousarray(faces).view(
+            np.dtype((np.void, faces.dtype.itemsize * 3))).ravel()
+    # A stable sort keeps the first appearance in front of every run.
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    isfirst = np.empty(len(keys), dtype=bool)
+    isfirst[:1] = True
+    isfirst[1:] = keys[1:] != keys[:-1]
+    del keys
+    group = np.cumsum(isfirst) - 1
+    first = order[isfirst]
+    # Renumber the triples in order of their first appearance.
+    appearance = np.argsort(first)
+    rank = np.empty_like(appearance)
+    rank[appearance] = np.arange(len(appearance))
+    index = np.empty(len(order), dtype=np.int64)
+    index[order] = rank[group]
+    return first[appearance], index
+
+def _cleanbulkfaces(v, vn, vt, faces):
+    '''
+    Generates new v/vn/vt arrays, so that every face vertex uses the same
+    index for all of its attributes. Unique (v, vn, vt) triples are numbered
+    in order of their first appearance.
+    '''
+    first, index = _uniquecorners(faces)
+    corners = faces[first]
+    v = np.asarray(v)[corners[:, 0]]
+    vn = np.asarray(vn)[corners[:, 1]] if corners[0, 1] >= 0 else vn[:0]
+    vt = np.asarray(vt)[corners[:, 2]] if corners[0, 2] >= 0 else vt[:0]
+    return v, vn, vt, index.reshape(-1, 3)
+
+def _readrange(filename, start, end):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+def _splitfile(filename, parts):
+    '''Splits the file into (at most) parts byte ranges at line boundaries.'''
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, parts):
+            pos = max(size * i // parts, bounds[-1])
+            if pos == 0:
+                continue
+            # Move to the start of the next line.
+            f.seek(pos - 1)
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+def _scanrange(args):
+    '''
+    Pool worker: Counts the v, vn and vt statements and the lines of a file
+    range.
+    '''
+    filename, start, end = args
+    data = _readrange(filename, start, end)
+    _, _, kinds = _classifylines(np.frombuffer(_normalizebuffer(data),
+                                               dtype=np.uint8))
+    counts = [np.count_nonzero(kinds == kind)
+              for kind in [_LINE_V, _LINE_VN, _LINE_VT]]
+    return counts, data.count(b'\n')
+
+def _parserange(args):
+    '''
+    Pool worker: Parses a file range in bulk mode. The attributes are written
+    into the shared arrays, the faces into an .npz file. Returns the
+    faceformat and the naming statements of the range.
+    '''
+    (filename, start, end, padnormals, padtexcoords, offsets, firstline,
+     shared, facefile) = args
+    data = _readrange(filename, start, end)
+    v, vn, vt, faces, nverts, faceformat, statements = _bulkparse(data,
+        padnormals, padtexcoords, offsets, None, firstline)
+    del data
+    for attr, offset, (path, shape) in zip([v, vn, vt], offsets, shared):
+        if len(attr) > 0:
+            out = np.memmap(path, dtype=np.float32, mode='r+', shape=shape)
+            out[offset:offset + len(attr)] = attr
+            out.flush()
+            del out
+    with open(facefile, 'wb') as f:
+        np.savez(f, faces=faces, nverts=nverts)
+    return faceformat, statements
+
+##############################################################################
+# Triangulation
+##############################################################################
+def _cross2(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+def _fan(n):
+    '''Fan triangulation of a convex polygon with n vertices.'''
+    tris = np.zeros((n - 2, 3), dtype=np.int64)
+    tris[:, 1] = np.arange(1, n - 1)
+    tris[:, 2] = np.arange(2, n)
+    return tris
+
+def _earclip(points):
+    '''
+    Ear clipping for Q (counterclockwise) 2D polygons with n vertices each,
+    given as (Q, n, 2) array. All polygons are clipped at once, one ear per
+    polygon and step. Returns (Q, n - 2, 3) vertex numbers.
+    '''
+    count, n = points.shape[:2]
+    q = np.arange(count)
+    vertex = np.arange(n)
+    prev = np.tile(np.roll(vertex, 1), (count, 1))
+    next = np.tile(np.roll(vertex, -1), (count, 1))
+    alive = np.ones((count, n), dtype=bool)
+    tris = np.empty((count, n - 2, 3), dtype=np.int64)
+    for k in range(n - 2):
+        if k < n - 3:
+            a = points[q[:, np.newaxis], prev]
+            c = points[q[:, np.newaxis], next]
+            convex = _cross2(points - a, c - points) > 0
+            # Test all vertices against the triangle of every candidate.
+            p = points[:, np.newaxis, :, :]
+            a, b, c = a[:, :, np.newaxis], points[:, :, np.newaxis], c[:, :, np.newaxis]
+            inside = ((_cross2(b - a, p - a) >= 0) &
+                      (_cross2(c - b, p - b) >= 0) &
+                      (_cross2(a - c, p - c) >= 0))
+            other = (alive[:, np.newaxis, :] &
+                     (vertex != vertex[:, np.newaxis]) &
+                     (vertex != prev[:, :, np.newaxis]) &
+                     (vertex != next[:, :, np.newaxis]))
+            ear = alive & convex & ~np.any(inside & other, axis=2)
+            # Degenerated polygons may have no ear, take any vertex then.
+            ear = np.where(np.any(ear, axis=1)[:, np.newaxis], ear, alive)
+        else:
+            ear = alive
+        i = np.argmax(ear, axis=1)
+        pi, ni = prev[q, i], next[q, i]
+        tris[:, k, 0], tris[:, k, 1], tris[:, k, 2] = pi, i, ni
+        alive[q, i] = False
+        next[q, pi] = ni
+        prev[q, ni] = pi
+    return tris
+
+def _triangulatepolygons(points):
+    '''
+    Triangulates P polygons with n vertices each, given as (P, n, 3) array of
+    positions. Convex polygons are fan triangulated, concave ones are
+    triangulated by ear clipping. Returns (P, n - 2, 3) vertex numbers within
+    the polygons, the winding of the polygons is kept.
+    '''
+    count, n = points.shape[:2]
+    tris = np.empty((count, n - 2, 3), dtype=np.int64)
+    tris[:] = _fan(n)
+    if n == 3:
+        return tris
+    points = np.asarray(points, dtype=np.float64)
+    # Project the polygons onto their plane, so that they are
+    # counterclockwise. The plane normal is determined by Newell's method.
+    normal = np.cross(points, np.roll(points, -1, axis=1)).sum(axis=1)
+    helper = np.eye(3)[np.argmin(np.abs(normal), axis=1)]
+    u = np.cross(normal, helper)
+    v = np.cross(normal, u)
+    projected = np.empty((count, n, 2))
+    projected[..., 0] = np.einsum('pnk,pk->pn', points, u)
+    projected[..., 1] = np.einsum('pnk,pk->pn', points, v)
+    edges = projected - np.roll(projected, 1, axis=1)
+    turns = _cross2(edges, np.roll(edges, -1, axis=1))
+    concave = np.any(turns < 0, axis=1) & np.any(normal != 0, axis=1)
+    if np.any(concave):
+        tris[concave] = _earclip(projected[concave])
+    return tris
+
+def _triangulate(v, faces, nverts, voffset = 0):
+    '''
+    Triangulates the polygons of the (N, 3) face vertex array, nverts holds
+    the number of vertices of each polygon. Polygons of the same size are
+    processed at once and the order of the faces is kept. Polygons using
+    positions before voffset (i.e. not in v) are fan triangulated.
+    '''
+    if np.all(nverts == 3):
+        return faces
+    ntris = nverts - 2
+    starts = np.cumsum(nverts) - nverts
+    tristarts = np.cumsum(ntris) - ntris
+    rows = np.empty((ntris.sum(), 3), dtype=np.int64)
+    for n in np.unique(nverts):
+        polygons = np.flatnonzero(nverts == n)
+        corners = starts[polygons, np.newaxis] + np.arange(n)
+        tris = np.empty((len(polygons), n - 2, 3), dtype=np.int64)
+        tris[:] = _fan(n)
+        positions = faces[corners, 0] - voffset
+        known = np.all(positions >= 0, axis=1)
+        if n > 3 and np.any(known):
+            tris[known] = _triangulatepolygons(v[positions[known], :3])
+        tris = corners[np.arange(len(polygons))[:, np.newaxis, np.newaxis],
+                       tris]
+        rows[tristarts[polygons, np.newaxis] + np.arange(n - 2)] = tris
+    return faces[rows.reshape(-1)]
+
+##############################################################################
+# Normals
+##############################################################################
+def _splitsmoothing(f, smoothing):
+    '''
+    Splits the vertices of the triangles f (N, 3) shared by different
+    smoothing groups (0 for flat triangles, which get vertices of their
+    own). Returns the original vertex of every new vertex and the new f.
+    '''
+    corners = f.reshape(-1)
+    groups = np.repeat(smoothing, 3)
+    flat = np.flatnonzero(groups == 0)
+    groups = groups - groups.min() + 1
+    groups[flat] = groups.max() + 1 + np.arange(len(flat))
+    first, index = _uniquecorners(np.stack([corners, groups,
+        np.zeros(len(corners), dtype=np.int64)], axis=1))
+    return corners[first], index.reshape(-1, 3)
+
+def _vertexnormals(v, f, nverts, weighting):
+    '''
+    Computes the vertex normals of the triangles f (N, 3) as sum of their
+    face normals, weighted by the face area or the angle at the vertex.
+    '''
+    p = np.asarray(v, dtype=np.float64)[:, :3]
+    a, b, c = p[f[:, 0]], p[f[:, 1]], p[f[:, 2]]
+    # The cross product is the normal scaled by twice the area.
+    normals = np.cross(b - a, c - a)
+    if weighting == NORMALS_ANGLE:
+        normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-30)[:, np.newaxis]
+        weights = []
+        for x, y, z in ((a, b, c), (b, c, a), (c, a, b)):
+            e1, e2 = y - x, z - x
+            cos = (e1 * e2).sum(axis=1) / np.maximum(np.linalg.norm(e1, axis=1) *
+                                                     np.linalg.norm(e2, axis=1), 1e-30)
+            weights.append(np.arccos(np.clip(cos, -1, 1)))
+        weights = np.stack(weights, axis=1).reshape(-1)
+    elif weighting == NORMALS_AREA:
+        weights = np.ones(3 * len(f))
+    else:
+        raise Exception, 'Unknown normal weighting %s.' % weighting
+    corners = f.reshape(-1)
+    cornernormals = np.repeat(normals, 3, axis=0) * weights[:, np.newaxis]
+    n = np.stack([np.bincount(corners, cornernormals[:, i], minlength=nverts)
+                  for i in range(3)], axis=1)
+    length = np.linalg.norm(n, axis=1)
+    # Vertices without (proper) faces get an arbitrary unit normal.
+    n[length == 0] = [0, 0, 1]
+    length[length == 0] = 1
+    return (n / length[:, np.newaxis]).astype(np.float32)
+
+##############################################################################
+# Vertex formats
+#
+# generateIndexedBuffer can quantize the attributes to smaller types. Every
+# format has an encoder, that turns the (N, width) float attribute into an
+# (N, components) array of its type, and the GL type and normalized flag for
+# glVertexAttribPointer. snorm16/unorm16 map the bounding range of the
+# attribute to [-1, 1]/[0, 1], see ObjFileParser.dequantization.
+##############################################################################
+VERTEX_FLOAT32 = 'float32'
+VERTEX_HALF = 'half'
+VERTEX_SNORM16 = 'snorm16'
+VERTEX_UNORM16 = 'unorm16'
+VERTEX_OCT16 = 'oct16'
+VERTEX_INT_2_10_10_10 = 'int2_10_10_10'
+
+_GL_SHORT = 0x1402
+_GL_UNSIGNED_SHORT = 0x1403
+_GL_UNSIGNED_INT = 0x1405
+_GL_FLOAT = 0x1406
+_GL_HALF_FLOAT = 0x140B
+_GL_INT_2_10_10_10_REV = 0x8D9F
+
+def _padeven(q):
+    # Pads 16 bit attributes to a multiple of 4 bytes.
+    if q.shape[1] % 2:
+        q = np.hstack([q, np.zeros((len(q), 1), dtype=q.dtype)])
+    return q
+
+def _encodefloat32(a, lo, hi):
+    return a
+
+def _encodehalf(a, lo, hi):
+    return _padeven(a.astype(np.float16))
+
+def _encodesnorm16(a, lo, hi):
+    n = (a - 0.5 * (lo + hi)) / np.where(hi > lo, 0.5 * (hi - lo), 1)
+    return _padeven(np.round(np.clip(n, -1, 1) * 32767).astype(np.int16))
+
+def _encodeunorm16(a, lo, hi):
+    n = (a - lo) / np.where(hi > lo, hi - lo, 1)
+    return _padeven(np.round(np.clip(n, 0, 1) * 65535).astype(np.uint16))
+
+def _encodeoct16(a, lo, hi):
+    # Octahedral normal encoding. The shader decodes e (the two snorms) with
+    #   vec3 n = vec3(e, 1.0 - abs(e.x) - abs(e.y));
+    #   if (n.z < 0.0) n.xy = (1.0 - abs(n.yx)) * (step(0.0, n.xy) * 2.0 - 1.0);
+    #   n = normalize(n);
+    n = a[:, :3] / np.maximum(np.abs(a[:, :3]).sum(axis=1), 1e-30)[:, np.newaxis]
+    e = n[:, :2].copy()
+    below = n[:, 2] < 0
+    sign = np.where(e[below] >= 0, 1.0, -1.0)
+    e[below] = (1 - np.abs(e[below][:, ::-1])) * sign
+    return np.round(np.clip(e, -1, 1) * 32767).astype(np.int16)
+
+def _encodeint2101010(a, lo, hi):
+    q = np.round(np.clip(a[:, :3], -1, 1) * 511).astype(np.int64) & 0x3FF
+    packed = q[:, 0] | (q[:, 1] << 10) | (q[:, 2] << 20)
+    return packed.astype(np.uint32)[:, np.newaxis]
+
+# Encoder, GL type and normalized flag of the formats.
+_VERTEX_FORMATS = {
+    VERTEX_FLOAT32 : (_encodefloat32, _GL_FLOAT, False),
+    VERTEX_HALF : (_encodehalf, _GL_HALF_FLOAT, False),
+    VERTEX_SNORM16 : (_encodesnorm16, _GL_SHORT, True),
+    VERTEX_UNORM16 : (_encodeunorm16, _GL_UNSIGNED_SHORT, True),
+    VERTEX_OCT16 : (_encodeoct16, _GL_SHORT, True),
+    VERTEX_INT_2_10_10_10 : (_encodeint2101010, _GL_INT_2_10_10_10_REV, True),
+}
+
+# Components used of the attributes, if they are quantized.
+_QUANTIZED_COMPONENTS = {'v' : 3, 'vn' : 3, 'vt' : 2}
 
 class ObjFileParser(object):
     """
     Parser for Wavefront Obj. Files.
-    Supports v, vn, vt and f statements for now. Other statements are ignored.
+    Supports v, vn, vt, f, usemtl, mtllib, o, g and s statements for now.
+    Other statements are ignored.
+    
+    The triangles are grouped by material: materialranges lists (material
+    name, first index, index count) for every used material (None for faces
+    without one) in order of first use, so each material is drawn with one
+    call. materials maps the names to the Material objects of the mtllib
+    files, which are loaded through a MaterialCache (missing files are
+    skipped). o and g map the object and group names to lists of (first
+    index, index count) ranges.
+    
+    If the file has no normals and normals is NORMALS_AREA or NORMALS_ANGLE,
+    they are generated (see generatenormals), honoring the smoothing groups.
+    
+    With bulk=True the file is parsed in one vectorized pass. v, vn and vt
+    are then float32 arrays with one row per vertex and f is an (N, 3)
+    integer array instead of a list of faces. With processes other than 1,
+    the file is split into that many parts, which are parsed in bulk mode by
+    a pool of processes (None uses one process per CPU).
     """
-    def __init__(self, filename, padnormals = 4, padtexcoords = 4):
+    def __init__(self, filename, padnormals = 4, padtexcoords = 4,
+                 bulk = False, processes = 1, materialcache = None,
+                 normals = None):
         self.padnormals = padnormals
         self.padtexcoords = padtexcoords
         self.v = []
@@ -63,13 +696,77 @@ class ObjFileParser(object):
             'vt' : self._vt,
             'f' : self._f,
             'vp' : self._vp,
-#            'o' : self._o,
-#            'g' : self._g
+            'usemtl' : self._usemtl,
+            'mtllib' : self._mtllib,
+            'o' : self._o,
+            'g' : self._g,
+            's' : self._s
         }
         
         self.allfacesclean = True
+        self.allfacestriangles = True
         self.faceformat = None
+        self.facesizes = None
+        self.statements = dict((keyword, ([], []))
+                               for keyword, _ in _NAMING_STATEMENTS)
         
+        if processes != 1:
+            self._parseparallel(filename, processes)
+        elif bulk:
+            self._parsebulk(filename)
+        else:
+            self._parselines(filename, handlers)
+            self.facesizes = np.array([len(face) for face in self.f],
+                                      dtype=np.int64)
+        
+        if not self.allfacestriangles:
+            self._triangulatefaces()
+        del self.allfacestriangles
+        if not self.allfacesclean:
+            self._cleanfaces()
+        del self.allfacesclean
+        order = self._groupfaces(os.path.dirname(filename), materialcache)
+        if normals is not None and not self.hasnormals():
+            self.generatenormals(normals, self._smoothinggroups(order))
+        del self.facesizes, self.statements
+        # Determine the BB
+        self.minpos = np.amin(self.v, axis=0)[:3]
+        self.maxpos = np.amax(self.v, axis=0)[:3]
+        self.scale = self.maxpos - self.minpos
+        
+    @classmethod
+    def fromarrays(cls, v, vn, vt, f, faceformat, padnormals = 4,
+                   padtexcoords = 4, minpos = None, maxpos = None,
+                   materialranges = None, mtllibs = (), o = None, g = None,
+                   materialcache = None):
+        """
+        Creates a parser object from already parsed (clean) data, e.g. loaded
+        from a cache. The bounding box is computed if not given, without
+        materialranges all triangles are in one range without material.
+        """
+        self = cls.__new__(cls)
+        self.padnormals = padnormals
+        self.padtexcoords = padtexcoords
+        self.v, self.vn, self.vt, self.f = v, vn, vt, f
+        self.o = dict((name, [tuple(r) for r in ranges])
+                      for name, ranges in (o or {}).items())
+        self.g = dict((name, [tuple(r) for r in ranges])
+                      for name, ranges in (g or {}).items())
+        if materialranges is None:
+            materialranges = [(None, 0, 3 * len(f))] if len(f) > 0 else []
+        self.materialranges = [tuple(r) for r in materialranges]
+        self.mtllibs = list(mtllibs)
+        self._loadmaterials(materialcache)
+        self.faceformat = faceformat
+        if minpos is None or maxpos is None:
+            minpos = np.amin(self.v, axis=0)[:3]
+            maxpos = np.amax(self.v, axis=0)[:3]
+        self.minpos = minpos
+        self.maxpos = maxpos
+        self.scale = self.maxpos - self.minpos
+        return self
+        
+    def _parselines(self, filename, handlers):
         with open(filename, 'r') as f:
             i = 0
             for line in f:
@@ -80,19 +777,89 @@ class ObjFileParser(object):
                 if len(line) > 0:
                     if line[0] in handlers:
                         try:
-                            handlers[line[0]](line[1])
+                            # Naming statements may come without a name.
+                            handlers[line[0]](line[1] if len(line) > 1 else '')
                         except Exception as e:
                             raise Exception, 'Parsing error at line %i: %s' % (i, e)
+    
+    def _parsebulk(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        (v, vn, vt, faces, nverts, self.faceformat,
+         self.statements) = _bulkparse(data, self.padnormals, self.padtexcoords)
+        self._setbulkdata(v, vn, vt, faces, nverts)
+    
+    def _parseparallel(self, filename, processes):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        tmpdir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm')
+                                  else None)
+        try:
+            ranges = _splitfile(filename, processes)
+            # First pass: Count the statements to get the global offsets and
+            # line numbers of the parts.
+            scans = pool.map(_scanrange, [(filename, start, end)
+                                          for start, end in ranges])
+            counts = np.array([count for count, _ in scans], dtype=np.int64)
+            offsets = np.cumsum(counts, axis=0) - counts
+            firstlines = np.cumsum([0] + [lines for _, lines in scans]) + 1
+            
+            # The attribute arrays are shared with the workers via memory
+            # mapped files, every part writes its rows into them.
+            widths = [4, max(3, self.padnormals), max(3, self.padtexcoords)]
+            shared = []
+            for name, total, width in zip(['v', 'vn', 'vt'],
+                                          counts.sum(axis=0), widths):
+                path = os.path.join(tmpdir, name)
+                if total > 0:
+                    np.memmap(path, dtype=np.float32, mode='w+',
+                              shape=(total, width)).flush()
+                shared.append((path, (total, width)))
+            
+            tasks = [(filename, start, end, self.padnormals, self.padtexcoords,
+                      tuple(offsets[i]), firstlines[i], shared,
+                      os.path.join(tmpdir, 'faces%i.npz' % i))
+                     for i, (start, end) in enumerate(ranges)]
+            results = pool.map(_parserange, tasks)
+            
+            attrs = []
+            for path, shape in shared:
+                if shape[0] > 0:
+                    attrs.append(np.array(np.memmap(path, dtype=np.float32,
+                                                    mode='r', shape=shape)))
+                else:
+                    attrs.append(np.zeros(shape, dtype=np.float32))
+            faces = [np.load(task[-1]) for task in tasks]
+            nverts = [part['nverts'] for part in faces]
+            faces = np.concatenate([part['faces'] for part in faces])
+        finally:
+            pool.terminate()
+            shutil.rmtree(tmpdir, True)
         
-        if not self.allfacesclean:
-            self._cleanfaces()
-        del self.allfacesclean
-        # Determine the BB
-        self.minpos = np.amin(self.v, axis=0)[:3]
-        self.maxpos = np.amax(self.v, axis=0)[:3]
-        self.scale = self.maxpos - self.minpos
-        
-        
+        # The statement positions are relative to the faces of their part.
+        facecounts = np.cumsum([0] + [len(n) for n in nverts])
+        for (_, statements), offset in zip(results, facecounts):
+            for keyword, (positions, names) in statements.items():
+                self.statements[keyword][0].extend(p + offset for p in positions)
+                self.statements[keyword][1].extend(names)
+        nverts = np.concatenate(nverts)
+        faceformats = set(f for f, _ in results if f is not None)
+        if len(faceformats) > 1:
+            raise Exception, 'Parsing error: All faces must have the same faceformat.'
+        self.faceformat = faceformats.pop() if faceformats else None
+        self._setbulkdata(attrs[0], attrs[1], attrs[2], faces, nverts)
+    
+    def _setbulkdata(self, v, vn, vt, faces, nverts):
+        self.facesizes = nverts
+        faces = _triangulate(v, faces, nverts)
+        clean = np.all((faces[:, 1:] < 0) | (faces[:, 1:] == faces[:, :1]))
+        if clean:
+            self.v, self.vn, self.vt = v, vn, vt
+            self.f = faces[:, 0].reshape(-1, 3).astype(np.int32)
+        else:
+            self.v, self.vn, self.vt, f = _cleanbulkfaces(v, vn, vt, faces)
+            self.f = f.astype(np.int32)
     
     def _v(self, args):
         args = args.split()
@@ -133,51 +900,44 @@ class ObjFileParser(object):
         self.vt.append(vt)
     
     def _f(self, args):
-        # TODO: The whole thing is a mess. REDO IT!
         args = args.split()
         if len(args) < 3:
             raise Exception, 'A face must have at least 3 vertices.'
-        if len(args) > 3:
-            raise NotImplementedError, 'More than 4 vertices not supported yet.'
-        # Determine the faceformat and split it.
-        faceformat = None
-        face = []
+        # Determine the faceformat from the first vertex.
         if '//' in args[0]:
             faceformat = OBJFILE_FORMAT_VN
-            for arg in args:
-                arg = arg.split('//')
-                face.append((int(arg[0])-1, int(arg[1])-1, None))
-        else:
-            if '/' in args[0]:
-                args = [arg.split('/') for arg in args]
-                if len(args[0]) == 3:
-                    faceformat = OBJFILE_FORMAT_VTN
-                    for arg in args:                        
-                        face.append((int(arg[0])-1, int(arg[2])-1, int(arg[1])-1))
-                else:
-                    faceformat = OBJFILE_FORMAT_VT
-                    for arg in args:
-                        face.append((int(arg[0])-1, None, int(arg[1])-1))                    
+        elif '/' in args[0]:
+            if args[0].count('/') == 2:
+                faceformat = OBJFILE_FORMAT_VTN
             else:
-                faceformat = OBJFILE_FORMAT_V
-                for arg in args:
-                    face.append((int(arg)-1, None, None))
-                
-            
+                faceformat = OBJFILE_FORMAT_VT
+        else:
+            faceformat = OBJFILE_FORMAT_V
+        
         # Check faceformat.
         if self.faceformat != None and faceformat != self.faceformat:
             raise Exception, 'All faces must have the same faceformat.'
         else:
             self.faceformat = faceformat
         
-        # Check if all indices are valid.
-        for v in face:
-            if v[0] >= len(self.v):
-                raise Exception, 'Invalid vertex position index.'
-            if v[1] >= 0 and v[1] >= len(self.vn):
-                raise Exception, 'Invalid vertex normal index.'
-            if v[2] >= 0 and v[2] >= len(self.vt):
-                raise Exception, 'Invalid vertex texture coordinate index.'
+        # Resolve the (1-based or relative) indices, like _bulkparse.
+        args = [arg.split('/') for arg in args]
+        size = (3 if faceformat & OBJFILE_FORMAT_N_BIT else
+                2 if faceformat & OBJFILE_FORMAT_T_BIT else 1)
+        if any(len(arg) != size for arg in args):
+            raise Exception, 'All faces must have the same faceformat.'
+        face = []
+        for arg in args:
+            v = _faceindex(arg[0], len(self.v),
+                           'Invalid vertex position index.')
+            vn = vt = None
+            if faceformat & OBJFILE_FORMAT_N_BIT:
+                vn = _faceindex(arg[-1], len(self.vn),
+                                'Invalid vertex normal index.')
+            if faceformat & OBJFILE_FORMAT_T_BIT:
+                vt = _faceindex(arg[1], len(self.vt),
+                                'Invalid vertex texture coordinate index.')
+            face.append((v, vn, vt))
         
         # Check if all the indices are the same.
         cleanface = []
@@ -189,108 +949,720 @@ class ObjFileParser(object):
             else:
                 self.allfacesclean = False
             cleanface.append(vert)
-            
+        
+        if len(cleanface) > 3:
+            self.allfacestriangles = False
         self.f.append(cleanface)
                 
     def _vp(self, args):
         raise NotImplementedError, 'Parameter space not implemented.'
         
+    def _statement(self, keyword, args):
+        positions, names = self.statements[keyword]
+        positions.append(len(self.f))
+        names.append(args.strip())
+    
+    def _usemtl(self, args):
+        self._statement('usemtl', args)
+    
+    def _mtllib(self, args):
+        self._statement('mtllib', args)
+    
     def _o(self, args):
-        position = len(self.f)
-        self.o[args] = position
+        self._statement('o', args)
         
     def _g(self, args):
-        position = len(self.f)
-        self.g[args] = position
+        self._statement('g', args)
+    
+    def _s(self, args):
+        self._statement('s', args)
+    
+    def _faceids(self, keyword):
+        '''
+        Returns the names of the statement and the number of the name for
+        every triangle (-1 before the first statement).
+        '''
+        positions, names = self.statements[keyword]
+        unique = sorted(set(names), key=names.index)
+        numbers = np.array([unique.index(name) for name in names] + [-1],
+                           dtype=np.int64)
+        faces = np.arange(len(self.facesizes))
+        ids = numbers[np.searchsorted(positions, faces, side='right') - 1]
+        return unique, np.repeat(ids, np.maximum(self.facesizes - 2, 0))
+    
+    def _groupfaces(self, directory, materialcache):
+        '''
+        Sorts the triangles by material (stable) and builds the material,
+        object and group ranges. Loads the material libraries. Returns the
+        order of the triangles.
+        '''
+        names, materialids = self._faceids('usemtl')
+        order = np.argsort(materialids, kind='mergesort')
+        if np.any(np.diff(materialids) < 0):
+            if isinstance(self.f, list):
+                self.f = [self.f[i] for i in order]
+            else:
+                self.f = self.f[order]
+            materialids = materialids[order]
+        self.materialranges = [(names[i] if i >= 0 else None, 3 * first,
+                                3 * count) for i, first, count in
+                               zip(*_runs(materialids))]
+        for keyword in ('o', 'g'):
+            names, ids = self._faceids(keyword)
+            ranges = {}
+            for i, first, count in zip(*_runs(ids[order])):
+                if i >= 0:
+                    ranges.setdefault(names[i], []).append((3 * first,
+                                                            3 * count))
+            setattr(self, keyword, ranges)
+        self.mtllibs = [os.path.join(directory, name)
+                        for names in self.statements['mtllib'][1]
+                        for name in names.split()]
+        self._loadmaterials(materialcache)
+        return order
+    
+    def _loadmaterials(self, materialcache):
+        if materialcache is None:
+            materialcache = defaultmaterialcache
+        self.materials = {}
+        for filename in self.mtllibs:
+            if os.path.isfile(filename):
+                self.materials.update(materialcache.load(filename))
+        
+    def _triangulatefaces(self):
+        """
+        Replaces all polygons by triangles. Polygons with the same number of
+        vertices are triangulated at once.
+        """
+        v = np.asarray(self.v, dtype=np.float32)
+        nverts = np.array([len(face) for face in self.f])
+        triangles = [[face] for face in self.f]
+        for n in np.unique(nverts[nverts > 3]):
+            polygons = np.flatnonzero(nverts == n)
+            positions = np.array([[vert[0] if isinstance(vert, tuple) else vert
+                                   for vert in self.f[i]] for i in polygons])
+            tris = _triangulatepolygons(v[positions, :3])
+            for i, polygontris in zip(polygons, tris.tolist()):
+                face = self.f[i]
+                triangles[i] = [[face[c] for c in tri] for tri in polygontris]
+        self.f = [tri for tris in triangles for tri in tris]
         
     def _cleanfaces(self):
         """
         Cleans up all the faces by generating new v/vn/vt/f buffers.
         The code simply finds all unique face edges and generates the
         appropriate v/vn/vt and a new f. The reasoning behind this is, that
-        OpenGL needs all the 
+        OpenGL needs all the attributes of a vertex at the same index.
         """
-        nv, nvn, nvt, nf = [], [], [], []
-        cleanedverts = {}
-        
         # V format doesn't need to be cleaned!
-        def addvn(vert):
-            nv.append(self.v[vert[0]])
-            nvn.append(self.vn[vert[1]])
-        def addvt(vert):
-            nv.append(self.v[vert[0]])
-            nvt.append(self.vt[vert[2]])
-        def addvtn(vert):
-            nv.append(self.v[vert[0]])
-            nvn.append(self.vn[vert[1]])
-            nvt.append(self.vt[vert[2]])            
-        
-        addvert = None
-        if self.faceformat == OBJFILE_FORMAT_VN:
-            addvert = addvn
-        elif self.faceformat == OBJFILE_FORMAT_VT:
-            addvert = addvt
-        elif self.faceformat == OBJFILE_FORMAT_VTN:
-            addvert = addvtn
-        
-        for face in self.f:
-            newface = []
-            for oldvert in face:
-                if oldvert not in cleanedverts:
-                    i = len(nv)
-                    if isinstance(oldvert, int):
-                        oldvert = (oldvert, oldvert, oldvert)
-                    addvert(oldvert)
-                    cleanedverts[oldvert] = i
-                    newvert = i
-                else:
-                    newvert = cleanedverts[oldvert]
-                newface.append(newvert)
-            nf.append(newface)    
-        
-        self.v, self.vn, self.vt, self.f = nv, nvn, nvt, nf
+        _, columns = _FACEFORMAT_COLUMNS[self.faceformat]
+        # Absent attributes (None) become NaN and then -1.
+        faces = np.array([vert if isinstance(vert, tuple) else
+                          (vert, vert, vert) for face in self.f for vert in face],
+                         dtype=np.float64)
+        faces[np.isnan(faces)] = -1
+        faces = faces.astype(np.int64)
+        for attr, column in enumerate(columns):
+            if column is None:
+                faces[:, attr] = -1
+        self.v, self.vn, self.vt, f = _cleanbulkfaces(self.v, self.vn,
+            self.vt, faces)
+        self.f = f.astype(np.int32)
                 
     def hasnormals(self):
-        return self.faceformat & OBJFILE_FORMAT_N_BIT > 0
+        return self.faceformat is not None and \
+            self.faceformat & OBJFILE_FORMAT_N_BIT > 0
         
     def hastexturecoords(self):
-        return self.faceformat & OBJFILE_FORMAT_T_BIT > 0
-        
-    def generateIndexedBuffer(self, layout = [0,1], itype = None):
+        return self.faceformat is not None and \
+            self.faceformat & OBJFILE_FORMAT_T_BIT > 0
+    
+    def generatenormals(self, weighting = NORMALS_ANGLE, smoothing = None):
         """
-        Generates a VBO and IBO for OpenGL.
-        
-        Arguments:
-        layout -- layout for the vertex-attributes. list of integers with 0=pos, 1=normal, 2=texcoord
-        itype -- numpy type for IBO (determines the minimum required type if None)
+        Generates vertex normals from the faces, replacing vn. The face
+        normals are weighted by area (NORMALS_AREA) or by the angle at the
+        vertex (NORMALS_ANGLE). smoothing optionally holds the smoothing group
+        of every triangle (0 = flat shaded); vertices shared by different
+        groups are split.
         """
-        # Build the vertices buffer by simply concatenating data:
-        vertices = []
+        f = np.asarray(self.f, dtype=np.int64).reshape(-1, 3)
+        v = np.asarray(self.v, dtype=np.float32)
+        vt = np.asarray(self.vt, dtype=np.float32)
+        if smoothing is not None and len(f) > 0:
+            smoothing = np.asarray(smoothing, dtype=np.int64)
+            if np.any(smoothing != smoothing[0]) or smoothing[0] == 0:
+                vertices, f = _splitsmoothing(f, smoothing)
+                v = v[vertices]
+                if len(vt) > 0:
+                    vt = vt[vertices]
+        normals = _vertexnormals(v, f, len(v), weighting)
+        vn = np.zeros((len(v), max(3, self.padnormals)), dtype=np.float32)
+        vn[:, :3] = normals
+        self.v, self.vn, self.vt = v, vn, vt
+        self.f = f.astype(np.int32)
+        if self.faceformat in (None, OBJFILE_FORMAT_V):
+            self.faceformat = OBJFILE_FORMAT_VN
+        elif self.faceformat == OBJFILE_FORMAT_VT:
+            self.faceformat = OBJFILE_FORMAT_VTN
+    
+    def _smoothinggroups(self, order):
+        # Smoothing group of every triangle (0 = off) in the given order.
+        names, ids = self._faceids('s')
+        numbers = np.array([0 if name in ('off', '0') else i + 1
+                            for i, name in enumerate(names)] + [len(names) + 1],
+                           dtype=np.int64)
+        return numbers[ids[order]]
+        
+    def _attributes(self):
+        # Attributes as indexed by the layout of generateIndexedBuffer.
         attr = [self.v]
         if len(self.vn) > 0:
             attr.append(self.vn)
         if len(self.vt) > 0:
             attr.append(self.vt)
-        
-        for vertex in zip(*attr):
-            vertexdata = []
-            for attr in layout:
-                vertexdata.append(vertex[attr])
-            vertices.append(np.concatenate(vertexdata))
-        vertexbuffer = np.concatenate(vertices)
-        
+        return [np.asarray(a, dtype=np.float32) for a in attr]
+    
+    def _attributenames(self):
+        return ['v'] + [name for name in ('vn', 'vt')
+                        if len(getattr(self, name)) > 0]
+    
+    def _attributerange(self, a, attr):
+        # Bounding range of the quantized components of an attribute.
+        if a == 0:
+            return self.minpos, self.maxpos
+        data = attr[a][:, :_QUANTIZED_COMPONENTS[self._attributenames()[a]]]
+        return data.min(axis=0), data.max(axis=0)
+    
+    def _encodings(self, layout, formats):
+        # The encoded (N, components) arrays of the attributes in layout.
+        attr = self._attributes()
+        names = self._attributenames()
+        if formats is None:
+            formats = [VERTEX_FLOAT32] * len(layout)
+        nverts = min(len(x) for x in attr)
+        encoded = []
+        for a, fmt in zip(layout, formats):
+            if fmt not in _VERTEX_FORMATS:
+                raise Exception, 'Unknown vertex format %s.' % fmt
+            data = attr[a][:nverts]
+            lo = hi = None
+            if fmt != VERTEX_FLOAT32:
+                data = data[:, :_QUANTIZED_COMPONENTS[names[a]]]
+            if fmt in (VERTEX_SNORM16, VERTEX_UNORM16):
+                lo, hi = self._attributerange(a, attr)
+            encoded.append(_VERTEX_FORMATS[fmt][0](data, lo, hi))
+        return encoded
+    
+    def vertexFormat(self, layout = [0,1], formats = None):
+        """
+        Describes the vertices generateIndexedBuffer creates for the layout
+        and formats. Returns the stride in bytes and a list of (components,
+        GL type, normalized, offset) for glVertexAttribPointer, one per
+        attribute in layout.
+        """
+        if formats is None:
+            formats = [VERTEX_FLOAT32] * len(layout)
+        attr = self._attributes()
+        names = self._attributenames()
+        result = []
+        offset = 0
+        for a, fmt in zip(layout, formats):
+            if fmt not in _VERTEX_FORMATS:
+                raise Exception, 'Unknown vertex format %s.' % fmt
+            encoder, gltype, normalized = _VERTEX_FORMATS[fmt]
+            if fmt == VERTEX_FLOAT32:
+                width = attr[a].shape[1]
+            else:
+                width = _QUANTIZED_COMPONENTS[names[a]]
+            sample = encoder(np.zeros((1, width), dtype=np.float32),
+                             np.zeros(width), np.ones(width))
+            components = {VERTEX_OCT16 : 2,
+                          VERTEX_INT_2_10_10_10 : 4}.get(fmt, width)
+            result.append((components, gltype, normalized, offset))
+            offset += sample.nbytes
+        return offset, result
+    
+    def dequantization(self, layout = [0,1], formats = None):
+        """
+        Returns the (scale, offset) to decode each attribute in layout with
+        value = scale * stored + offset in the shader, where stored is the
+        attribute as fetched by GL (normalized to [-1, 1]/[0, 1] for
+        snorm16/unorm16). Attributes without a range use scale 1, offset 0.
+        """
+        if formats is None:
+            formats = [VERTEX_FLOAT32] * len(layout)
+        attr = self._attributes()
+        names = self._attributenames()
+        result = []
+        for a, fmt in zip(layout, formats):
+            width = _QUANTIZED_COMPONENTS[names[a]]
+            lo, hi = self._attributerange(a, attr)
+            lo, hi = np.asarray(lo, dtype=np.float32), np.asarray(hi, dtype=np.float32)
+            extent = np.where(hi > lo, hi - lo, 1).astype(np.float32)
+            if fmt == VERTEX_SNORM16:
+                result.append((0.5 * extent, 0.5 * (lo + hi)))
+            elif fmt == VERTEX_UNORM16:
+                result.append((extent, lo))
+            else:
+                result.append((np.ones(width, dtype=np.float32),
+                               np.zeros(width, dtype=np.float32)))
+        return result
+    
+    def _indextype(self, itype):
+        # uint8 indices are poorly supported by hardware, so they are only
+        # used if asked for.
         if itype == None:
-            if len(self.v) < 256:
-                itype = np.uint8
-            elif len(self.v) < 65536:
+            if len(self.v) < 65536:
                 itype = np.uint16
             else:
                 itype = np.uint32
-            
-        indexbuffer = np.zeros(len(self.f) * 3, dtype=itype)
-        i = 0
-        for face in self.f:
-            for vert in face:
-                indexbuffer[i] = vert
+        return np.dtype(itype)
+    
+    def indexedBufferSize(self, layout = [0,1], itype = None, formats = None):
+        """
+        Returns the size in bytes of the VBO and IBO generateIndexedBuffer
+        would create, e.g. to allocate a GL buffer to write them into.
+        """
+        stride, _ = self.vertexFormat(layout, formats)
+        nverts = min(len(a) for a in self._attributes())
+        nindices = len(self.f) * 3
+        return (nverts * stride,
+                nindices * self._indextype(itype).itemsize)
+        
+    def generateIndexedBuffer(self, layout = [0,1], itype = None,
+                              vertexbuffer = None, indexbuffer = None,
+                              formats = None):
+        """
+        Generates a VBO and IBO for OpenGL.
+        
+        Arguments:
+        layout -- layout for the vertex-attributes. list of integers with 0=pos, 1=normal, 2=texcoord
+        itype -- numpy type for IBO (determines the minimum required type if None)
+        vertexbuffer, indexbuffer -- optional writable buffers (e.g. a
+            bytearray or a mapped GL buffer) to write the data into. See
+            indexedBufferSize for the required sizes.
+        formats -- optional list of vertex formats (VERTEX_*) per attribute
+            in layout, to quantize the attributes. See vertexFormat and
+            dequantization for the GL attribute setup and decoding.
+        
+        Returns the vertex and index buffer as flat numpy arrays (views of
+        the given buffers if any). The vertex buffer is float32 without
+        formats and uint8 with them.
+        """
+        itype = self._indextype(itype)
+        stride, _ = self.vertexFormat(layout, formats)
+        nverts = min(len(a) for a in self._attributes())
+        nindices = len(self.f) * 3
+        
+        if formats is None:
+            vertexbuffer = _outbuffer(vertexbuffer, np.float32, nverts * stride // 4)
+        else:
+            vertexbuffer = _outbuffer(vertexbuffer, np.uint8, nverts * stride)
+        indexbuffer = _outbuffer(indexbuffer, itype, nindices)
+        
+        self._vertexbytes(layout, formats,
+                          vertexbuffer.view(np.uint8).reshape(nverts, stride))
+        indexbuffer[:] = np.asarray(self.f).reshape(-1)
+        return vertexbuffer, indexbuffer
+    
+    def _vertexbytes(self, layout, formats, vertices = None):
+        '''
+        Returns the encoded vertices as (N, stride) bytes, written into the
+        given vertices array if any. The attributes are interleaved with one
+        strided write per attribute.
+        '''
+        stride, attributes = self.vertexFormat(layout, formats)
+        nverts = min(len(a) for a in self._attributes())
+        if vertices is None:
+            vertices = np.empty((nverts, stride), dtype=np.uint8)
+        for data, (_, _, _, offset) in zip(self._encodings(layout, formats),
+                                           attributes):
+            width = data.shape[1] * data.itemsize
+            vertices[:, offset:offset + width] = np.ascontiguousarray(
+                data).view(np.uint8).reshape(nverts, width)
+        return vertices
+    
+    def generateSubmeshBuffers(self, layout = [0,1], formats = None,
+                               maxverts = 65535):
+        """
+        Generates a VBO and a 16 bit IBO for OpenGL, like
+        generateIndexedBuffer, with the mesh split into submeshes of at most
+        maxverts vertices each. The triangles of every material range are
+        partitioned along a Morton curve through their centers, so the
+        submeshes are spatially coherent. Within a submesh the triangles keep
+        their order. Vertices on the submesh borders are duplicated.
+        
+        Returns the vertex buffer, the index buffer (uint16 for maxverts <=
+        65535) and a list of draw ranges (firstindex, indexcount,
+        basevertex, vertexcount, material name), one per submesh, e.g. for
+        glDrawElementsBaseVertex. The indices of a submesh are relative to
+        its basevertex.
+        """
+        tris = np.asarray(self.f, dtype=np.int64).reshape(-1, 3)
+        itype = np.uint16 if maxverts <= 65535 else np.uint32
+        nverts = min(len(a) for a in self._attributes())
+        parts = []
+        for material, first, count in self.materialranges:
+            part = np.arange(first // 3, (first + count) // 3)
+            if nverts <= maxverts:
+                parts.append((material, part))
+            else:
+                parts.extend((material, part[p]) for p in _partition(
+                    tris[part], _mortoncodes(self, tris[part]), maxverts))
+        
+        vertices = self._vertexbytes(layout, formats)
+        vertexlist, indexlist, ranges = [], [], []
+        firstindex = basevertex = 0
+        for material, part in parts:
+            used, local = np.unique(tris[np.sort(part)], return_inverse=True)
+            vertexlist.append(used)
+            indexlist.append(local.astype(itype))
+            ranges.append((firstindex, len(local), basevertex, len(used),
+                           material))
+            firstindex += len(local)
+            basevertex += len(used)
+        order = np.concatenate(vertexlist) if vertexlist else np.zeros(0, dtype=np.int64)
+        vertexbuffer = vertices[order].reshape(-1)
+        if formats is None:
+            vertexbuffer = vertexbuffer.view(np.float32)
+        indexbuffer = (np.concatenate(indexlist) if indexlist
+                       else np.zeros(0, dtype=itype))
+        return vertexbuffer, indexbuffer, ranges
+
+def _spread(x):
+    # Spreads the lower 10 bits of x to every third bit.
+    x = (x | (x << 16)) & 0x030000FF
+    x = (x | (x << 8)) & 0x0300F00F
+    x = (x | (x << 4)) & 0x030C30C3
+    x = (x | (x << 2)) & 0x09249249
+    return x
+
+def _mortoncodes(obj, tris):
+    # 30 bit Morton codes of the triangle centers in the bounding cube, so
+    # flat axes don't dominate the order.
+    v = np.asarray(obj.v, dtype=np.float32)[:, :3]
+    centers = v[tris].mean(axis=1)
+    scale = max(np.max(obj.scale), 1e-30)
+    q = np.clip((centers - obj.minpos) / scale * 1023, 0, 1023).astype(np.int64)
+    return _spread(q[:, 0]) | (_spread(q[:, 1]) << 1) | (_spread(q[:, 2]) << 2)
+
+def _partition(tris, codes, maxverts):
+    '''
+    Splits the triangles in the order of codes into runs with at most
+    maxverts vertices. Returns the triangle numbers of the runs.
+    '''
+    order = np.argsort(codes, kind='mergesort')
+    ordered = tris[order]
+    nverts = lambda start, end: len(np.unique(ordered[start:end]))
+    parts = []
+    start = 0
+    while start < len(order):
+        # Gallop to an end with too many vertices, then bisect.
+        lo, step = start + 1, max(1, maxverts // 3)
+        hi = min(start + step, len(order))
+        while hi < len(order) and nverts(start, hi) <= maxverts:
+            lo, step = hi, 2 * step
+            hi = min(start + step, len(order))
+        if nverts(start, hi) <= maxverts:
+            lo = hi
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if nverts(start, mid) <= maxverts:
+                lo = mid
+            else:
+                hi = mid
+        parts.append(order[start:lo])
+        start = lo
+    return parts
+
+
+def _faceindex(value, count, message):
+    '''
+    Resolves a 1-based (or negative, relative to the count attributes defined
+    so far) index of a face vertex to a 0-based index.
+    '''
+    index = int(value)
+    index = count + index if index < 0 else index - 1
+    if int(value) == 0 or index < 0 or index >= count:
+        raise Exception, message
+    return index
+
+
+def _runs(ids):
+    '''Returns the values, starts and lengths of the runs of equal ids.'''
+    if len(ids) == 0:
+        return [], [], []
+    starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+    counts = np.diff(np.append(starts, len(ids)))
+    return ids[starts].tolist(), starts.tolist(), counts.tolist()
+
+def _outbuffer(buf, dtype, count):
+    '''
+    Returns a numpy array of count elements, that is either newly allocated
+    or a view of the given writable buffer.
+    '''
+    if buf is None:
+        return np.empty(count, dtype=dtype)
+    nbytes = np.dtype(dtype).itemsize * count
+    if np.frombuffer(buf, dtype=np.uint8).nbytes < nbytes:
+        raise Exception, 'Buffer too small, %i bytes needed.' % nbytes
+    return np.frombuffer(buf, dtype=dtype, count=count)
+
+
+class ObjChunk(object):
+    """
+    A part of an obj-file as yielded by readobjchunks.
+    
+    v, vn and vt hold the attributes defined in this part, the global index
+    of their first row is stored in voffset, vnoffset and vtoffset. f holds
+    the faces of this part as (N, 3) array of global position indices, fn
+    and ft the normal and texture coordinate indices (-1 if the faceformat
+    lacks them). minpos and maxpos are the bounding box of all vertices read
+    so far.
+    """
+    def __init__(self, v, vn, vt, faces, offsets, faceformat, minpos, maxpos):
+        self.v, self.vn, self.vt = v, vn, vt
+        self.voffset, self.vnoffset, self.vtoffset = offsets
+        self.faceformat = faceformat
+        self.f = faces[:, 0].reshape(-1, 3)
+        self.fn = faces[:, 1].reshape(-1, 3)
+        self.ft = faces[:, 2].reshape(-1, 3)
+        self.minpos = minpos
+        self.maxpos = maxpos
+        self.scale = maxpos - minpos
+
+def readobjchunks(filename, chunksize = 1 << 24, padnormals = 4, padtexcoords = 4):
+    """
+    Reads an obj-file in chunks of (at least) chunksize bytes and yields an
+    ObjChunk for each of them. Only the data of one chunk is held in memory,
+    so arbitrarily large files can be processed. Chunks always end at a line
+    boundary, and faces may reference attributes of previous chunks.
+    Polygons are triangulated with the positions of their chunk, polygons
+    using positions of previous chunks are assumed to be convex.
+    """
+    offsets = np.zeros(3, dtype=np.int64)
+    faceformat = None
+    firstline = 1
+    minpos = np.empty(3, dtype=np.float32)
+    minpos[:] = np.inf
+    maxpos = -minpos
+    rest = b''
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunksize)
+            eof = len(data) == 0
+            data = rest + data
+            if not eof:
+                end = data.rfind(b'\n') + 1
+                if end == 0:
+                    # Not even a single line, continue reading.
+                    rest = data
+                    continue
+                data, rest = data[:end], data[end:]
+            elif len(data) == 0:
+                break
+            v, vn, vt, faces, nverts, faceformat, _ = _bulkparse(data,
+                padnormals, padtexcoords, offsets, faceformat, firstline)
+            faces = _triangulate(v, faces, nverts, offsets[0])
+            if len(v) > 0:
+                minpos = np.minimum(minpos, np.amin(v, axis=0)[:3])
+                maxpos = np.maximum(maxpos, np.amax(v, axis=0)[:3])
+            yield ObjChunk(v, vn, vt, faces, tuple(offsets), faceformat,
+                minpos, maxpos)
+            offsets += [len(v), len(vn), len(vt)]
+            firstline += data.count(b'\n')
+            if eof:
+                break
+
+
+##############################################################################
+# Materials
+##############################################################################
+# Options of texture map statements and their (maximum) number of arguments.
+_MAP_OPTIONS = {'-blendu' : 1, '-blendv' : 1, '-bm' : 1, '-boost' : 1,
+                '-cc' : 1, '-clamp' : 1, '-imfchan' : 1, '-mm' : 2, '-o' : 3,
+                '-s' : 3, '-t' : 3, '-texres' : 1, '-type' : 1}
+
+# Texture map statements, with the names used in materials.
+_MAP_STATEMENTS = {'map_Ka' : 'map_Ka', 'map_Kd' : 'map_Kd',
+                   'map_Ks' : 'map_Ks', 'map_Ke' : 'map_Ke',
+                   'map_Ns' : 'map_Ns', 'map_d' : 'map_d',
+                   'map_bump' : 'bump', 'map_Bump' : 'bump', 'bump' : 'bump',
+                   'norm' : 'norm', 'disp' : 'disp', 'decal' : 'decal',
+                   'refl' : 'refl'}
+
+def _isnumber(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def _resolvepath(directory, path):
+    '''
+    Resolves a texture path of an mtl-file relative to its directory. Windows
+    separators are converted, if the file doesn't exist there, it is looked
+    up by its name in the directory.
+    '''
+    path = os.path.normpath(os.path.join(directory, path.replace('\\', '/')))
+    if not os.path.exists(path):
+        candidate = os.path.join(directory, os.path.basename(path))
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+class Material(object):
+    """
+    A material of an mtl-file. Ka, Kd, Ks, Ke and Tf are the color
+    statements as float32 arrays, Ns, Ni and d (1 - Tr) the scalars and illum
+    the illumination model. maps maps the texture statements (map_Kd, bump,
+    ...) to the resolved texture paths, mapoptions to their options as dict
+    of option name to the list of arguments.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.Ka = np.zeros(3, dtype=np.float32)
+        self.Kd = np.ones(3, dtype=np.float32)
+        self.Ks = np.zeros(3, dtype=np.float32)
+        self.Ke = np.zeros(3, dtype=np.float32)
+        self.Tf = np.ones(3, dtype=np.float32)
+        self.Ns = 0.0
+        self.Ni = 1.0
+        self.d = 1.0
+        self.illum = 2
+        self.maps = {}
+        self.mapoptions = {}
+    
+    def __repr__(self):
+        return 'Material(%r)' % self.name
+
+class MtlFileParser(object):
+    """
+    Parser for Wavefront Mtl. Files.
+    Supports the color, scalar, illum and texture map statements, materials
+    maps the material names to Material objects.
+    """
+    def __init__(self, filename):
+        self.directory = os.path.dirname(filename)
+        self.materials = {}
+        self.current = None
+        handlers = {
+            'newmtl' : self._newmtl,
+            'Ns' : self._scalar,
+            'Ni' : self._scalar,
+            'd' : self._scalar,
+            'Tr' : self._scalar,
+            'illum' : self._illum,
+        }
+        for color in ('Ka', 'Kd', 'Ks', 'Ke', 'Tf'):
+            handlers[color] = self._color
+        for statement in _MAP_STATEMENTS:
+            handlers[statement] = self._map
+        
+        with open(filename, 'r') as f:
+            i = 0
+            for line in f:
                 i += 1
-        return vertexbuffer, indexbuffer
\ No newline at end of file
+                line = line.split('#', 1)[0].split(None, 1)
+                if len(line) > 0 and line[0] in handlers:
+                    try:
+                        if line[0] != 'newmtl' and self.current is None:
+                            raise Exception, 'No material defined.'
+                        handlers[line[0]](line[0], line[1] if len(line) > 1 else '')
+                    except Exception as e:
+                        raise Exception, 'Parsing error at line %i: %s' % (i, e)
+        del self.current
+    
+    def _newmtl(self, statement, args):
+        name = args.strip()
+        self.current = self.materials[name] = Material(name)
+    
+    def _color(self, statement, args):
+        args = args.split()
+        # Spectral and CIEXYZ colors are not supported.
+        if len(args) == 0 or not _isnumber(args[0]):
+            return
+        values = [float(x) for x in args[:3]]
+        if len(values) == 1:
+            values *= 3
+        elif len(values) != 3:
+            raise Exception, 'A color must have 1 or 3 values.'
+        setattr(self.current, statement, np.array(values, dtype=np.float32))
+    
+    def _scalar(self, statement, args):
+        args = args.split()
+        if len(args) > 0 and args[0] == '-halo':
+            args = args[1:]
+        if len(args) != 1:
+            raise Exception, '%s must have 1 value.' % statement
+        if statement == 'Tr':
+            self.current.d = 1.0 - float(args[0])
+        else:
+            setattr(self.current, statement, float(args[0]))
+    
+    def _illum(self, statement, args):
+        self.current.illum = int(args)
+    
+    def _map(self, statement, args):
+        args = args.split()
+        options = {}
+        while args and args[0] in _MAP_OPTIONS:
+            option, args = args[0], args[1:]
+            count = _MAP_OPTIONS[option]
+            values = args[:1]
+            # Only -o, -s, -t and -mm have a variable number of numbers.
+            while len(values) < count and len(values) < len(args) and \
+                  _isnumber(args[len(values)]):
+                values = args[:len(values) + 1]
+            options[option] = values
+            args = args[len(values):]
+        if not args:
+            raise Exception, 'Missing texture file.'
+        name = _MAP_STATEMENTS[statement]
+        self.current.maps[name] = _resolvepath(self.directory, ' '.join(args))
+        self.current.mapoptions[name] = options
+
+class MaterialCache(object):
+    """
+    Caches parsed mtl-files by their path, so a material library shared by
+    many obj-files is parsed once and all of them use the same Material
+    objects. Files are parsed again if they have been modified.
+    """
+    def __init__(self):
+        self.libraries = {}
+    
+    def load(self, filename):
+        """Returns the materials of the mtl-file as dict of name to Material."""
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        entry = self.libraries.get(path)
+        if entry is None or entry[0] != key:
+            entry = (key, MtlFileParser(path).materials)
+            self.libraries[path] = entry
+        return entry[1]
+    
+    def clear(self):
+        self.libraries.clear()
+
+defaultmaterialcache = MaterialCache()
+
+def groupbymaterial(parsers):
+    """
+    Groups the material ranges of several ObjFileParser objects, which share
+    Material objects through a MaterialCache. Returns a list of (material,
+    [(parser, first index, index count), ...]) in order of first use, so a
+    scene can be drawn with one bind per material. Ranges without a known
+    material are grouped under their name (or None).
+    """
+    groups = []
+    index = {}
+    for parser in parsers:
+        for name, first, count in parser.materialranges:
+            material = parser.materials.get(name, name)
+            key = id(material) if isinstance(material, Material) else (name,)
+            if key not in index:
+                index[key] = len(groups)
+                groups.append((material, []))
+            groups[index[key]][1].append((parser, first, count))
+    return groups